@@ -0,0 +1,381 @@
+"""A local stand-in for a mastodon instance that is used by the benchmarks.
+
+It implements the webfinger, nodeinfo, OAuth, account, statuses and media
+endpoints that mastodon-download-toots uses. Latency, the X-RateLimit headers,
+randomly refused requests and the size of the media files are configurable,
+statuses can be posted, edited and deleted while the server runs.
+"""
+
+import json
+import random
+import time
+from argparse import ArgumentParser
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Optional
+from urllib.parse import parse_qs, urlparse
+
+# the first status is from 2020-01-01 and the account posts every 10 minutes
+FIRST_STATUS = int(datetime(2020, 1, 1, tzinfo=timezone.utc).timestamp() * 1000)
+STATUS_INTERVAL = 10 * 60 * 1000
+CHUNK_SIZE = 64 * 1024
+PAGE_LIMIT = 40
+
+ACCOUNT = {
+    "id": "1",
+    "username": "bench",
+    "acct": "bench",
+    "display_name": "Benchmark account",
+    "locked": False,
+    "bot": False,
+    "created_at": "2019-12-01T00:00:00.000Z",
+    "note": "<p>An account with a lot of statuses</p>",
+    "url": "https://mastodon.example/@bench",
+    "avatar": "https://mastodon.example/avatars/original/missing.png",
+    "avatar_static": "https://mastodon.example/avatars/original/missing.png",
+    "header": "https://mastodon.example/headers/original/missing.png",
+    "header_static": "https://mastodon.example/headers/original/missing.png",
+    "followers_count": 100,
+    "following_count": 100,
+    "statuses_count": 0,
+    "emojis": [],
+    "fields": [],
+}
+
+
+def status_id(i: int) -> int:
+    # snowflake ids like mastodon: milliseconds since the epoch shifted by 16 bits
+    return (FIRST_STATUS + i * STATUS_INTERVAL) << 16
+
+
+class MockInstance:
+    """The state of the mock instance, it may be changed while the server runs."""
+
+    def __init__(
+        self,
+        statuses: int = 1000,
+        media: int = 0,
+        media_size: int = 64 * 1024,
+        latency: float = 0.0,
+        rate_limit: int = 300,
+        rate_limit_window: float = 300.0,
+        refuse_probability: float = 0.0,
+    ) -> None:
+        self.media = media
+        self.media_size = media_size
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.rate_limit_window = rate_limit_window
+        self.refuse_probability = refuse_probability
+        self.lock = Lock()
+        self.__count = 0
+        self.__ids: list[int] = []
+        # the edited statuses and when they were edited
+        self.__edited: dict[int, str] = {}
+        self.add_statuses(statuses)
+        self.reset_counters()
+
+    def add_statuses(self, count: int) -> None:
+        """Post `count` new statuses."""
+        with self.lock:
+            self.__ids.extend(
+                status_id(i) for i in range(self.__count, self.__count + count)
+            )
+            self.__count += count
+
+    def edit_statuses(self, count: int) -> None:
+        """Edit `count` statuses spread evenly over the account."""
+        with self.lock:
+            step = max(len(self.__ids) // count, 1) if count else 1
+            edited_at = datetime.now(timezone.utc).isoformat(timespec="milliseconds")
+            for id in self.__ids[::step][:count]:
+                self.__edited[id] = edited_at
+
+    def delete_statuses(self, count: int) -> None:
+        """Delete `count` statuses spread evenly over the account."""
+        with self.lock:
+            step = max(len(self.__ids) // count, 1) if count else 1
+            deleted = set(self.__ids[::step][:count])
+            self.__ids = [id for id in self.__ids if id not in deleted]
+
+    @property
+    def status_count(self) -> int:
+        return len(self.__ids)
+
+    def reset_counters(self) -> None:
+        with self.lock:
+            self.requests: dict[str, int] = {}
+            self.statuses_sent = 0
+            self.bytes_sent = 0
+            self.refused = 0
+            self.__window_start = 0.0
+            self.__window_requests = 0
+
+    def count_request(self, endpoint: str) -> None:
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+
+    def count_bytes(self, size: int) -> None:
+        with self.lock:
+            self.bytes_sent += size
+
+    def take_api_request(self) -> tuple[bool, int, float]:
+        """Count an API request, returns whether it's allowed, the remaining requests and the reset time."""
+        with self.lock:
+            now = time.time()
+            if now >= self.__window_start + self.rate_limit_window:
+                self.__window_start = now
+                self.__window_requests = 0
+            self.__window_requests += 1
+            allowed = self.__window_requests <= self.rate_limit and (
+                random.random() >= self.refuse_probability
+            )
+            if not allowed:
+                self.refused += 1
+            return (
+                allowed,
+                max(0, self.rate_limit - self.__window_requests),
+                self.__window_start + self.rate_limit_window,
+            )
+
+    def page(
+        self,
+        host: str,
+        limit: int,
+        max_id: Optional[int],
+        since_id: Optional[int],
+        min_id: Optional[int],
+    ) -> list[dict]:
+        """The page of statuses for the query, newest first."""
+        with self.lock:
+            end = len(self.__ids) if max_id is None else bisect_left(self.__ids, max_id)
+            if min_id is not None:
+                start = bisect_right(self.__ids, min_id)
+                end = min(end, start + limit)
+            else:
+                start = 0 if since_id is None else bisect_right(self.__ids, since_id)
+                start = max(start, end - limit)
+            ids = self.__ids[start:end]
+            self.statuses_sent += len(ids)
+        return [self.status(host, id) for id in reversed(ids)]
+
+    def status(self, host: str, id: int) -> dict:
+        created_at = datetime.fromtimestamp((id >> 16) / 1000, timezone.utc)
+        edited_at = self.__edited.get(id)
+        return {
+            "id": str(id),
+            "created_at": created_at.isoformat(timespec="milliseconds").replace(
+                "+00:00", "Z"
+            ),
+            "in_reply_to_id": None,
+            "in_reply_to_account_id": None,
+            "sensitive": False,
+            "spoiler_text": "",
+            "visibility": "public",
+            "language": "en",
+            "uri": f"https://mastodon.example/users/bench/statuses/{id}",
+            "url": f"https://mastodon.example/@bench/{id}",
+            "replies_count": id % 3,
+            "reblogs_count": id % 5,
+            "favourites_count": id % 7,
+            "edited_at": edited_at,
+            "content": f"<p>{'Edited status' if edited_at else 'Status'} {id} of the benchmark account, posted at {created_at:%Y-%m-%d %H:%M}. "
+            + "Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 3
+            + "</p>",
+            "reblog": None,
+            "application": {"name": "Web", "website": None},
+            "account": ACCOUNT,
+            "media_attachments": [
+                {
+                    "id": f"{id}{k}",
+                    "type": "image",
+                    "url": f"{host}/media/{id}{k}.png",
+                    "preview_url": f"{host}/media/{id}{k}_small.png",
+                    "remote_url": None,
+                    "meta": {"original": {"width": 1920, "height": 1080}},
+                    "description": None,
+                    "blurhash": "UFG8_#j[00WB~qj[M{ay00ay?bj[%MWBRjt7",
+                }
+                for k in range(self.media)
+            ],
+            "mentions": [],
+            "tags": [],
+            "emojis": [],
+            "card": None,
+            "poll": None,
+        }
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    server: "MockServer"
+
+    def log_message(self, format: str, *args) -> None:
+        pass
+
+    @property
+    def instance(self) -> MockInstance:
+        return self.server.instance
+
+    def __host(self) -> str:
+        return f"http://{self.headers['Host']}"
+
+    def __send(
+        self,
+        status: int,
+        body: bytes = b"",
+        headers: Optional[dict[str, str]] = None,
+    ) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+        self.instance.count_bytes(len(body))
+
+    def __send_json(self, obj, headers: Optional[dict[str, str]] = None) -> None:
+        self.__send(
+            200,
+            json.dumps(obj).encode("utf-8"),
+            {"Content-Type": "application/json", **(headers or {})},
+        )
+
+    def __start(self) -> Optional[dict[str, str]]:
+        """Count and delay the request, returns the rate limit headers or None if it was refused."""
+        path = urlparse(self.path).path
+        self.instance.count_request("media" if path.startswith("/media/") else path)
+        if self.instance.latency:
+            time.sleep(self.instance.latency)
+        if not path.startswith("/api/"):
+            return {}
+        allowed, remaining, reset = self.instance.take_api_request()
+        headers = {
+            "X-RateLimit-Limit": str(self.instance.rate_limit),
+            "X-RateLimit-Remaining": str(remaining),
+            "X-RateLimit-Reset": datetime.fromtimestamp(
+                reset, timezone.utc
+            ).isoformat(),
+        }
+        if not allowed:
+            self.__send(429, b'{"error": "Too many requests"}', headers)
+            return None
+        return headers
+
+    def do_HEAD(self) -> None:
+        if self.__start() is not None:
+            self.__send(200)
+
+    def do_POST(self) -> None:
+        headers = self.__start()
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if headers is None:
+            return
+        path = urlparse(self.path).path
+        if path == "/api/v1/apps":
+            self.__send_json(
+                {"client_id": "client", "client_secret": "secret"}, headers
+            )
+        elif path == "/oauth/token":
+            self.__send_json({"access_token": "token", "token_type": "Bearer"}, headers)
+        else:
+            self.__send(404)
+
+    def do_GET(self) -> None:
+        headers = self.__start()
+        if headers is None:
+            return
+        url = urlparse(self.path)
+        query = {key: value[0] for key, value in parse_qs(url.query).items()}
+        if url.path == "/.well-known/webfinger":
+            self.__send_json({"subject": "acct:bench@mastodon.example"})
+        elif url.path == "/.well-known/nodeinfo":
+            self.__send_json({"links": [{"href": f"{self.__host()}/nodeinfo/2.0"}]})
+        elif url.path == "/nodeinfo/2.0":
+            self.__send_json({"software": {"name": "mastodon", "version": "4.3.0"}})
+        elif url.path == "/api/v1/accounts/verify_credentials":
+            self.__send_json(
+                {**ACCOUNT, "statuses_count": self.instance.status_count}, headers
+            )
+        elif url.path == "/api/v1/accounts/search":
+            self.__send_json([ACCOUNT], headers)
+        elif url.path == f"/api/v1/accounts/{ACCOUNT['id']}/statuses":
+            self.__send_json(
+                self.instance.page(
+                    self.__host(),
+                    min(int(query.get("limit", 20)), PAGE_LIMIT),
+                    int(query["max_id"]) if "max_id" in query else None,
+                    int(query["since_id"]) if "since_id" in query else None,
+                    int(query["min_id"]) if "min_id" in query else None,
+                ),
+                headers,
+            )
+        elif url.path.startswith("/media/"):
+            self.__send_media(url.path.rsplit("/", 1)[-1])
+        else:
+            self.__send(404)
+
+    def __send_media(self, name: str) -> None:
+        size = self.instance.media_size
+        if "_small" in name:
+            size //= 16
+        etag = f'"{name}-{size}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.__send(304, headers={"ETag": etag})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/png")
+        self.send_header("Content-Length", str(size))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Wed, 01 Jan 2020 00:00:00 GMT")
+        self.end_headers()
+        chunk = (name.encode("utf-8") * (CHUNK_SIZE // len(name) + 1))[:CHUNK_SIZE]
+        left = size
+        while left:
+            n = min(left, CHUNK_SIZE)
+            self.wfile.write(chunk[:n])
+            left -= n
+        self.instance.count_bytes(size)
+
+
+class MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, instance: MockInstance, port: int = 0) -> None:
+        super().__init__(("127.0.0.1", port), Handler)
+        self.instance = instance
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self) -> None:
+        Thread(target=self.serve_forever, daemon=True).start()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Run the mock mastodon instance")
+    parser.add_argument("--port", type=int, default=3000)
+    parser.add_argument("--statuses", type=int, default=1000)
+    parser.add_argument("--media", type=int, default=0)
+    parser.add_argument("--media-size", type=int, default=64 * 1024)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=int, default=300)
+    parser.add_argument("--rate-limit-window", type=float, default=300.0)
+    args = parser.parse_args()
+    server = MockServer(
+        MockInstance(
+            statuses=args.statuses,
+            media=args.media,
+            media_size=args.media_size,
+            latency=args.latency,
+            rate_limit=args.rate_limit,
+            rate_limit_window=args.rate_limit_window,
+        ),
+        args.port,
+    )
+    print(f"Serving a mock mastodon instance at {server.url}")
+    server.serve_forever()
@@ -0,0 +1,280 @@
+"""Run mastodon-download-toots against the mock instance and report its throughput.
+
+Every scenario runs the command line tool in a subprocess inside a temporary
+directory, so the peak RSS is measured for that run alone. Save the results of
+a run with `--save` and pass them to a later run with `--compare` to fail if
+the throughput drops or the memory usage grows more than the tolerance.
+"""
+
+import json
+import os
+import subprocess
+import sys
+from argparse import ArgumentParser, Namespace
+from os.path import abspath, dirname
+from tempfile import TemporaryDirectory, TemporaryFile
+from time import perf_counter
+from typing import Optional, TypedDict
+
+from mock_server import MockInstance, MockServer
+
+REPOSITORY = dirname(dirname(abspath(__file__)))
+
+
+class Scenario(TypedDict):
+    args: list[str]
+    # attachments per status
+    media: int
+    # run the tool once before the measured run and post these statuses in between
+    incremental: Optional[int]
+    # statuses edited and deleted between the runs of an incremental scenario
+    edited: int
+    deleted: int
+
+
+class Result(TypedDict):
+    scenario: str
+    statuses: int
+    seconds: float
+    statuses_per_second: float
+    bytes_per_second: float
+    peak_rss: int
+    requests: int
+    refused: int
+    db_write_seconds: float
+
+
+SCENARIOS: dict[str, Scenario] = {
+    "json": {
+        "args": ["-o", "out.json"],
+        "media": 0,
+        "incremental": None,
+        "edited": 0,
+        "deleted": 0,
+    },
+    "zip": {
+        "args": ["-z", "-o", "out.zip"],
+        "media": 1,
+        "incremental": None,
+        "edited": 0,
+        "deleted": 0,
+    },
+    "sqlite-initial": {
+        "args": ["-s", "-o", "out.sqlite"],
+        "media": 0,
+        "incremental": None,
+        "edited": 0,
+        "deleted": 0,
+    },
+    "sqlite-incremental": {
+        "args": ["-s", "-o", "out.sqlite"],
+        "media": 0,
+        "incremental": 200,
+        "edited": 0,
+        "deleted": 0,
+    },
+    # compare with sqlite-initial, the full crawl that rewrites every row
+    "sqlite-refresh": {
+        "args": ["-s", "--refresh", "-o", "out.sqlite"],
+        "media": 0,
+        "incremental": 0,
+        "edited": 50,
+        "deleted": 20,
+    },
+    "media": {
+        "args": ["-m", "--media-output", "media", "-o", "out.json"],
+        "media": 4,
+        "incremental": None,
+        "edited": 0,
+        "deleted": 0,
+    },
+}
+
+parser = ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument(
+    "scenarios",
+    nargs="*",
+    help=f"Scenarios to run, all by default: {', '.join(SCENARIOS)}",
+)
+parser.add_argument(
+    "--statuses", type=int, default=2000, help="Statuses of the account"
+)
+parser.add_argument(
+    "--media-size",
+    type=int,
+    default=256 * 1024,
+    help="Size of every attachment in bytes",
+)
+parser.add_argument(
+    "--latency", type=float, default=0.0, help="Seconds every request is delayed"
+)
+parser.add_argument(
+    "--rate-limit", type=int, default=300, help="API requests per rate limit window"
+)
+parser.add_argument(
+    "--rate-limit-window",
+    type=float,
+    default=300.0,
+    help="Seconds until the rate limit is reset",
+)
+parser.add_argument(
+    "--refuse-probability",
+    type=float,
+    default=0.0,
+    help="Probability that an API request is refused with 429",
+)
+parser.add_argument(
+    "--tool-args",
+    type=str,
+    default="",
+    help="Additional arguments passed to mastodon-download-toots, e.g. '--crawl-workers 4'",
+)
+parser.add_argument("--save", type=str, help="Write the results to this JSON file")
+parser.add_argument(
+    "--compare",
+    type=str,
+    help="Compare the results with a file written by --save and fail on regressions",
+)
+parser.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.2,
+    help="Allowed relative regression for --compare",
+)
+
+
+def run_tool(url: str, cwd: str, args: list[str]) -> tuple[int, dict[str, float]]:
+    """Run the tool and return its peak RSS in bytes and the metrics of the run."""
+    env = {**os.environ, "PYTHONPATH": REPOSITORY}
+    with TemporaryFile() as stderr:
+        process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "mastodon_download",
+                "-c",
+                "cache",
+                "--metrics-file",
+                "metrics.json",
+                *args,
+                url,
+            ],
+            cwd=cwd,
+            env=env,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=stderr,
+        )
+        assert process.stdin
+        # the authorization code asked for on the first run
+        process.stdin.write(b"code\n")
+        process.stdin.close()
+        _, status, rusage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+        if process.returncode != 0:
+            stderr.seek(0)
+            raise Exception(
+                f"mastodon-download-toots {' '.join(args)} failed:\n{stderr.read().decode()}"
+            )
+    with open(os.path.join(cwd, "metrics.json")) as file:
+        metrics = json.load(file)
+    # ru_maxrss is in kilobytes on linux and in bytes on macOS
+    peak_rss = rusage.ru_maxrss if sys.platform == "darwin" else rusage.ru_maxrss * 1024
+    return peak_rss, metrics
+
+
+def run_scenario(name: str, scenario: Scenario, args: Namespace) -> Result:
+    instance = MockInstance(
+        statuses=args.statuses,
+        media=scenario["media"],
+        media_size=args.media_size,
+        latency=args.latency,
+        rate_limit=args.rate_limit,
+        rate_limit_window=args.rate_limit_window,
+        refuse_probability=args.refuse_probability,
+    )
+    server = MockServer(instance)
+    server.start()
+    tool_args = scenario["args"] + args.tool_args.split()
+    try:
+        with TemporaryDirectory() as directory:
+            if scenario["incremental"] is not None:
+                run_tool(server.url, directory, tool_args)
+                instance.add_statuses(scenario["incremental"])
+                instance.edit_statuses(scenario["edited"])
+                instance.delete_statuses(scenario["deleted"])
+                instance.reset_counters()
+            start = perf_counter()
+            peak_rss, metrics = run_tool(server.url, directory, tool_args)
+            seconds = perf_counter() - start
+    finally:
+        server.shutdown()
+        server.server_close()
+
+    return {
+        "scenario": name,
+        "statuses": instance.statuses_sent,
+        "seconds": seconds,
+        "statuses_per_second": instance.statuses_sent / seconds,
+        "bytes_per_second": instance.bytes_sent / seconds,
+        "peak_rss": peak_rss,
+        "requests": sum(instance.requests.values()),
+        "refused": instance.refused,
+        "db_write_seconds": metrics.get("db_write_seconds", 0.0),
+    }
+
+
+def print_results(results: list[Result]) -> None:
+    print(
+        f"{'Scenario':<20} {'Statuses':>9} {'Seconds':>8} {'Statuses/s':>11} {'MiB/s':>8} {'Peak RSS MiB':>13} {'Requests':>9} {'429s':>5} {'DB write s':>11}"
+    )
+    for result in results:
+        print(
+            f"{result['scenario']:<20} {result['statuses']:>9} {result['seconds']:>8.2f} {result['statuses_per_second']:>11.1f} {result['bytes_per_second'] / 2**20:>8.1f} {result['peak_rss'] / 2**20:>13.1f} {result['requests']:>9} {result['refused']:>5} {result['db_write_seconds']:>11.3f}"
+        )
+
+
+def compare_results(
+    results: list[Result], baseline: list[Result], tolerance: float
+) -> bool:
+    """Print the changes compared to `baseline`, returns False if anything regressed."""
+    ok = True
+    baseline_results = {result["scenario"]: result for result in baseline}
+    for result in results:
+        old = baseline_results.get(result["scenario"])
+        if old is None:
+            continue
+        speed = result["statuses_per_second"] / old["statuses_per_second"] - 1
+        memory = result["peak_rss"] / old["peak_rss"] - 1
+        regressed = speed < -tolerance or memory > tolerance
+        ok = ok and not regressed
+        print(
+            f"{result['scenario']:<20} statuses/s {speed:+.1%}, peak RSS {memory:+.1%}{'  REGRESSION' if regressed else ''}"
+        )
+    return ok
+
+
+def main() -> None:
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"Unknown scenario: {name}")
+    results = [
+        run_scenario(name, SCENARIOS[name], args)
+        for name in args.scenarios or SCENARIOS
+    ]
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        print()
+        if not compare_results(results, baseline, args.tolerance):
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
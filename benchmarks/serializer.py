@@ -0,0 +1,105 @@
+"""Measure the cost of encoding and decoding statuses with every JSON backend.
+
+The statuses are the ones the mock instance serves. Every backend of
+`mastodon_download.serializer` that is installed is compared with the plain
+json module calls the tool used before, and its output is checked to be the
+same bytes as the output of the json module fallback.
+"""
+
+import json
+import sys
+from argparse import ArgumentParser
+from os.path import abspath, dirname
+from time import perf_counter
+from typing import Callable
+
+from mock_server import MockInstance
+
+REPOSITORY = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, REPOSITORY)
+
+from mastodon_download import serializer  # noqa: E402
+from mastodon_download.sqlite import status_hash  # noqa: E402
+
+parser = ArgumentParser(description=__doc__.splitlines()[0])
+parser.add_argument(
+    "--statuses", type=int, default=10000, help="Statuses that are encoded and decoded"
+)
+parser.add_argument("--media", type=int, default=1, help="Attachments per status")
+parser.add_argument(
+    "--repeat", type=int, default=5, help="Runs of every measurement, the best counts"
+)
+
+
+def measure(function: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        best = min(best, perf_counter() - start)
+    return best
+
+
+def main() -> None:
+    args = parser.parse_args()
+    instance = MockInstance(statuses=args.statuses, media=args.media)
+    statuses = instance.page(
+        "https://mastodon.example", args.statuses, None, None, None
+    )
+    # every 10th status with text that isn't ASCII
+    for status in statuses[::10]:
+        status["content"] += "<p>Grüße 🐘 “quoted”</p>"
+    scale = 10000 / len(statuses)
+
+    print(
+        f"{'Backend':<16} {'Encode ms/10k':>14} {'Decode ms/10k':>14} {'Hash ms/10k':>12} {'MiB':>7}"
+    )
+    encoded = [json.dumps(status).encode("utf-8") for status in statuses]
+    encode = measure(
+        lambda: [json.dumps(status).encode("utf-8") for status in statuses],
+        args.repeat,
+    )
+    decode = measure(lambda: [json.loads(data) for data in encoded], args.repeat)
+    print(
+        f"{'json (before)':<16} {encode * scale * 1000:>14.1f} {decode * scale * 1000:>14.1f} {'':>12} {sum(map(len, encoded)) / 2**20:>7.1f}"
+    )
+
+    orjson = serializer.orjson
+    backends = ["json", "orjson"] if orjson else ["json"]
+    outputs: dict[str, list[bytes]] = {}
+    try:
+        for name in backends:
+            if name == "json":
+                # the fallback used when orjson isn't installed
+                serializer.orjson = None  # type: ignore[assignment]
+            else:
+                serializer.orjson = orjson
+            encoded = [serializer.dumps(status) for status in statuses]
+            encode = measure(
+                lambda: [serializer.dumps(status) for status in statuses], args.repeat
+            )
+            decode = measure(
+                lambda: [serializer.loads(data) for data in encoded], args.repeat
+            )
+            hashing = measure(
+                lambda: [status_hash(status) for status in statuses], args.repeat
+            )
+            if [serializer.loads(data) for data in encoded] != statuses:
+                raise Exception(f"{name} doesn't decode the statuses it encoded")
+            outputs[name] = encoded
+            print(
+                f"{name:<16} {encode * scale * 1000:>14.1f} {decode * scale * 1000:>14.1f} {hashing * scale * 1000:>12.1f} {sum(map(len, encoded)) / 2**20:>7.1f}"
+            )
+    finally:
+        serializer.orjson = orjson
+
+    if "orjson" in outputs:
+        identical = outputs["orjson"] == outputs["json"]
+        print()
+        print(f"orjson output identical to json output: {identical}")
+        if not identical:
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
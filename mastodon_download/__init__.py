@@ -1,22 +1,139 @@
+from argparse import Namespace
 from datetime import datetime
-from json import dump, dumps
+from io import BytesIO
+from itertools import chain, islice
 from os import mkdir, remove
 from os.path import exists, join
-from typing import Any, Optional
-from zipfile import ZipFile
-
-from requests import HTTPError
+from time import perf_counter, time
+from typing import IO, BinaryIO, Iterator, Optional, TypedDict
+from urllib.parse import urlparse
+from zipfile import ZIP_DEFLATED, ZIP_STORED, BadZipFile, ZipFile, ZipInfo, is_zipfile
 
+from mastodon_download.archive import (
+    TailBackup,
+    extract_member,
+    remove_member,
+    write_member,
+)
 from mastodon_download.args import parser
-from mastodon_download.mastodon import Mastodon, RateLimitExceededException
+from mastodon_download.checkpoint import Checkpoint, CrawlState
+from mastodon_download.compressed import CompressedStatusWriter, index_path
+from mastodon_download.crawl import PAGE_SIZE, crawl, crawl_parallel, snowflake_id
+from mastodon_download.mastodon import Account, Mastodon
+from mastodon_download.media import FAILED_MEDIA_FILE, MediaDownloader
+from mastodon_download.mediapolicy import SKIPPED_MEDIA_FILE, MediaPolicy, SkippedMedia
+from mastodon_download.mediastore import MediaStore
+from mastodon_download.metrics import metrics, progress
+from mastodon_download.reader import StatusReader
+from mastodon_download.session import PooledSession
 from mastodon_download.sqlite import SqliteDatabase
+from mastodon_download.writer import StatusWriter
+
+
+class BackupResult(TypedDict):
+    statuses: int
+    media: int
+    media_bytes: int
+
+
+def batched(statuses: Iterator[dict], size: int) -> Iterator[list[dict]]:
+    while batch := list(islice(statuses, size)):
+        yield batch
+
+
+def backup_options(domain: str, **options) -> Namespace:
+    """Build the options of `backup` like the command line would, e.g. `backup_options("mastodon.social", zip=True)`.
+
+    The names of the options are the long command line options with underscores.
+    """
+    args = normalize_domain(parser.parse_args([domain]))
+    for key, value in options.items():
+        if not hasattr(args, key):
+            raise Exception(f"Unknown option: {key}")
+        setattr(args, key, value)
+    return args
+
+
+def normalize_domain(args: Namespace) -> Namespace:
+    """Reduce a domain passed as url (e.g. `http://localhost:3000`) to its host.
+
+    The url is kept as `instance`, the instance is discovered from it.
+    """
+    args.instance = args.domain
+    if "://" in args.domain:
+        args.domain = urlparse(args.domain).netloc
+    return args
+
+
+def account_domain(args: Namespace, account: Account) -> str:
+    """Check that `account` is the account searched for by `--user`, returns the domain of its instance."""
+    if not args.user:
+        return args.domain
+    if account["acct"] != args.user:
+        raise Exception(
+            f"User was not found: Searched for {args.user} but got {account['acct']}"
+        )
+    acct = account["acct"].split("@")
+    return args.domain if len(acct) == 1 else acct[1]
+
+
+def default_output(
+    args: Namespace, account: Account, instance_domain: str, extension: str
+) -> str:
+    if args.sync_sqlite:
+        return f"{account['username']}_{instance_domain}.sqlite"
+    date = datetime.now().strftime("%Y-%m-%d")
+    return f"{account['username']}_{instance_domain}_{date}.{extension}"
+
+
+def media_policy(args: Namespace) -> MediaPolicy:
+    """The media policy configured by `args`, the types may also be lists (e.g. in batch configs)."""
+
+    def types(value: Optional[str | list[str]]) -> Optional[set[str]]:
+        if value is None:
+            return None
+        return set(value.split(",") if isinstance(value, str) else value)
+
+    return MediaPolicy(
+        types=types(args.media_types),
+        preview_types=types(args.media_preview_types),
+        max_dimension=args.media_max_dimension,
+        max_duration=args.media_max_duration,
+        budget=args.media_budget,
+    )
 
 
 def main() -> None:
-    args = parser.parse_args()
+    args = normalize_domain(parser.parse_args())
+    progress.mode = args.progress
+    try:
+        with metrics.timer("run_seconds"):
+            run(args)
+    except BaseException:
+        metrics.add("failed_runs")
+        raise
+    finally:
+        if args.metrics_file:
+            metrics.write(
+                args.metrics_file,
+                args.metrics_format,
+                {"domain": args.domain, "account_profile": args.account_profile or ""},
+            )
+        progress.done(metrics.snapshot())
+
+
+def run(args: Namespace) -> None:
+    # one connection pool per host for the instance and every media host,
+    # each large enough for the concurrent downloads plus the status pager
+    session = PooledSession(
+        pool_connections=args.media_workers + 1,
+        pool_maxsize=args.media_host_concurrency + 1,
+    )
     mastodon = Mastodon.from_instance_domain(
-        args.domain,
+        args.instance,
         args.cache_dir,
+        session=session,
+        discovery_ttl=0 if args.refresh_discovery else args.discovery_ttl,
         account_profile=args.account_profile,
         req_rate_limit=args.rate_limit,
     )
@@ -31,31 +148,86 @@ def main() -> None:
         code = input("Authorize code: ")
         mastodon.create_token(code)
 
+    backup(mastodon, args)
+
+    stats = session.stats
+    metrics.add("connections", stats.connections)
+    metrics.add("reused_connections", stats.reused_connections)
+    progress.message(
+        f"Reused connections for {stats.reused_connections}/{stats.requests} requests, "
+        f"saved about {stats.saved_time:.1f} seconds of connection setup"
+    )
+
+
+def backup(
+    mastodon: Mastodon, args: Namespace, interactive: bool = True
+) -> BackupResult:
+    """Download the statuses (and media) of an account as configured by the command line `args`.
+
+    Without `interactive` an existing output file is only overwritten with `--overwrite`.
+    """
+    result: BackupResult = {"statuses": 0, "media": 0, "media_bytes": 0}
     if args.user:
-        accounts = mastodon.search_accounts(args.user, limit=1, resolve=True)
-        account = accounts[0]
-        if account["acct"] != args.user:
-            raise Exception(
-                f"User was not found: Searched for {args.user} but got {account['acct']}"
-            )
-        acct = account["acct"].split("@")
-        instance_domain = args.domain if len(acct) == 1 else acct[1]
+        account = mastodon.search_accounts(args.user, limit=1, resolve=True)[0]
     else:
         account = mastodon.get_me()
-        instance_domain = args.domain
+    instance_domain = account_domain(args, account)
+
+    # compressed JSON output is written as gzip compressed newline-delimited JSON
+    compressed_json = args.compress and not args.zip and not args.sync_sqlite
+    if compressed_json and args.optimize_json:
+        raise Exception("--optimize-json can't be used for compressed JSON output")
+    extension = "zip" if args.zip else "ndjson.gz" if compressed_json else "json"
+
+    if args.update and not args.zip:
+        raise Exception(
+            "--update only works for zip files, use --sync-sqlite for incremental backups"
+        )
+    if args.update and args.resume:
+        raise Exception("--resume can't be used with --update")
+    if args.refresh and not args.sync_sqlite:
+        raise Exception("--refresh only works with --sync-sqlite")
+    if args.refresh and args.resume:
+        raise Exception("--resume can't be used with --refresh")
+
+    checkpoint = None
+    state: Optional[CrawlState] = None
+    if not args.sync_sqlite:
+        checkpoint = Checkpoint(
+            args.cache_dir, f"{args.domain} {account['id']} {extension}"
+        )
+        if args.resume:
+            state = checkpoint.load()
+            if state and args.output and state["output"] != args.output:
+                raise Exception(
+                    f"Can't resume: The interrupted download was written to {state['output']}"
+                )
 
     output = args.output
+    if state:
+        output = state["output"]
     if not output:
-        if args.sync_sqlite:
-            output = f"{account['username']}_{instance_domain}.sqlite"
-        else:
-            date = datetime.now().strftime("%Y-%m-%d")
-            output = f"{account['username']}_{instance_domain}_{date}.{'zip' if args.zip else 'json'}"
+        output = default_output(args, account, instance_domain, extension)
+
+    # an update adds the statuses newer than the newest status of the archive
+    update = args.update and exists(output)
+
+    # the end of a zip file that is appended to is copied to the cache directory
+    # first, so it can be put back if the process is killed before it's closed
+    tail = TailBackup(args.cache_dir, output) if args.zip else None
 
-    if not args.sync_sqlite and exists(output):
-        if input("Output file already exists, overwriting? [y/n] ").lower() != "y":
-            return
+    if not args.sync_sqlite and not state and not update and exists(output):
+        if not args.overwrite:
+            if not interactive:
+                raise Exception(f"Output file {output} already exists")
+            if input("Output file already exists, overwriting? [y/n] ").lower() != "y":
+                return result
         remove(output)
+        if compressed_json and exists(index_path(output)):
+            remove(index_path(output))
+    if tail and not state and not update:
+        # left behind by an archive that was written to this path before
+        tail.remove()
 
     media_output = args.media_output
     if args.media and not media_output:
@@ -67,118 +239,343 @@ def main() -> None:
         mkdir(media_output)
 
     zipfile = None
+    # the zip file of a download that was killed before it was closed once has
+    # no central directory, it's written again from the spooled statuses
+    rebuild = False
     if args.zip:
-        zipfile = ZipFile(output, "x")
+        if (state or update) and tail and tail.restore():
+            progress.warning(
+                f"Restored {output} as it was before the interrupted {'update' if update else 'download'}"
+            )
+        if state and not is_zipfile(output):
+            progress.warning(
+                f"{output} wasn't closed by the interrupted download, the attachments are downloaded again"
+            )
+            if exists(output):
+                remove(output)
+            rebuild = True
+        # in append mode a file that isn't a zip file is appended to instead of failing
+        try:
+            if update and not is_zipfile(output):
+                raise BadZipFile(output)
+            zipfile = ZipFile(output, "a" if (state and not rebuild) or update else "x")
+        except BadZipFile:
+            raise Exception(
+                f"Can't {'update' if update else 'resume'}: {output} is damaged, start a new download without --{'update' if update else 'resume'}"
+            )
+
+    # the statuses of the archive are copied before the new statuses.json is
+    # written and added behind the new statuses at the end
+    old_member: Optional[tuple[ZipInfo, IO[bytes]]] = None
+    old_statuses: Iterator[dict] = iter([])
+    since_id: Optional[str] = None
+    if zipfile and update:
+        try:
+            old_member = extract_member(zipfile, "statuses.json")
+        except BadZipFile as e:
+            zipfile.close()
+            raise Exception(f"Can't update: statuses.json of {output} is damaged: {e}")
+        if old_member:
+            reader = StatusReader(old_member[1])
+            if reader.optimize_json != args.optimize_json:
+                zipfile.close()
+                raise Exception(
+                    f"Can't update: {output} was {'' if reader.optimize_json else 'not '}written with --optimize-json"
+                )
+            old_statuses = iter(reader)
+            newest_old_status = next(old_statuses, None)
+            if newest_old_status:
+                since_id = newest_old_status["id"]
+                old_statuses = chain([newest_old_status], old_statuses)
+        for name in (SKIPPED_MEDIA_FILE, FAILED_MEDIA_FILE):
+            if name in zipfile.NameToInfo:
+                # the attachments of the old statuses are submitted again, so
+                # the skipped and failed ones are recorded again
+                remove_member(zipfile, zipfile.getinfo(name))
+        if old_member:
+            remove_member(zipfile, old_member[0])
+    if zipfile and tail and ((state and not rebuild) or update):
+        tail.save(zipfile.start_dir)
 
     sqlite = None
     if args.sync_sqlite:
-        sqlite = SqliteDatabase(output)
+        sqlite = SqliteDatabase(output, normalize=args.normalize_sqlite)
         sqlite.set_account(account)
+        sqlite.set_instance(args.instance)
+        if args.resume:
+            state = sqlite.get_crawl_state()
 
-    all_statuses: list[dict] = []
-    status_count = 0
+    store = MediaStore(args.media_store) if args.media_store else None
+    downloader = None
+    skipped_media_path: Optional[str] = None
+    failed_media_path: Optional[str] = None
+    if media_output:
+        # a zip crawl keeps the skipped and failed attachments next to its
+        # checkpoint until they are written to the archive
+        if checkpoint and zipfile:
+            skipped_media_path = checkpoint.skipped_media_path
+            failed_media_path = checkpoint.failed_media_path
+        else:
+            skipped_media_path = join(media_output, SKIPPED_MEDIA_FILE)
+            failed_media_path = join(media_output, FAILED_MEDIA_FILE)
+        downloader = MediaDownloader(
+            mastodon,
+            media_output,
+            zipfile=zipfile,
+            store=store,
+            workers=args.media_workers,
+            host_concurrency=args.media_host_concurrency,
+            policy=media_policy(args),
+            skipped=(
+                SkippedMedia.load(skipped_media_path)
+                if state or not zipfile
+                else SkippedMedia()
+            ),
+            failed=(
+                SkippedMedia.load(failed_media_path)
+                if state or not zipfile
+                else SkippedMedia()
+            ),
+        )
+
+    # in zip mode the statuses are spooled to a file in the cache directory
+    # because the zip file is written by the media downloader at the same time
+    statuses_file: Optional[BinaryIO] = None
+    index_file: Optional[BinaryIO] = None
+    writer: Optional[StatusWriter | CompressedStatusWriter] = None
+    if checkpoint:
+        path = checkpoint.spool_path if zipfile else output
+        statuses_file = open(path, "r+b" if state else "w+b")
+        if state:
+            statuses_file.truncate(state["statuses_offset"])
+            statuses_file.seek(state["statuses_offset"])
+        if compressed_json:
+            index_file = open(index_path(output), "r+b" if state else "w+b")
+            writer = CompressedStatusWriter(
+                statuses_file,
+                index_file,
+                count=state["status_count"] if state else 0,
+            )
+        else:
+            writer = StatusWriter(
+                statuses_file,
+                optimize_json=args.optimize_json,
+                count=state["status_count"] if state else 0,
+            )
+
+    # an incremental sync pages forward from the newest stored status using
+    # min_id, a full crawl pages backwards from the newest status using max_id
     min_id: Optional[str] = None
     max_id: Optional[str] = None
     page = 1
+    status_count = 0
+    newest_status: Optional[str] = None
 
-    if sqlite:
+    if state:
+        max_id = state["max_id"]
+        page = state["page"]
+        status_count = state["status_count"]
+        newest_status = state["newest_status"]
+        if downloader and rebuild and writer and statuses_file and checkpoint:
+            # the spooled statuses are read as a finished document, the end
+            # is cut off again before the crawl continues
+            writer.close()
+            statuses_file.flush()
+            with open(checkpoint.spool_path, "rb") as spool:
+                for status in StatusReader(spool):
+                    for attachment in status["media_attachments"]:
+                        downloader.submit(attachment)
+            statuses_file.truncate(state["statuses_offset"])
+            statuses_file.seek(state["statuses_offset"])
+        elif downloader:
+            for attachment in state["pending_media"]:
+                downloader.submit(attachment)
+        progress.message(f"Resuming at page {page}...")
+    elif args.refresh:
+        # a refresh pages backwards from the newest status like a full crawl
+        if args.refresh_days:
+            since_id = snowflake_id(time() - args.refresh_days * 24 * 60 * 60)
+    elif sqlite:
         min_id = sqlite.get_newest_status()
+        if downloader and min_id:
+            # an incremental sync doesn't see the statuses of the skipped and
+            # failed attachments again, they are checked against the current
+            # policy and the failed ones are retried
+            for attachment in (
+                downloader.skipped.attachments + downloader.failed.attachments
+            ):
+                downloader.submit(attachment)
 
-    print("Fetching statuses...")
-    while True:
-        print(
-            f"\033[KPage {page} (already fetched: {status_count})",
-            end="\r",
-            flush=True,
+    if min_id or since_id or args.crawl_workers <= 1:
+        pages = crawl(
+            mastodon, account["id"], max_id=max_id, min_id=min_id, since_id=since_id
+        )
+    else:
+        pages = crawl_parallel(
+            mastodon, account["id"], args.crawl_workers, max_id=max_id
         )
-        try:
-            statuses = mastodon.get_user_statuses(
-                account["id"], limit=40, max_id=max_id, min_id=min_id
-            )
-        except RateLimitExceededException as e:
-            e.wait()
-            statuses = mastodon.get_user_statuses(
-                account["id"], limit=40, max_id=max_id, min_id=min_id
-            )
 
-        if len(statuses) == 0:
-            break
+    # the ids of the refreshed statuses, the stored ones that are missing were deleted
+    refreshed_ids: set[str] = set()
+    changed_count = 0
 
-        if sqlite:
-            for status in statuses:
-                sqlite.add_status(status)
-        else:
-            all_statuses.extend(statuses)
-        status_count += len(statuses)
-
-        if sqlite and page == 1:
-            sqlite.set_newest_status(statuses[0]["id"])
-
-        if media_output:
-            for status in statuses:
-                for attachment in status["media_attachments"]:
-                    url = attachment["url"]
-                    remote_url = attachment["remote_url"]
-                    file_suffix = (
-                        (remote_url if remote_url else url)
-                        .split("/")[-1]
-                        .split(".")[-1]
-                    )
-                    filename = attachment["id"] + "." + file_suffix
-                    path = join(media_output, filename)
-                    if not zipfile and exists(path):
-                        continue
-
-                    print(
-                        f"\033[KDownloading attachment {path}...", end="\r", flush=True
-                    )
-                    url_first_try = remote_url if remote_url else url
-                    url_second_try = url if remote_url else None
-
-                    try:
-                        attachment = mastodon.download_attachment(url_first_try)
-                    except RateLimitExceededException as e:
-                        e.wait()
-                        attachment = mastodon.download_attachment(url_first_try)
-                    if not attachment and url_second_try:
-                        try:
-                            attachment = mastodon.download_attachment(url_second_try)
-                        except RateLimitExceededException as e:
-                            e.wait()
-                            attachment = mastodon.download_attachment(url_second_try)
-
-                    if not attachment:
-                        print(
-                            f"Warning: Skipping attachment {url} because it was not found"
-                        )
-                        continue
+    progress.message("Fetching statuses...")
+    crawl_start = perf_counter()
+    try:
+        for statuses in pages:
+            progress.page(page, status_count)
+            metrics.add("pages")
+            metrics.add("statuses", len(statuses))
+            if downloader:
+                for status in statuses:
+                    for attachment in status["media_attachments"]:
+                        downloader.submit(attachment)
+
+            if min_id:
+                # the statuses of a page are always ordered newest first
+                newest_status = min_id = statuses[0]["id"]
+            else:
+                if page == 1:
+                    newest_status = statuses[0]["id"]
+                max_id = statuses[-1]["id"]
+            page += 1
+            status_count += len(statuses)
+            state = {
+                "output": output,
+                "max_id": max_id,
+                "page": page,
+                "status_count": status_count,
+                "newest_status": newest_status,
+                "statuses_offset": 0,
+                "pending_media": downloader.pending if downloader else [],
+            }
 
-                    if zipfile:
-                        zipfile.writestr(path, attachment)
-                    else:
-                        with open(path, "wb") as file:
-                            file.write(attachment)
+            if sqlite:
+                # an incremental sync moves the bookmark with every page, a full
+                # crawl only moves it once all older statuses are stored
+                if min_id:
+                    sqlite.add_statuses(statuses, newest_status=newest_status)
+                elif args.refresh:
+                    refreshed_ids.update(status["id"] for status in statuses)
+                    changed_count += sqlite.refresh_statuses(statuses)
+                else:
+                    sqlite.add_statuses(statuses, crawl_state=state)
+            elif writer and statuses_file and checkpoint:
+                with metrics.timer("output_write_seconds"):
+                    writer.write(statuses)
+                    statuses_file.flush()
+                    state["statuses_offset"] = statuses_file.tell()
+                    if not update:
+                        checkpoint.save(state)
 
-        max_id = statuses[-1]["id"]
-        page += 1
+        if writer and old_member:
+            # attachments of the old statuses that aren't in the archive yet
+            # are downloaded again, the existing ones are skipped
+            with metrics.timer("output_write_seconds"):
+                for statuses in batched(old_statuses, PAGE_SIZE):
+                    writer.write(statuses)
+                    if downloader:
+                        for status in statuses:
+                            for attachment in status["media_attachments"]:
+                                downloader.submit(attachment)
+    except BaseException:
+        # keep everything that was downloaded so far so the crawl can be resumed
+        if downloader:
+            downloader.close(abort=True)
+            if skipped_media_path and failed_media_path:
+                downloader.skipped.save(skipped_media_path)
+                downloader.failed.save(failed_media_path)
+        if store:
+            store.close()
+        if zipfile:
+            if old_member:
+                # put the statuses back that were in the archive before
+                info, file = old_member
+                file.seek(0, 2)
+                size = file.tell()
+                file.seek(0)
+                write_member(zipfile, info.filename, file, size, info.compress_type)
+            zipfile.close()
+            if tail:
+                tail.remove()
+        raise
+    finally:
+        metrics.add("crawl_seconds", perf_counter() - crawl_start)
+
+    if downloader:
+        with metrics.timer("media_wait_seconds"):
+            downloader.close()
+        if len(downloader.skipped):
+            progress.message(
+                f"Skipped {len(downloader.skipped)} attachments because of the media options, they are listed in {SKIPPED_MEDIA_FILE}"
+            )
+        if len(downloader.failed):
+            retry = (
+                "Update the zip file with --update"
+                if zipfile
+                else "Run mastodon-download-toots-verify --repair"
+            )
+            progress.warning(
+                f"{len(downloader.failed)} attachments couldn't be downloaded, they are listed in {FAILED_MEDIA_FILE}. {retry} to download them again."
+            )
+        if not zipfile and skipped_media_path and failed_media_path:
+            downloader.skipped.save(skipped_media_path)
+            downloader.failed.save(failed_media_path)
+    if store:
+        store.close()
 
     if sqlite:
+        if newest_status and not min_id:
+            sqlite.set_newest_status(newest_status)
+        if args.refresh:
+            deleted_count = sqlite.mark_deleted(refreshed_ids, since_id)
+            metrics.add("changed_statuses", changed_count)
+            metrics.add("deleted_statuses", deleted_count)
+            progress.message(
+                f"Refreshed {len(refreshed_ids)} statuses: {changed_count} changed, {deleted_count} deleted"
+            )
         sqlite.close()
-        return
-
-    j: Any
-    if args.optimize_json:
-        ac = all_statuses[0]["account"] if len(all_statuses) > 0 else None
-        for status in all_statuses:
-            del status["account"]
-        j = {"account": ac, "statuses": all_statuses}
-    else:
-        j = all_statuses
+    if writer and statuses_file:
+        writer.close()
+        if zipfile:
+            finalize_start = perf_counter()
+            size = statuses_file.tell()
+            statuses_file.seek(0)
+            write_member(
+                zipfile,
+                "statuses.json",
+                statuses_file,
+                size,
+                ZIP_DEFLATED if args.compress else ZIP_STORED,
+            )
+            if downloader:
+                for name, ledger in (
+                    (SKIPPED_MEDIA_FILE, downloader.skipped),
+                    (FAILED_MEDIA_FILE, downloader.failed),
+                ):
+                    if len(ledger):
+                        ledger_json = ledger.to_json()
+                        write_member(
+                            zipfile,
+                            name,
+                            BytesIO(ledger_json),
+                            len(ledger_json),
+                            ZIP_DEFLATED,
+                        )
+            zipfile.close()
+            if tail:
+                tail.remove()
+            metrics.add("finalize_seconds", perf_counter() - finalize_start)
+        statuses_file.close()
+    if index_file:
+        index_file.close()
+    if old_member:
+        old_member[1].close()
+    if checkpoint:
+        checkpoint.remove()
 
-    s = dumps(j)
-    if zipfile:
-        zipfile.writestr("statuses.json", s)
-        zipfile.close()
-    else:
-        with open(output, "w") as file:
-            file.write(s)
+    result["statuses"] = status_count
+    if downloader:
+        result["media"] = downloader.downloaded
+        result["media_bytes"] = downloader.downloaded_bytes
+    return result
@@ -0,0 +1,307 @@
+"""An asyncio client for mastodon with async generators over the statuses of an account.
+
+The client uses httpx, install it with the `async` extra:
+`pip install mastodon-download-toots[async]`
+"""
+
+import asyncio
+from math import ceil
+from typing import IO, AsyncIterator, Callable, Optional
+
+from mastodon_download.crawl import PAGE_SIZE, next_page
+from mastodon_download.credentials import credential_store
+from mastodon_download.mastodon import (
+    ACCOUNTS_SEARCH_PATH,
+    ACCOUNTS_STATUSES_PATH,
+    CHUNK_SIZE,
+    DISCOVERY_TTL,
+    TIMEOUT,
+    USER_AGENT,
+    VERIFIY_CREDENTIALS_PATH,
+    Account,
+    AttachmentResponse,
+    Mastodon,
+    RateLimitExceededException,
+    RequestPolicy,
+    auth_headers,
+    content_length,
+)
+from mastodon_download.metrics import metrics, progress
+from mastodon_download.ratelimit import RateLimits
+from mastodon_download.serializer import loads
+from mastodon_download.session import PooledSession
+
+try:
+    import httpx
+except ImportError:  # the `async` extra is not installed
+    httpx = None  # type: ignore[assignment]
+
+
+async def wait_rate_limit(e: RateLimitExceededException) -> None:
+    """Wait until the rate limit shouldn't be exceeded anymore without blocking the event loop."""
+    if e.waiting_time <= 0:
+        return
+    waiting_time = ceil(e.waiting_time)
+    progress.waiting(waiting_time)
+    with metrics.timer("rate_limit_wait_seconds"):
+        await asyncio.sleep(waiting_time)
+
+
+class AsyncMastodon:
+    """The operations of `Mastodon` that a backup needs as coroutines.
+
+    The access token is read from the cache directory, so the account has to be
+    authorized with mastodon-download-toots (or `Mastodon.create_token`) first.
+    Requests are rate limited and retried like the requests of `Mastodon`,
+    clients of the same instance can share their `rate_limits` and `client`.
+    """
+
+    @classmethod
+    async def from_instance_domain(
+        cls,
+        domain: str,
+        cache_dir: str,
+        discovery_ttl: float = DISCOVERY_TTL,
+        **kwargs,
+    ) -> "AsyncMastodon":
+        # the discovery is cached in the cache directory, so the blocking
+        # client only runs in a thread once per instance and day
+        instance_url = await asyncio.to_thread(
+            Mastodon.discover, domain, PooledSession(), cache_dir, discovery_ttl
+        )
+        return cls(instance_url, cache_dir, **kwargs)
+
+    def __init__(
+        self,
+        instance_url: str,
+        cache_dir: str,
+        account_profile: Optional[str] = None,
+        req_rate_limit: Optional[float] = None,
+        client: Optional["httpx.AsyncClient"] = None,
+        rate_limits: Optional[RateLimits] = None,
+    ) -> None:
+        if httpx is None:
+            raise Exception(
+                "AsyncMastodon needs httpx, install mastodon-download-toots[async]"
+            )
+        self.__instance_url = instance_url
+        self.__token = credential_store(cache_dir).token(instance_url, account_profile)
+        self.__own_client = client is None
+        self.__client = client if client is not None else httpx.AsyncClient()
+        self.__policy = RequestPolicy(
+            instance_url,
+            account_profile,
+            (
+                rate_limits
+                if rate_limits is not None
+                else RateLimits(1 / req_rate_limit if req_rate_limit else None)
+            ),
+        )
+
+    async def __aenter__(self) -> "AsyncMastodon":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        await self.aclose()
+
+    async def aclose(self) -> None:
+        """Close the http client unless it was passed to the constructor."""
+        if self.__own_client:
+            await self.__client.aclose()
+
+    @property
+    def authorized(self) -> bool:
+        return self.__token is not None
+
+    async def get_user_statuses(
+        self,
+        account_id: str,
+        max_id: Optional[str] = None,
+        limit: Optional[int] = None,
+        min_id: Optional[str] = None,
+        since_id: Optional[str] = None,
+    ) -> list[dict]:
+        params: dict[str, str] = {}
+        if max_id:
+            params["max_id"] = max_id
+        if min_id:
+            params["min_id"] = min_id
+        if since_id:
+            params["since_id"] = since_id
+        if limit:
+            params["limit"] = str(limit)
+
+        response = await self.__request(
+            "GET",
+            self.__instance_url
+            + ACCOUNTS_STATUSES_PATH.replace("{ACCOUNT_ID}", account_id),
+            params=params,
+            auth=True,
+        )
+        return loads(response.content)
+
+    async def download_attachment(
+        self,
+        url: str,
+        file: IO[bytes],
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        check_size: Optional[Callable[[Optional[int]], None]] = None,
+    ) -> Optional[AttachmentResponse]:
+        """Stream the attachment at `url` into `file`, returns None if it was not found.
+
+        If `etag` or `last_modified` are passed the request is conditional and
+        nothing is written when the attachment wasn't modified. `check_size` is
+        called with the Content-Length before the body is read, it may raise an
+        exception to skip the download.
+        """
+        auth = url.startswith(self.__instance_url)
+        headers: dict[str, str] = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        response = await self.__request(
+            "GET", url, raise_for_status=False, auth=auth, stream=True, headers=headers
+        )
+        try:
+            if response.status_code == 404:
+                return None
+            if response.status_code != 304:
+                response.raise_for_status()
+                if check_size:
+                    check_size(content_length(response.headers))
+                async for chunk in response.aiter_bytes(CHUNK_SIZE):
+                    await asyncio.to_thread(file.write, chunk)
+            return {
+                "not_modified": response.status_code == 304,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
+        finally:
+            await response.aclose()
+
+    async def search_accounts(
+        self, q: str, limit: Optional[int] = None, resolve: Optional[bool] = None
+    ) -> list[Account]:
+        params: dict[str, str] = {"q": q}
+        if limit is not None:
+            params["limit"] = str(limit)
+        if resolve is not None:
+            params["resolve"] = "true" if resolve else "false"
+        response = await self.__request(
+            "GET", self.__instance_url + ACCOUNTS_SEARCH_PATH, params=params, auth=True
+        )
+        return loads(response.content)
+
+    async def get_me(self) -> Account:
+        response = await self.__request(
+            "GET", self.__instance_url + VERIFIY_CREDENTIALS_PATH, auth=True
+        )
+        return loads(response.content)
+
+    async def crawl(
+        self,
+        account_id: str,
+        max_id: Optional[str] = None,
+        min_id: Optional[str] = None,
+        since_id: Optional[str] = None,
+    ) -> AsyncIterator[list[dict]]:
+        """Yield the pages of statuses of an account like `crawl.crawl`, newest status first."""
+        while True:
+            statuses = await self.__get_page(account_id, max_id, min_id, since_id)
+            if len(statuses) == 0:
+                return
+            yield statuses
+            page = next_page(statuses, max_id, min_id)
+            if page is None:
+                return
+            max_id, min_id = page
+
+    async def iter_statuses(
+        self,
+        account_id: str,
+        max_id: Optional[str] = None,
+        min_id: Optional[str] = None,
+        since_id: Optional[str] = None,
+    ) -> AsyncIterator[dict]:
+        """Yield all statuses of an account one by one, see `crawl`."""
+        async for statuses in self.crawl(account_id, max_id, min_id, since_id):
+            for status in statuses:
+                yield status
+
+    async def __get_page(
+        self,
+        account_id: str,
+        max_id: Optional[str],
+        min_id: Optional[str],
+        since_id: Optional[str],
+    ) -> list[dict]:
+        try:
+            return await self.get_user_statuses(
+                account_id,
+                limit=PAGE_SIZE,
+                max_id=max_id,
+                min_id=min_id,
+                since_id=since_id,
+            )
+        except RateLimitExceededException as e:
+            await wait_rate_limit(e)
+            return await self.get_user_statuses(
+                account_id,
+                limit=PAGE_SIZE,
+                max_id=max_id,
+                min_id=min_id,
+                since_id=since_id,
+            )
+
+    async def __request(
+        self,
+        method: str,
+        url: str,
+        raise_for_status: bool = True,
+        auth: bool = False,
+        stream: bool = False,
+        headers: Optional[dict[str, str]] = None,
+        **kwargs,
+    ) -> "httpx.Response":
+        headers = {**(headers or {}), "User-Agent": USER_AGENT}
+        if auth:
+            headers |= auth_headers(self.__token)
+        request = self.__client.build_request(
+            method, url, headers=headers, timeout=TIMEOUT, **kwargs
+        )
+
+        bucket, interval = self.__policy.limits(url)
+        attempt = 0
+        while True:
+            for limit in (bucket, interval):
+                delay = limit.reserve()
+                if delay:
+                    await asyncio.sleep(delay)
+            metrics.add("requests")
+            with metrics.timer("request_seconds"):
+                response = await self.__client.send(
+                    request, stream=stream, follow_redirects=True
+                )
+            try:
+                retry_delay = self.__policy.retry_delay(
+                    method, bucket, response.status_code, response.headers, attempt
+                )
+            except RateLimitExceededException:
+                await response.aclose()
+                raise
+            if retry_delay is None:
+                break
+            await response.aclose()
+            metrics.add("retries")
+            with metrics.timer("backoff_seconds"):
+                await asyncio.sleep(retry_delay)
+            attempt += 1
+
+        if not stream:
+            metrics.add("response_bytes", len(response.content))
+        if raise_for_status:
+            response.raise_for_status()
+        return response
@@ -0,0 +1,126 @@
+from datetime import datetime
+from hashlib import blake2b
+from json import dump, load
+from os import fsync, remove, replace
+from os.path import abspath, exists, join
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+from typing import IO, Optional, TypedDict
+from zipfile import ZIP64_LIMIT, BadZipFile, ZipFile, ZipInfo
+
+
+def extract_member(zipfile: ZipFile, name: str) -> Optional[tuple[ZipInfo, IO[bytes]]]:
+    """Copy the member `name` to a temporary file, returns None if there is no such member."""
+    try:
+        info = zipfile.getinfo(name)
+    except KeyError:
+        return None
+    file = TemporaryFile()
+    with zipfile.open(info) as member:
+        copyfileobj(member, file)
+    file.seek(0)
+    return info, file
+
+
+def remove_member(zipfile: ZipFile, info: ZipInfo) -> None:
+    """Remove a member from an archive opened in append mode, the other members are kept as they are.
+
+    The data of the last member of the archive is dropped, the data of any other
+    member stays in the file but isn't referenced anymore.
+    """
+    zipfile.filelist.remove(info)
+    del zipfile.NameToInfo[info.filename]
+    if all(other.header_offset < info.header_offset for other in zipfile.filelist):
+        # new members and the central directory are written at start_dir,
+        # in append mode the file is truncated behind them when it's closed
+        zipfile.start_dir = info.header_offset
+
+
+def open_member(
+    zipfile: ZipFile, name: str, compress_type: int, force_zip64: bool = False
+) -> IO[bytes]:
+    """Open a new member `name` for writing, pass `force_zip64` if it may exceed 2 GiB."""
+    info = ZipInfo(name, datetime.now().timetuple()[:6])
+    info.external_attr = 0o600 << 16
+    info.compress_type = compress_type
+    return zipfile.open(info, "w", force_zip64=force_zip64)
+
+
+def write_member(
+    zipfile: ZipFile, name: str, file: IO[bytes], size: int, compress_type: int
+) -> None:
+    """Write `size` bytes of `file` from the current position as member `name`."""
+    with open_member(zipfile, name, compress_type, size >= ZIP64_LIMIT) as member:
+        copyfileobj(file, member)
+
+
+def is_intact(path: str) -> bool:
+    """Whether the central directory of the zip file at `path` matches the headers of its members."""
+    try:
+        with ZipFile(path) as zipfile:
+            for info in zipfile.infolist():
+                # checks the signature and the name of the local header
+                zipfile.open(info).close()
+    except (BadZipFile, EOFError):
+        return False
+    return True
+
+
+class TailState(TypedDict):
+    offset: int
+
+
+class TailBackup:
+    """A copy of the end of a zip file that is overwritten while members are added to it.
+
+    In append mode new members are written over the central directory (and a
+    removed last member), the new central directory is only written when the
+    archive is closed. Before anything is written the bytes from `offset` to the
+    end of the file are copied to the cache directory, so a process that was
+    killed in the meantime leaves an archive that `restore` can bring back to
+    the state it had before.
+    """
+
+    def __init__(self, cache_dir: str, path: str) -> None:
+        name = blake2b(abspath(path).encode("utf-8")).hexdigest()
+        self.__path = path
+        self.__tail_path = join(cache_dir, f"{name}_zip_tail")
+        self.__state_path = join(cache_dir, f"{name}_zip_tail.json")
+
+    def save(self, offset: int) -> None:
+        with open(self.__path, "rb") as file, open(self.__tail_path, "wb") as tail:
+            file.seek(offset)
+            copyfileobj(file, tail)
+            tail.flush()
+            fsync(tail.fileno())
+        # the state is written last, a tail without it is incomplete
+        tmp_path = self.__state_path + ".tmp"
+        with open(tmp_path, "w") as file:
+            dump(TailState(offset=offset), file)
+            file.flush()
+            fsync(file.fileno())
+        replace(tmp_path, self.__state_path)
+
+    def restore(self) -> bool:
+        """Put the saved end back if the archive wasn't closed, returns whether it was put back."""
+        if not exists(self.__state_path):
+            return False
+        if is_intact(self.__path):
+            # the process was killed after the archive was closed
+            self.remove()
+            return False
+        with open(self.__state_path) as file:
+            state: TailState = load(file)
+        with open(self.__path, "r+b") as file, open(self.__tail_path, "rb") as tail:
+            file.seek(state["offset"])
+            copyfileobj(tail, file)
+            file.truncate()
+            file.flush()
+            fsync(file.fileno())
+        self.remove()
+        return True
+
+    def remove(self) -> None:
+        for path in (self.__state_path, self.__tail_path):
+            if exists(path):
+                remove(path)
@@ -1,8 +1,36 @@
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 from os import environ
 
 from platformdirs import user_cache_dir
 
+from mastodon_download.mastodon import DISCOVERY_TTL
+from mastodon_download.mediapolicy import MEDIA_TYPES
+from mastodon_download.metrics import METRICS_FORMATS, PROGRESS_MODES
+
+BYTE_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+
+
+def media_types(value: str) -> list[str]:
+    types = value.split(",")
+    for media_type in types:
+        if media_type not in MEDIA_TYPES:
+            raise ArgumentTypeError(
+                f"Unknown media type {media_type}, the types are {', '.join(MEDIA_TYPES)}"
+            )
+    return types
+
+
+def byte_size(value: str) -> int:
+    """Parse a number of bytes like 500M or 2G."""
+    unit = value[-1:].upper()
+    try:
+        if unit in BYTE_UNITS:
+            return int(float(value[:-1]) * BYTE_UNITS[unit])
+        return int(value)
+    except ValueError:
+        raise ArgumentTypeError(f"Invalid size {value}, e.g. 500M or 2G")
+
+
 parser = ArgumentParser("mastodon-download-toots")
 parser.add_argument("domain", type=str, help="Domain, e.g. mastodon.social")
 parser.add_argument(
@@ -34,6 +62,36 @@ parser.add_argument(
     action="store_true",
     help="Instead of putting everything in a zip file sync the date to a sqlite file. This is recommended if you do your backups frequently because with this option they are incremental. The path of the sqlite database is configurable using the `-o` option.",
 )
+parser.add_argument(
+    "--normalize-sqlite",
+    action="store_true",
+    help="Additionally store the dates, visibility, reply and reblog ids and counts of the statuses in columns, their media in a table and their text in a full-text index of the sqlite database. Existing databases are migrated, afterwards they stay normalized.",
+)
+parser.add_argument(
+    "--refresh",
+    action="store_true",
+    help="Fetch the statuses that are already in the sqlite database again and store the ones that were edited or whose counts changed, statuses that were deleted are marked as deleted. Only the changed rows are written.",
+)
+parser.add_argument(
+    "--refresh-days",
+    type=float,
+    help="Only refresh the statuses of the last days instead of all statuses",
+)
+parser.add_argument(
+    "--overwrite",
+    action="store_true",
+    help="Overwrite an existing output file without asking",
+)
+parser.add_argument(
+    "--update",
+    action="store_true",
+    help="Update an existing zip file (passed with `-o`): Only the statuses newer than the newest status in the archive and the missing attachments are downloaded, the existing media files are kept as they are. If the file doesn't exist it's created.",
+)
+parser.add_argument(
+    "--resume",
+    action="store_true",
+    help="Continue an interrupted download at the page where it stopped instead of starting again with the newest status",
+)
 parser.add_argument(
     "-o",
     "--output",
@@ -47,6 +105,17 @@ parser.add_argument(
     action="store_true",
     help="Instead of having one json file and a media directory download everything into a zip file.",
 )
+parser.add_argument(
+    "--compress",
+    action="store_true",
+    help="Compress the statuses. The JSON output is written as gzip compressed newline-delimited JSON with an index next to it that allows reading single statuses, in a zip file the statuses.json file is compressed.",
+)
+parser.add_argument(
+    "--crawl-workers",
+    type=int,
+    default=1,
+    help="Number of pages of statuses that are fetched at the same time. The time since the account was created is split into windows that are fetched concurrently, this speeds up the first download of accounts with many statuses. Incremental sqlite syncs always fetch one page at a time.",
+)
 parser.add_argument(
     "-m",
     "--media",
@@ -58,6 +127,48 @@ parser.add_argument(
     type=str,
     help="The directory where media should be put in when media downloading is enabled. The default is <USERNAME>_<INSTANCE_DOMAIN>_media.",
 )
+parser.add_argument(
+    "--media-store",
+    type=str,
+    help="Keep every downloaded attachment once in this directory, keyed by the hash of its content. Later downloads and zip exports reuse the stored files and only ask the server whether they changed.",
+)
+parser.add_argument(
+    "--media-types",
+    type=media_types,
+    help=f"Only download attachments of these comma separated types ({', '.join(MEDIA_TYPES)}), e.g. image,gifv. Skipped attachments are listed in skipped_media.json in the media directory (or the zip file), a later run with other media options downloads the missing ones.",
+)
+parser.add_argument(
+    "--media-preview-types",
+    type=media_types,
+    help="Download only the preview image of attachments of these comma separated types instead of the original, e.g. video,gifv",
+)
+parser.add_argument(
+    "--media-max-dimension",
+    type=int,
+    help="Skip attachments whose width or height is larger than this many pixels",
+)
+parser.add_argument(
+    "--media-max-duration",
+    type=float,
+    help="Skip videos and audio longer than this many seconds",
+)
+parser.add_argument(
+    "--media-budget",
+    type=byte_size,
+    help="Download at most this many bytes of media in one run, e.g. 500M or 2G. The size of an attachment is checked before it's downloaded, attachments that don't fit are skipped.",
+)
+parser.add_argument(
+    "--media-workers",
+    type=int,
+    default=4,
+    help="Number of attachments that are downloaded concurrently",
+)
+parser.add_argument(
+    "--media-host-concurrency",
+    type=int,
+    default=2,
+    help="Maximum number of concurrent attachment downloads from the same host",
+)
 
 parser.add_argument(
     "-c",
@@ -69,5 +180,35 @@ parser.add_argument(
 )
 
 parser.add_argument(
-    "--rate-limit", type=float, help="Limit the requests per second per instance"
+    "--rate-limit",
+    type=float,
+    help="Limit the requests per second per host, the API requests and media downloads of the instance count together",
+)
+parser.add_argument(
+    "--discovery-ttl",
+    type=float,
+    default=DISCOVERY_TTL,
+    help="Seconds the url of the instance found for the domain is cached, 0 disables the cache. The default is one day.",
+)
+parser.add_argument(
+    "--refresh-discovery",
+    action="store_true",
+    help="Ignore the cached url of the instance and look it up again",
+)
+parser.add_argument(
+    "--progress",
+    choices=PROGRESS_MODES,
+    default="tty",
+    help="How the progress is reported: `tty` updates a line in the terminal, `json` prints one JSON object per event and line (e.g. for logs of cron jobs or systemd services), `none` only prints warnings.",
+)
+parser.add_argument(
+    "--metrics-file",
+    type=str,
+    help="Write the counters and timers of the run (requests, retries, bytes, rate limit waiting time, database write time, ...) to this file at the end of the run",
+)
+parser.add_argument(
+    "--metrics-format",
+    choices=METRICS_FORMATS,
+    default="json",
+    help="Format of the metrics file: `json` overwrites the file, `ndjson` appends a line per run and `prometheus` writes a textfile for the textfile collector of the node exporter",
 )
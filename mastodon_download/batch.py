@@ -0,0 +1,177 @@
+import tomllib
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from time import perf_counter
+from typing import Any, Optional, TypedDict
+
+from mastodon_download import BackupResult, backup, backup_options
+from mastodon_download.args import parser as backup_parser
+from mastodon_download.mastodon import DISCOVERY_TTL, Mastodon
+from mastodon_download.metrics import progress
+from mastodon_download.ratelimit import RateLimits
+from mastodon_download.session import PooledSession
+
+# options that are configured per instance or for the whole batch
+GLOBAL_OPTIONS = {
+    "cache_dir",
+    "rate_limit",
+    "purge_cache",
+    "force_login",
+    "discovery_ttl",
+    "refresh_discovery",
+}
+
+parser = ArgumentParser("mastodon-download-toots-batch")
+parser.add_argument(
+    "config",
+    type=str,
+    help="TOML file that lists the accounts to backup, see the README for the format",
+)
+parser.add_argument(
+    "-w",
+    "--workers",
+    type=int,
+    help="Number of backups running at the same time, overrides `workers` of the config file",
+)
+
+
+class AccountSummary(TypedDict):
+    name: str
+    result: Optional[BackupResult]
+    seconds: float
+    error: Optional[str]
+
+
+class Instance:
+    """The session, rate limits and clients shared by all accounts of one instance.
+
+    The requests of all clients to a host are spaced by the `rate_limit` together,
+    only the X-RateLimit budget is counted per access token.
+    """
+
+    def __init__(
+        self,
+        domain: str,
+        cache_dir: str,
+        rate_limit: Optional[float],
+        workers: int,
+        discovery_ttl: float = DISCOVERY_TTL,
+    ) -> None:
+        self.__domain = domain
+        self.__cache_dir = cache_dir
+        self.__discovery_ttl = discovery_ttl
+        self.__session = PooledSession(pool_maxsize=workers * 3)
+        self.__rate_limits = RateLimits(1 / rate_limit if rate_limit else None)
+        self.__lock = Lock()
+        self.__instance_url: Optional[str] = None
+        self.__clients: dict[Optional[str], Mastodon] = {}
+
+    def client(self, account_profile: Optional[str]) -> Mastodon:
+        with self.__lock:
+            if self.__instance_url is None:
+                self.__instance_url = Mastodon.discover(
+                    self.__domain,
+                    self.__session,
+                    self.__cache_dir,
+                    self.__discovery_ttl,
+                )
+            if account_profile not in self.__clients:
+                self.__clients[account_profile] = Mastodon(
+                    self.__instance_url,
+                    self.__cache_dir,
+                    account_profile=account_profile,
+                    session=self.__session,
+                    rate_limits=self.__rate_limits,
+                )
+            return self.__clients[account_profile]
+
+
+def account_args(account: dict[str, Any], cache_dir: str) -> Namespace:
+    """Build the command line arguments of `backup` for an account of the config file."""
+    if "domain" not in account:
+        raise Exception(f"Account {account} has no domain")
+    options = {
+        key: value for key, value in account.items() if key not in ("name", "domain")
+    }
+    for key in options:
+        if key in GLOBAL_OPTIONS:
+            raise Exception(f"Unknown option for account: {key}")
+    return backup_options(account["domain"], cache_dir=cache_dir, **options)
+
+
+def run_account(instance: Instance, name: str, args: Namespace) -> AccountSummary:
+    start = perf_counter()
+    try:
+        mastodon = instance.client(args.account_profile)
+        if not mastodon.authorized:
+            raise Exception(
+                "Not authorized, run mastodon-download-toots once with the same domain and account profile to login"
+            )
+        result = backup(mastodon, args, interactive=False)
+    except Exception as e:
+        return {
+            "name": name,
+            "result": None,
+            "seconds": perf_counter() - start,
+            "error": str(e),
+        }
+    return {
+        "name": name,
+        "result": result,
+        "seconds": perf_counter() - start,
+        "error": None,
+    }
+
+
+def print_summary(summaries: list[AccountSummary]) -> None:
+    progress.message(
+        f"{'Account':<40} {'Statuses':>9} {'Media':>7} {'MiB':>9} {'Seconds':>8} {'Statuses/s':>10}  Error"
+    )
+    for summary in summaries:
+        result = summary["result"]
+        statuses = result["statuses"] if result else 0
+        media = result["media"] if result else 0
+        media_bytes = result["media_bytes"] if result else 0
+        seconds = summary["seconds"]
+        print(
+            f"{summary['name']:<40} {statuses:>9} {media:>7} {media_bytes / 2**20:>9.1f} {seconds:>8.1f} {statuses / seconds if seconds else 0:>10.1f}  {summary['error'] or ''}"
+        )
+
+
+def main() -> None:
+    args = parser.parse_args()
+    with open(args.config, "rb") as file:
+        config = tomllib.load(file)
+
+    workers = args.workers or config.get("workers", 2)
+    cache_dir = config.get("cache_dir", backup_parser.get_default("cache_dir"))
+    discovery_ttl = config.get("discovery_ttl", DISCOVERY_TTL)
+    instance_configs: dict[str, dict] = config.get("instances", {})
+
+    instances: dict[str, Instance] = {}
+    jobs: list[tuple[Instance, str, Namespace]] = []
+    for account in config.get("accounts", []):
+        account_arguments = account_args(account, cache_dir)
+        # as written in the config, the instances table uses the same keys
+        domain = account_arguments.instance
+        if domain not in instances:
+            instances[domain] = Instance(
+                domain,
+                cache_dir,
+                instance_configs.get(domain, {}).get("rate_limit"),
+                workers,
+                discovery_ttl,
+            )
+        name = account.get(
+            "name",
+            f"{account_arguments.user or account_arguments.account_profile or 'me'} ({domain})",
+        )
+        jobs.append((instances[domain], name, account_arguments))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        summaries = list(executor.map(lambda job: run_account(*job), jobs))
+
+    print_summary(summaries)
+    if any(summary["error"] for summary in summaries):
+        raise SystemExit(1)
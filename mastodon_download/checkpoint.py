@@ -0,0 +1,53 @@
+from hashlib import blake2b
+from json import dump, load
+from os import remove, replace
+from os.path import exists, join
+from typing import Optional, TypedDict
+
+
+class CrawlState(TypedDict):
+    output: str
+    max_id: Optional[str]
+    page: int
+    status_count: int
+    newest_status: Optional[str]
+    statuses_offset: int
+    pending_media: list[dict]
+
+
+class Checkpoint:
+    """Persist the state of a crawl in the cache directory so it can be resumed.
+
+    Besides the state a zip crawl keeps its statuses in a spool file next to
+    the checkpoint until the crawl is complete, and the attachments skipped by
+    the media policy or failed to download until they are written to the archive.
+    """
+
+    def __init__(self, cache_dir: str, key: str) -> None:
+        name = blake2b(key.encode("utf-8")).hexdigest()
+        self.__path = join(cache_dir, f"{name}_crawl.json")
+        self.spool_path = join(cache_dir, f"{name}_statuses.part")
+        self.skipped_media_path = join(cache_dir, f"{name}_skipped_media.json")
+        self.failed_media_path = join(cache_dir, f"{name}_failed_media.json")
+
+    def load(self) -> Optional[CrawlState]:
+        if not exists(self.__path):
+            return None
+        with open(self.__path) as file:
+            return load(file)
+
+    def save(self, state: CrawlState) -> None:
+        tmp_path = self.__path + ".tmp"
+        with open(tmp_path, "w") as file:
+            dump(state, file)
+        replace(tmp_path, self.__path)
+
+    def remove(self) -> None:
+        for path in (
+            self.__path,
+            self.spool_path,
+            self.skipped_media_path,
+            self.failed_media_path,
+        ):
+            if exists(path):
+                remove(path)
@@ -0,0 +1,106 @@
+import gzip
+from typing import BinaryIO, Iterator, Optional, TypedDict
+
+from mastodon_download.serializer import dumps, loads
+
+
+class PageIndexEntry(TypedDict):
+    offset: int
+    length: int
+    max_id: str
+    min_id: str
+
+
+def id_key(status_id: str) -> tuple[int, str]:
+    # status ids are numeric strings, longer ids are newer
+    return (len(status_id), status_id)
+
+
+class CompressedStatusWriter:
+    """Write statuses as gzip compressed newline-delimited JSON.
+
+    Every page is written as its own gzip member, so the file is still a valid
+    gzip file. For every member a line with its offset, length and id range is
+    appended to the index file, that allows reading a single status by id
+    without decompressing the whole file.
+    """
+
+    def __init__(self, file: BinaryIO, index_file: BinaryIO, count: int = 0) -> None:
+        """Pass the number of statuses already in `file` as `count` to continue writing it.
+
+        Index entries of pages behind the current position of `file` are dropped.
+        """
+        self.__file = file
+        self.__index_file = index_file
+        self.count = count
+        if count:
+            offset = file.tell()
+            entries = [
+                line
+                for line in index_file.read().splitlines(keepends=True)
+                if loads(line)["offset"] < offset
+            ]
+            index_file.seek(0)
+            index_file.truncate()
+            index_file.writelines(entries)
+
+    def write(self, statuses: list[dict]) -> None:
+        if not statuses:
+            return
+        ids = sorted((status["id"] for status in statuses), key=id_key)
+        data = gzip.compress(
+            b"".join(dumps(status) + b"\n" for status in statuses),
+            mtime=0,
+        )
+        entry: PageIndexEntry = {
+            "offset": self.__file.tell(),
+            "length": len(data),
+            "max_id": ids[-1],
+            "min_id": ids[0],
+        }
+        self.__file.write(data)
+        self.__index_file.write(dumps(entry) + b"\n")
+        self.__index_file.flush()
+        self.count += len(statuses)
+
+    def close(self) -> None:
+        """Nothing to finish, the underlying files are not closed."""
+
+
+def index_path(path: str) -> str:
+    return path + ".idx"
+
+
+def load_index(path: str) -> list[PageIndexEntry]:
+    with open(index_path(path), "rb") as file:
+        return [loads(line) for line in file]
+
+
+def find_status(
+    path: str, status_id: str, index: Optional[list[PageIndexEntry]] = None
+) -> Optional[dict]:
+    """Return the status with `status_id` from the compressed file at `path`.
+
+    Only the page containing the status is decompressed. Pass the result of
+    `load_index` as `index` for repeated lookups.
+    """
+    if index is None:
+        index = load_index(path)
+    key = id_key(status_id)
+    with open(path, "rb") as file:
+        for entry in index:
+            if not id_key(entry["min_id"]) <= key <= id_key(entry["max_id"]):
+                continue
+            file.seek(entry["offset"])
+            for line in gzip.decompress(file.read(entry["length"])).splitlines():
+                status = loads(line)
+                if status["id"] == status_id:
+                    return status
+    return None
+
+
+def iter_statuses(path: str) -> Iterator[dict]:
+    """Iterate over all statuses of the compressed file at `path`."""
+    with gzip.open(path, "rb") as file:
+        for line in file:
+            yield loads(line)
@@ -0,0 +1,210 @@
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryFile
+from threading import Condition, Event
+from typing import Iterator, Optional
+
+from mastodon_download.mastodon import Mastodon, RateLimitExceededException
+from mastodon_download.serializer import dumps, loads
+
+PAGE_SIZE = 40
+# more windows than workers so a worker that finished a window with few
+# statuses can continue with the next one
+WINDOWS_PER_WORKER = 4
+
+
+def snowflake_id(timestamp: float) -> str:
+    """The smallest id of the statuses created at `timestamp`.
+
+    Mastodon ids are the milliseconds since the epoch shifted by 16 bits.
+    """
+    return str(int(timestamp * 1000) << 16)
+
+
+def get_page(
+    mastodon: Mastodon,
+    account_id: str,
+    max_id: Optional[str] = None,
+    min_id: Optional[str] = None,
+    since_id: Optional[str] = None,
+) -> list[dict]:
+    try:
+        return mastodon.get_user_statuses(
+            account_id,
+            limit=PAGE_SIZE,
+            max_id=max_id,
+            min_id=min_id,
+            since_id=since_id,
+        )
+    except RateLimitExceededException as e:
+        e.wait()
+        return mastodon.get_user_statuses(
+            account_id,
+            limit=PAGE_SIZE,
+            max_id=max_id,
+            min_id=min_id,
+            since_id=since_id,
+        )
+
+
+def next_page(
+    statuses: list[dict], max_id: Optional[str], min_id: Optional[str]
+) -> Optional[tuple[Optional[str], Optional[str]]]:
+    """The `max_id` and `min_id` of the page after `statuses`, None if it was the last page."""
+    if len(statuses) == 0:
+        return None
+    if min_id:
+        # a page with less statuses than requested is the newest page, after a
+        # full page one more request is needed, as the prev link of Mastodon's
+        # Link header is sent for the newest page as well
+        if len(statuses) < PAGE_SIZE:
+            return None
+        # the statuses of a page are always ordered newest first
+        return max_id, statuses[0]["id"]
+    return statuses[-1]["id"], None
+
+
+def crawl(
+    mastodon: Mastodon,
+    account_id: str,
+    max_id: Optional[str] = None,
+    min_id: Optional[str] = None,
+    since_id: Optional[str] = None,
+) -> Iterator[list[dict]]:
+    """Yield the pages of statuses of an account, newest status first.
+
+    With `min_id` the pages are crawled forwards starting at the status after
+    `min_id`, otherwise backwards starting before `max_id` until `since_id`.
+    """
+    while True:
+        statuses = get_page(mastodon, account_id, max_id, min_id, since_id)
+        if len(statuses) == 0:
+            return
+        yield statuses
+        page = next_page(statuses, max_id, min_id)
+        if page is None:
+            return
+        max_id, min_id = page
+
+
+class _Window:
+    """The pages of an id window, spooled to a temporary file until they are merged."""
+
+    def __init__(self, max_id: str, since_id: Optional[str]) -> None:
+        self.max_id = max_id
+        self.since_id = since_id
+        self.__file = TemporaryFile()
+        self.__offsets: list[int] = []
+        self.__condition = Condition()
+        self.__done = False
+        self.__error: Optional[BaseException] = None
+
+    def add(self, statuses: list[dict]) -> None:
+        with self.__condition:
+            self.__file.seek(0, 2)
+            self.__offsets.append(self.__file.tell())
+            self.__file.write(dumps(statuses) + b"\n")
+            self.__condition.notify_all()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        with self.__condition:
+            self.__done = True
+            self.__error = error
+            self.__condition.notify_all()
+
+    def pages(self) -> Iterator[list[dict]]:
+        """Yield the pages of the window as soon as they are crawled."""
+        i = 0
+        while True:
+            with self.__condition:
+                self.__condition.wait_for(
+                    lambda: i < len(self.__offsets) or self.__done
+                )
+                if i == len(self.__offsets):
+                    self.__file.close()
+                    if self.__error:
+                        raise self.__error
+                    return
+                self.__file.seek(self.__offsets[i])
+                line = self.__file.readline()
+            i += 1
+            yield loads(line)
+
+
+def crawl_parallel(
+    mastodon: Mastodon,
+    account_id: str,
+    workers: int,
+    max_id: Optional[str] = None,
+) -> Iterator[list[dict]]:
+    """Yield the same statuses as a backward `crawl` while crawling id windows concurrently.
+
+    The ids between the oldest status and `max_id` (or the newest status)
+    are split into windows that are crawled by `workers` threads. The pages are
+    yielded in order, newest first, the pages of later windows are spooled to
+    temporary files in the meantime.
+    """
+    if max_id is None:
+        statuses = get_page(mastodon, account_id)
+        if len(statuses) == 0:
+            return
+        yield statuses
+        max_id = statuses[-1]["id"]
+
+    # paging forwards from the smallest id returns the oldest statuses
+    oldest = get_page(mastodon, account_id, min_id="0")
+    if not max_id.isdigit() or not oldest or not oldest[-1]["id"].isdigit():
+        yield from crawl(mastodon, account_id, max_id=max_id)
+        return
+    top = int(max_id)
+    bottom = int(oldest[-1]["id"]) - 1
+    count = workers * WINDOWS_PER_WORKER
+    if bottom >= top - count:
+        yield from crawl(mastodon, account_id, max_id=max_id)
+        return
+    bounds = [top - (top - bottom) * i // count for i in range(count)]
+    windows = [
+        _Window(str(upper), str(bounds[i + 1] - 1) if i + 1 < count else None)
+        for i, upper in enumerate(bounds)
+    ]
+
+    stop = Event()
+    errors: list[BaseException] = []
+
+    def crawl_window(window: _Window) -> None:
+        try:
+            if stop.is_set():
+                raise errors[0] if errors else Exception("Crawl was aborted")
+            for statuses in crawl(
+                mastodon, account_id, max_id=window.max_id, since_id=window.since_id
+            ):
+                if stop.is_set():
+                    raise errors[0] if errors else Exception("Crawl was aborted")
+                window.add(statuses)
+        except BaseException as e:
+            if not errors:
+                errors.append(e)
+            stop.set()
+            window.finish(errors[0])
+        else:
+            window.finish()
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        for window in windows:
+            executor.submit(crawl_window, window)
+        # the windows don't overlap, deduplicating only guards against
+        # statuses that are returned twice
+        last_id: Optional[int] = None
+        for window in windows:
+            for statuses in window.pages():
+                statuses = [
+                    status
+                    for status in statuses
+                    if last_id is None or int(status["id"]) < last_id
+                ]
+                if statuses:
+                    last_id = int(statuses[-1]["id"])
+                    yield statuses
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
@@ -0,0 +1,144 @@
+from contextlib import contextmanager
+from hashlib import blake2b
+from json import dump, load
+from os import replace
+from os.path import abspath, exists, join
+from threading import Lock
+from typing import Callable, Iterator, Optional, TypedDict
+
+try:
+    import fcntl
+except ImportError:  # not available on windows
+    fcntl = None  # type: ignore[assignment]
+
+from mastodon_download.metrics import metrics
+
+LOCK_FILE = "credentials.lock"
+
+
+class ClientCredentials(TypedDict):
+    client_id: str
+    client_secret: str
+
+
+class Token(TypedDict):
+    access_token: str
+    token_type: str
+
+
+class CredentialStore:
+    """The client credentials and access tokens in a cache directory, keyed by instance and account profile.
+
+    Every file is read once, later lookups are answered from memory. Files are
+    written while holding an exclusive lock on the lock file of the cache
+    directory, so processes sharing it don't register the same app twice or
+    read a half written file.
+    """
+
+    def __init__(self, cache_dir: str) -> None:
+        self.__cache_dir = cache_dir
+        self.__lock = Lock()
+        self.__write_lock = Lock()
+        self.__files: dict[str, Optional[ClientCredentials | Token]] = {}
+
+    def client_credentials(
+        self,
+        instance_url: str,
+        account_profile: Optional[str],
+        register: Callable[[], ClientCredentials],
+    ) -> ClientCredentials:
+        """Return the client credentials, `register` creates them if there are none yet."""
+        path = self.__path(instance_url, account_profile, "client")
+        credentials = self.__read(path)
+        if credentials is None:
+            with self.__file_lock():
+                # another process may have registered the app in the meantime
+                credentials = self.__read(path, reload=True)
+                if credentials is None:
+                    registered = register()
+                    self.__write(path, registered)
+                    return registered
+        return credentials  # type: ignore[return-value]
+
+    def token(
+        self, instance_url: str, account_profile: Optional[str]
+    ) -> Optional[Token]:
+        path = self.__path(instance_url, account_profile, "user")
+        token = self.__read(path)
+        if token is None and account_profile:
+            # the tokens of account profiles used to be stored in the file of
+            # the instance, they are moved to their own file on first use
+            legacy_token = self.__read(self.__path(instance_url, None, "user"))
+            if legacy_token is not None:
+                with self.__file_lock():
+                    token = self.__read(path, reload=True)
+                    if token is None:
+                        self.__write(path, legacy_token)
+                        token = legacy_token
+        return token  # type: ignore[return-value]
+
+    def set_token(
+        self, instance_url: str, account_profile: Optional[str], token: Token
+    ) -> None:
+        with self.__file_lock():
+            self.__write(self.__path(instance_url, account_profile, "user"), token)
+
+    def clear(self) -> None:
+        """Forget the loaded files, e.g. after they were deleted."""
+        with self.__lock:
+            self.__files.clear()
+
+    def __path(
+        self, instance_url: str, account_profile: Optional[str], kind: str
+    ) -> str:
+        instance_hash = blake2b(instance_url.encode("utf-8")).hexdigest()
+        profile = f"{account_profile}_" if account_profile else ""
+        return join(self.__cache_dir, f"{instance_hash}_{profile}{kind}.json")
+
+    def __read(
+        self, path: str, reload: bool = False
+    ) -> Optional[ClientCredentials | Token]:
+        with self.__lock:
+            if path in self.__files and not reload:
+                return self.__files[path]
+            content = None
+            if exists(path):
+                metrics.add("credential_file_reads")
+                with open(path) as file:
+                    content = load(file)
+            self.__files[path] = content
+            return content
+
+    def __write(self, path: str, content: ClientCredentials | Token) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            dump(content, file)
+        replace(tmp_path, path)
+        with self.__lock:
+            self.__files[path] = content
+
+    @contextmanager
+    def __file_lock(self) -> Iterator[None]:
+        with self.__write_lock:
+            if fcntl is None:
+                yield
+                return
+            with open(join(self.__cache_dir, LOCK_FILE), "w") as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(file, fcntl.LOCK_UN)
+
+
+_stores: dict[str, CredentialStore] = {}
+_stores_lock = Lock()
+
+
+def credential_store(cache_dir: str) -> CredentialStore:
+    """The store of `cache_dir`, shared by all clients of this process."""
+    key = abspath(cache_dir)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = CredentialStore(cache_dir)
+        return _stores[key]
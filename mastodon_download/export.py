@@ -0,0 +1,181 @@
+from argparse import ArgumentParser
+from datetime import datetime
+from os import remove, replace
+from os.path import basename, exists, join, splitext
+from typing import Optional, TypedDict
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
+
+from mastodon_download.archive import open_member
+from mastodon_download.compressed import CompressedStatusWriter, index_path
+from mastodon_download.media import find_attachment
+from mastodon_download.metrics import progress
+from mastodon_download.sqlite import SqliteDatabase
+from mastodon_download.writer import StatusWriter
+
+parser = ArgumentParser("mastodon-download-toots-export")
+parser.add_argument(
+    "database",
+    type=str,
+    help="SQLite database written by mastodon-download-toots --sync-sqlite",
+)
+parser.add_argument(
+    "-o",
+    "--output",
+    type=str,
+    help="Output file. By default it's the name of the database with the date, e.g. <USERNAME>_<INSTANCE_DOMAIN>_<DATE>.json or .zip",
+)
+parser.add_argument(
+    "-z",
+    "--zip",
+    action="store_true",
+    help="Write a zip file like mastodon-download-toots -z instead of a json file",
+)
+parser.add_argument(
+    "--media-output",
+    type=str,
+    help="The media directory of the database (the --media-output of the sync), its attachments are added to the zip file",
+)
+parser.add_argument(
+    "--optimize-json",
+    action="store_true",
+    help="Store the account once in the json and remove it from every status for smaller json",
+)
+parser.add_argument(
+    "--compress",
+    action="store_true",
+    help="Write gzip compressed newline-delimited JSON with an index, in a zip file the statuses.json file is compressed",
+)
+parser.add_argument(
+    "--overwrite",
+    action="store_true",
+    help="Overwrite an existing output file without asking",
+)
+
+
+class ExportResult(TypedDict):
+    statuses: int
+    media: int
+    missing_media: int
+
+
+def export(
+    database: SqliteDatabase,
+    output: str,
+    zip: bool = False,
+    media_output: Optional[str] = None,
+    optimize_json: bool = False,
+    compress: bool = False,
+) -> ExportResult:
+    """Write the statuses of `database` to `output` in the layout of a JSON or zip download, without any request.
+
+    The output is written to a temporary file next to it and only replaces
+    `output` once it's complete.
+    """
+    if compress and optimize_json and not zip:
+        raise Exception("--optimize-json can't be used for compressed JSON output")
+    result: ExportResult = {"statuses": 0, "media": 0, "missing_media": 0}
+    part_path = output + ".part"
+    index_part_path = index_path(output) + ".part"
+    try:
+        with open(part_path, "wb") as file:
+            if zip:
+                with ZipFile(file, "w") as zipfile:
+                    if media_output:
+                        _export_media(database, zipfile, media_output, result)
+                    # the size of the statuses isn't known before they are written
+                    with open_member(
+                        zipfile,
+                        "statuses.json",
+                        ZIP_DEFLATED if compress else ZIP_STORED,
+                        force_zip64=True,
+                    ) as member:
+                        result["statuses"] = _export_statuses(
+                            database, StatusWriter(member, optimize_json=optimize_json)
+                        )
+            elif compress:
+                with open(index_part_path, "wb") as index_file:
+                    result["statuses"] = _export_statuses(
+                        database, CompressedStatusWriter(file, index_file)
+                    )
+            else:
+                result["statuses"] = _export_statuses(
+                    database, StatusWriter(file, optimize_json=optimize_json)
+                )
+    except BaseException:
+        remove(part_path)
+        if exists(index_part_path):
+            remove(index_part_path)
+        raise
+    replace(part_path, output)
+    if exists(index_part_path):
+        replace(index_part_path, index_path(output))
+    return result
+
+
+def _export_statuses(
+    database: SqliteDatabase, writer: StatusWriter | CompressedStatusWriter
+) -> int:
+    for statuses in database.iter_statuses():
+        writer.write(statuses)
+    writer.close()
+    return writer.count
+
+
+def _export_media(
+    database: SqliteDatabase,
+    zipfile: ZipFile,
+    media_output: str,
+    result: ExportResult,
+) -> None:
+    seen: set[str] = set()
+    for statuses in database.iter_statuses():
+        for status in statuses:
+            for attachment in status["media_attachments"]:
+                if attachment["id"] in seen:
+                    continue
+                seen.add(attachment["id"])
+                found = find_attachment(attachment, media_output)
+                if found is None:
+                    result["missing_media"] += 1
+                    continue
+                path, _ = found
+                zipfile.write(path, join("media", basename(path)))
+                result["media"] += 1
+
+
+def main() -> None:
+    args = parser.parse_args()
+    if args.media_output and not args.zip:
+        parser.error("--media-output can only be used with --zip")
+    if not exists(args.database):
+        raise Exception(f"Database {args.database} doesn't exist")
+
+    output = args.output
+    if not output:
+        compressed_json = args.compress and not args.zip
+        extension = "zip" if args.zip else "ndjson.gz" if compressed_json else "json"
+        date = datetime.now().strftime("%Y-%m-%d")
+        output = f"{splitext(basename(args.database))[0]}_{date}.{extension}"
+    if exists(output) and not args.overwrite:
+        if input("Output file already exists, overwriting? [y/n] ").lower() != "y":
+            return
+
+    database = SqliteDatabase(args.database, read_only=True)
+    try:
+        result = export(
+            database,
+            output,
+            zip=args.zip,
+            media_output=args.media_output,
+            optimize_json=args.optimize_json,
+            compress=args.compress,
+        )
+    finally:
+        database.close()
+    if result["missing_media"]:
+        progress.warning(
+            f"{result['missing_media']} attachments are missing in {args.media_output}"
+        )
+    print(
+        f"Exported {result['statuses']} statuses and {result['media']} attachments to {output}"
+    )
@@ -1,15 +1,31 @@
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from hashlib import blake2b
 from json import dump, load
 from math import ceil
 from os import listdir, mkdir, remove
 from os.path import exists, join
 from time import sleep, time
-from typing import Any, Optional, TypedDict
-from urllib.parse import urlencode
+from typing import IO, Any, Callable, Mapping, Optional, TypedDict
+from urllib.parse import urlencode, urlparse
 
 import requests
 
+from mastodon_download.credentials import (
+    ClientCredentials,
+    Token,
+    credential_store,
+)
+from mastodon_download.metrics import metrics, progress
+from mastodon_download.ratelimit import (
+    MAX_BACKOFF,
+    RateLimits,
+    TokenBucket,
+    backoff,
+    parse_reset,
+)
+from mastodon_download.serializer import loads
+from mastodon_download.session import ConnectionStats, PooledSession
+
 CLIENT_NAME = "Mastodon Toots Downloader"
 
 WEBFINGER_PATH = "/.well-known/webfinger"
@@ -26,36 +42,44 @@ SCOPES = "read:statuses read:accounts profile"
 WEBSITE = "https://github.com/adridevelopsthings/mastodon-download-toots"
 USER_AGENT = f"mastodon-download-toots <{WEBSITE}>"
 TIMEOUT = 10
+MAX_RETRIES = 5
+DISCOVERY_TTL = 24 * 60 * 60
+API_PATHS = ("/api/", "/oauth/")
+CHUNK_SIZE = 64 * 1024
+
+
+def content_length(headers: Mapping[str, str]) -> Optional[int]:
+    try:
+        return int(headers["Content-Length"])
+    except (KeyError, ValueError):
+        return None
 
 
 class RateLimitExceededException(Exception):
     def __init__(self, reset: datetime) -> None:
         self.reset = reset
 
+    @property
+    def waiting_time(self) -> float:
+        """Seconds until the rate limit shouldn't be exceeded anymore."""
+        return (self.reset - datetime.now(timezone.utc)).total_seconds() + 0.1
+
     def wait(self) -> None:
         """Wait until rate limit shouldn't be exceeded anymore."""
-        waiting_time = (self.reset - datetime.now(timezone.utc)).total_seconds() + 0.1
-        if waiting_time <= 0:
+        if self.waiting_time <= 0:
             return
-        waiting_time = ceil(waiting_time)
-        print(
-            f"\nWaiting until rate limit is over for {round(waiting_time)} seconds..."
-        )
-        for i in range(waiting_time):
-            print(
-                f"\033[KWaited for {i+1}/{waiting_time} seconds", end="\r", flush=True
-            )
-            sleep(1)
-
-
-class ClientCredentials(TypedDict):
-    client_id: str
-    client_secret: str
+        waiting_time = ceil(self.waiting_time)
+        progress.waiting(waiting_time)
+        with metrics.timer("rate_limit_wait_seconds"):
+            for i in range(waiting_time):
+                progress.waiting(waiting_time, i + 1)
+                sleep(1)
 
 
-class Token(TypedDict):
-    access_token: str
-    token_type: str
+class AttachmentResponse(TypedDict):
+    not_modified: bool
+    etag: Optional[str]
+    last_modified: Optional[str]
 
 
 class Account(TypedDict):
@@ -64,32 +88,148 @@ class Account(TypedDict):
     acct: str
 
 
+def auth_headers(token: Optional[Token]) -> dict[str, str]:
+    assert token, "Not Authorized"
+    return {"Authorization": token["token_type"] + " " + token["access_token"]}
+
+
+class RequestPolicy:
+    """How the requests of a client are rate limited and retried.
+
+    `Mastodon` and `AsyncMastodon` only differ in how they send requests and
+    wait, both follow this policy. The budget of the X-RateLimit headers is
+    counted per access token for the API and per host for media, --rate-limit
+    spaces all requests to a host.
+    """
+
+    def __init__(
+        self,
+        instance_url: str,
+        account_profile: Optional[str],
+        rate_limits: RateLimits,
+    ) -> None:
+        self.__instance_url = instance_url
+        self.__account_profile = account_profile
+        self.__rate_limits = rate_limits
+
+    def limits(self, url: str) -> tuple[TokenBucket, TokenBucket]:
+        """The bucket of the X-RateLimit budget and the interval bucket of the host of `url`."""
+        parsed_url = urlparse(url)
+        if url.startswith(self.__instance_url) and parsed_url.path.startswith(
+            API_PATHS
+        ):
+            # the API rate limit is counted per access token
+            bucket = self.__rate_limits.bucket(f"api {self.__account_profile or ''}")
+        else:
+            bucket = self.__rate_limits.bucket(parsed_url.netloc)
+        return bucket, self.__rate_limits.host(parsed_url.netloc)
+
+    @staticmethod
+    def retry_delay(
+        method: str,
+        bucket: TokenBucket,
+        status_code: int,
+        headers: Mapping[str, str],
+        attempt: int,
+    ) -> Optional[float]:
+        """Seconds to wait before the request is sent again, None if the response is returned.
+
+        Rate limited requests and server errors of GET and HEAD requests are
+        retried up to MAX_RETRIES times, afterwards RateLimitExceededException
+        is raised for a rate limited request.
+        """
+        bucket.update(headers)
+        if status_code == 429:
+            metrics.add("rate_limited_responses")
+            reset = parse_reset(headers)
+            bucket.exhaust(reset)
+            if attempt >= MAX_RETRIES:
+                raise RateLimitExceededException(
+                    reset or datetime.now(timezone.utc) + timedelta(seconds=MAX_BACKOFF)
+                )
+        elif not (method in ("GET", "HEAD") and status_code >= 500):
+            return None
+        if attempt >= MAX_RETRIES:
+            return None
+        return backoff(attempt)
+
+
 class Mastodon:
     @staticmethod
-    def __get_nodeinfo(instance_url: str) -> dict:
-        response = requests.get(instance_url + NODEINFO_PATH)
+    def __get_nodeinfo(session: requests.Session, instance_url: str) -> dict:
+        response = session.get(instance_url + NODEINFO_PATH, timeout=TIMEOUT)
         response.raise_for_status()
-        j = response.json()
+        j = loads(response.content)
         assert len(j["links"]) > 0
         link = j["links"][0]
         href = link["href"]
-        response = requests.get(href)
+        response = session.get(href, timeout=TIMEOUT)
         response.raise_for_status()
-        j = response.json()
+        j = loads(response.content)
         return j
 
-    @classmethod
-    def from_instance_domain(cls, domain: str, cache_dir: str, **kwargs) -> "Mastodon":
-        response = requests.get(f"https://{domain}{WEBFINGER_PATH}")
+    @staticmethod
+    def discover(
+        domain: str,
+        session: requests.Session,
+        cache_dir: Optional[str] = None,
+        ttl: float = DISCOVERY_TTL,
+    ) -> str:
+        """Return the url of the mastodon instance at `domain`.
+
+        `domain` may also be an url like `http://localhost:3000`, e.g. for a
+        local test instance. If `cache_dir` is passed the result is cached
+        there for `ttl` seconds.
+        """
+        session.headers["User-Agent"] = USER_AGENT
+        cache_file = (
+            join(
+                cache_dir,
+                f"{blake2b(domain.encode('utf-8')).hexdigest()}_instance.json",
+            )
+            if cache_dir
+            else None
+        )
+        if cache_file and ttl > 0 and exists(cache_file):
+            with open(cache_file) as file:
+                cached = load(file)
+            if cached["discovered_at"] + ttl > time():
+                return cached["instance_url"]
+
+        base_url = domain.rstrip("/") if "://" in domain else f"https://{domain}"
+        response = session.get(f"{base_url}{WEBFINGER_PATH}", timeout=TIMEOUT)
         if not response.url.endswith(WEBFINGER_PATH):
             raise Exception(
                 f"Invalid mastodon url: Webfinger request redirects to an url that is not a webfinger url: '{response.url}'"
             )
         instance_url: str = response.url[: -len(WEBFINGER_PATH)]
-        requests.head(instance_url).raise_for_status()
-        if Mastodon.__get_nodeinfo(instance_url)["software"]["name"] != "mastodon":
+        session.head(instance_url, timeout=TIMEOUT).raise_for_status()
+        if (
+            Mastodon.__get_nodeinfo(session, instance_url)["software"]["name"]
+            != "mastodon"
+        ):
             raise Exception(f"Instance '{instance_url}' is not a mastodon instance")
-        return cls(instance_url, cache_dir, **kwargs)
+
+        if cache_file and cache_dir:
+            if not exists(cache_dir):
+                mkdir(cache_dir)
+            with open(cache_file, "w") as file:
+                dump({"instance_url": instance_url, "discovered_at": time()}, file)
+        return instance_url
+
+    @classmethod
+    def from_instance_domain(
+        cls,
+        domain: str,
+        cache_dir: str,
+        session: Optional[requests.Session] = None,
+        discovery_ttl: float = DISCOVERY_TTL,
+        **kwargs,
+    ) -> "Mastodon":
+        if session is None:
+            session = PooledSession()
+        instance_url = Mastodon.discover(domain, session, cache_dir, discovery_ttl)
+        return cls(instance_url, cache_dir, session=session, **kwargs)
 
     def __init__(
         self,
@@ -97,17 +237,25 @@ class Mastodon:
         cache_dir: str,
         account_profile: Optional[str] = None,
         req_rate_limit: Optional[float] = None,
+        session: Optional[requests.Session] = None,
+        rate_limits: Optional[RateLimits] = None,
     ) -> None:
         self.__instance_url = instance_url
+        self.__session = session if session is not None else PooledSession()
         self.__account_profile = account_profile
-        self.__req_waiting_time = 1 / req_rate_limit if req_rate_limit else None
-        self.__last_request: Optional[float] = None
-        self.__cached_client_credentials: Optional[ClientCredentials] = None
-        self.__cached_user_credentials: Optional[Token] = None
+        self.__policy = RequestPolicy(
+            instance_url,
+            account_profile,
+            (
+                rate_limits
+                if rate_limits is not None
+                else RateLimits(1 / req_rate_limit if req_rate_limit else None)
+            ),
+        )
         self.__cache_dir = cache_dir
         if not exists(self.__cache_dir):
             mkdir(self.__cache_dir)
-        self.__instance_hash = blake2b(self.__instance_url.encode("utf-8")).hexdigest()
+        self.__credentials = credential_store(cache_dir)
 
     def create_token(self, code: str) -> Token:
         data = {
@@ -117,10 +265,9 @@ class Mastodon:
             "client_secret": self.__client_credentials["client_secret"],
             "redirect_uri": REDIRECT_URI,
         }
-        j = self.__request("POST", self.__instance_url + TOKEN_PATH, data=data).json()
-        self.__cached_user_credentials = j
-        with open(self.__user_credentials_path, "w") as file:
-            dump(j, file)
+        response = self.__request("POST", self.__instance_url + TOKEN_PATH, data=data)
+        j = loads(response.content)
+        self.__credentials.set_token(self.__instance_url, self.__account_profile, j)
         return j
 
     def get_user_statuses(
@@ -129,31 +276,66 @@ class Mastodon:
         max_id: Optional[str] = None,
         limit: Optional[int] = None,
         min_id: Optional[str] = None,
+        since_id: Optional[str] = None,
     ) -> list[dict]:
         params: dict[str, str] = {}
         if max_id:
             params["max_id"] = max_id
         if min_id:
             params["min_id"] = min_id
+        if since_id:
+            params["since_id"] = since_id
         if limit:
             params["limit"] = str(limit)
 
-        return self.__request(
+        response = self.__request(
             "GET",
             self.__instance_url
             + ACCOUNTS_STATUSES_PATH.replace("{ACCOUNT_ID}", account_id),
             params=params,
             auth=True,
-        ).json()
+        )
+        return loads(response.content)
 
-    def download_attachment(self, url: str) -> Optional[bytes]:
+    def download_attachment(
+        self,
+        url: str,
+        file: IO[bytes],
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        check_size: Optional[Callable[[Optional[int]], None]] = None,
+    ) -> Optional[AttachmentResponse]:
+        """Stream the attachment at `url` into `file`, returns None if it was not found.
+
+        If `etag` or `last_modified` are passed the request is conditional and
+        nothing is written when the attachment wasn't modified. `check_size` is
+        called with the Content-Length before the body is read, it may raise an
+        exception to skip the download.
+        """
         auth = url.startswith(self.__instance_url)
-
-        response = self.__request("GET", url, raise_for_status=False, auth=auth)
-        if response.status_code == 404:
-            return None
-        response.raise_for_status()
-        return response.content
+        headers: dict[str, str] = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+        response = self.__request(
+            "GET", url, raise_for_status=False, auth=auth, stream=True, headers=headers
+        )
+        with response:
+            if response.status_code == 404:
+                return None
+            if response.status_code != 304:
+                response.raise_for_status()
+                if check_size:
+                    check_size(content_length(response.headers))
+                for chunk in response.iter_content(CHUNK_SIZE):
+                    file.write(chunk)
+            return {
+                "not_modified": response.status_code == 304,
+                "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+            }
 
     def search_accounts(
         self, q: str, limit: Optional[int] = None, resolve: Optional[bool] = None
@@ -163,20 +345,21 @@ class Mastodon:
             params["limit"] = str(limit)
         if resolve is not None:
             params["resolve"] = "true" if resolve else "false"
-        return self.__request(
+        response = self.__request(
             "GET", self.__instance_url + ACCOUNTS_SEARCH_PATH, params=params, auth=True
-        ).json()
+        )
+        return loads(response.content)
 
     def get_me(self) -> Account:
-        return self.__request(
+        response = self.__request(
             "GET", self.__instance_url + VERIFIY_CREDENTIALS_PATH, auth=True
-        ).json()
+        )
+        return loads(response.content)
 
     def purge_cache(self) -> None:
         for file in listdir(self.__cache_dir):
             remove(join(self.__cache_dir, file))
-        self.__cached_client_credentials = None
-        self.__cached_user_credentials = None
+        self.__credentials.clear()
 
     def __request(
         self,
@@ -190,26 +373,45 @@ class Mastodon:
             kwargs["headers"] = {}
         kwargs["headers"]["User-Agent"] = USER_AGENT
         if auth:
-            kwargs["headers"] |= self.__auth_headers
+            kwargs["headers"] |= auth_headers(self.__token)
         if not "timeout" in kwargs:
             kwargs["timeout"] = TIMEOUT
 
-        if self.__req_waiting_time and self.__last_request:
-            cur = time()
-            wu = self.__last_request + self.__req_waiting_time
-            if wu > cur:
-                sleep(wu - cur)
-
-        response = requests.request(method, url, **kwargs)
-        self.__last_request = time()
-        if response.status_code == 429:
-            raise RateLimitExceededException(
-                datetime.fromisoformat(response.headers["X-RateLimit-Reset"])
-            )
+        bucket, interval = self.__policy.limits(url)
+        attempt = 0
+        while True:
+            bucket.acquire()
+            interval.acquire()
+            metrics.add("requests")
+            with metrics.timer("request_seconds"):
+                response = self.__session.request(method, url, **kwargs)
+            try:
+                delay = self.__policy.retry_delay(
+                    method, bucket, response.status_code, response.headers, attempt
+                )
+            except RateLimitExceededException:
+                response.close()
+                raise
+            if delay is None:
+                break
+            response.close()
+            metrics.add("retries")
+            with metrics.timer("backoff_seconds"):
+                sleep(delay)
+            attempt += 1
+
+        if not kwargs.get("stream"):
+            metrics.add("response_bytes", len(response.content))
         if raise_for_status:
             response.raise_for_status()
         return response
 
+    @property
+    def connection_stats(self) -> Optional[ConnectionStats]:
+        if isinstance(self.__session, PooledSession):
+            return self.__session.stats
+        return None
+
     @property
     def authorize_url(self) -> str:
         return (
@@ -231,57 +433,28 @@ class Mastodon:
         return self.__token is not None
 
     @property
-    def __auth_headers(self) -> dict[str, str]:
-        assert self.__token, "Not Authorized"
-        return {
-            "Authorization": self.__token["token_type"]
-            + " "
-            + self.__token["access_token"]
-        }
+    def token(self) -> Optional[Token]:
+        """The access token of the account, None if not authorized yet."""
+        return self.__token
 
     @property
     def __token(self) -> Optional[Token]:
-        if self.__cached_user_credentials:
-            return self.__cached_user_credentials
-
-        cache_file = self.__user_credentials_path
-        if not exists(cache_file):
-            return None
-
-        with open(cache_file) as file:
-            return load(file)
+        return self.__credentials.token(self.__instance_url, self.__account_profile)
 
     @property
     def __client_credentials(self) -> ClientCredentials:
-        if self.__cached_client_credentials:
-            return self.__cached_client_credentials
-
-        cache_file = self.__client_credentials_path
-        if exists(cache_file):
-            with open(cache_file) as file:
-                credentials = load(file)
-        else:
-            json = {
-                "client_name": CLIENT_NAME,
-                "redirect_uris": REDIRECT_URI,
-                "scopes": SCOPES,
-                "website": WEBSITE,
-            }
-            credentials = self.__request(
-                "POST", self.__instance_url + APP_CREATE_PATH, json=json
-            ).json()
-            with open(cache_file, "w") as file:
-                dump(credentials, file)
-        self.__cached_client_credentials = credentials
-        return credentials
-
-    @property
-    def __client_credentials_path(self) -> str:
-        return join(
-            self.__cache_dir,
-            f"{self.__instance_hash}_{f'{self.__account_profile}_' if self.__account_profile else ''}client.json",
+        return self.__credentials.client_credentials(
+            self.__instance_url, self.__account_profile, self.__register_app
         )
 
-    @property
-    def __user_credentials_path(self) -> str:
-        return join(self.__cache_dir, f"{self.__instance_hash}_user.json")
+    def __register_app(self) -> ClientCredentials:
+        json = {
+            "client_name": CLIENT_NAME,
+            "redirect_uris": REDIRECT_URI,
+            "scopes": SCOPES,
+            "website": WEBSITE,
+        }
+        response = self.__request(
+            "POST", self.__instance_url + APP_CREATE_PATH, json=json
+        )
+        return loads(response.content)
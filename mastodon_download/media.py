@@ -0,0 +1,358 @@
+from os import remove, replace
+from os.path import exists, join
+from queue import Queue
+from shutil import copyfileobj
+from tempfile import TemporaryFile
+from threading import BoundedSemaphore, Lock, Thread
+from typing import IO, Optional
+from urllib.parse import urlparse
+from zipfile import ZIP64_LIMIT, ZipFile
+
+import requests
+
+from mastodon_download.mastodon import (
+    AttachmentResponse,
+    Mastodon,
+    RateLimitExceededException,
+)
+from mastodon_download.mediapolicy import (
+    MediaBudgetExceededException,
+    MediaPolicy,
+    SkippedMedia,
+)
+from mastodon_download.mediastore import MediaStore, StoredMedia
+from mastodon_download.metrics import metrics, progress
+
+FAILED_MEDIA_FILE = "failed_media.json"
+
+
+def attachment_filename(attachment: dict, preview: bool = False) -> str:
+    """The name of the file an attachment is saved as, its id with the extension of its url.
+
+    Previews get their own name, so the original isn't mistaken for downloaded
+    by a later run that downloads originals.
+    """
+    url = (
+        attachment["preview_url"]
+        if preview
+        else attachment["remote_url"] or attachment["url"]
+    )
+    suffix = "_preview" if preview else ""
+    return attachment["id"] + suffix + "." + url.split("/")[-1].split(".")[-1]
+
+
+def attachment_urls(attachment: dict, preview: bool = False) -> list[str]:
+    """The urls to download an attachment from, the original first if it's a remote attachment."""
+    if preview:
+        return [attachment["preview_url"]]
+    remote_url = attachment["remote_url"]
+    return [remote_url, attachment["url"]] if remote_url else [attachment["url"]]
+
+
+def find_attachment(attachment: dict, media_output: str) -> Optional[tuple[str, bool]]:
+    """The path of the downloaded file of an attachment and whether it's the preview.
+
+    With --media-preview-types the preview is downloaded instead of the
+    original. None if neither is in `media_output`.
+    """
+    previews = [False, True] if attachment.get("preview_url") else [False]
+    for preview in previews:
+        path = join(media_output, attachment_filename(attachment, preview))
+        if exists(path):
+            return path, preview
+    return None
+
+
+class MediaDownloader:
+    """Download media attachments concurrently in background worker threads.
+
+    The status pager puts attachments into a bounded queue using `submit` so
+    a slow media host doesn't block fetching the next page of statuses.
+    Attachments rejected by the `policy` are recorded in `skipped`, the ones
+    that were not found or couldn't be downloaded in `failed`.
+    """
+
+    def __init__(
+        self,
+        mastodon: Mastodon,
+        media_output: str,
+        zipfile: Optional[ZipFile] = None,
+        store: Optional[MediaStore] = None,
+        workers: int = 4,
+        host_concurrency: int = 2,
+        policy: Optional[MediaPolicy] = None,
+        skipped: Optional[SkippedMedia] = None,
+        failed: Optional[SkippedMedia] = None,
+    ) -> None:
+        self.__mastodon = mastodon
+        self.__media_output = media_output
+        self.__zipfile = zipfile
+        self.__store = store
+        self.__policy = policy if policy is not None else MediaPolicy()
+        self.skipped = skipped if skipped is not None else SkippedMedia()
+        self.failed = failed if failed is not None else SkippedMedia()
+        self.__host_concurrency = host_concurrency
+        self.__host_semaphores: dict[str, BoundedSemaphore] = {}
+        self.__lock = Lock()
+        # the zip file takes one member at a time, copying an attachment into it
+        # must not block submitting attachments or the other workers' bookkeeping
+        self.__zip_lock = Lock()
+        self.__error: Optional[BaseException] = None
+        self.__aborted = False
+        self.__pending: dict[str, dict] = {}
+        self.downloaded = 0
+        self.downloaded_bytes = 0
+        self.__zip_names = set(zipfile.namelist()) if zipfile else set()
+        self.__queue: Queue[Optional[dict]] = Queue(maxsize=workers * 4)
+        self.__threads = [
+            Thread(target=self.__work, daemon=True) for _ in range(workers)
+        ]
+        for thread in self.__threads:
+            thread.start()
+
+    @property
+    def pending(self) -> list[dict]:
+        """Attachments that were submitted but not downloaded yet."""
+        with self.__lock:
+            return list(self.__pending.values())
+
+    def submit(self, attachment: dict) -> None:
+        self.__raise_error()
+        with self.__lock:
+            self.__pending[attachment["id"]] = attachment
+        self.__queue.put(attachment)
+
+    def close(self, abort: bool = False) -> None:
+        """Wait until all submitted attachments are downloaded.
+
+        With `abort` only the downloads that are already running are finished,
+        the remaining attachments stay pending.
+        """
+        self.__aborted = abort
+        for _ in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+        if not abort:
+            self.__raise_error()
+
+    def __raise_error(self) -> None:
+        if self.__error:
+            raise self.__error
+
+    def __work(self) -> None:
+        while True:
+            attachment = self.__queue.get()
+            if attachment is None:
+                return
+            if self.__error or self.__aborted:
+                continue
+            try:
+                with metrics.timer("media_download_seconds"):
+                    self.__download(attachment)
+            except BaseException as e:
+                self.__error = e
+                continue
+            with self.__lock:
+                self.__pending.pop(attachment["id"], None)
+
+    def __count_download(self, size: int) -> None:
+        with self.__lock:
+            self.downloaded += 1
+            self.downloaded_bytes += size
+        metrics.add("media_downloaded")
+        metrics.add("media_bytes", size)
+
+    def __host_semaphore(self, url: str) -> BoundedSemaphore:
+        host = urlparse(url).netloc
+        with self.__lock:
+            if host not in self.__host_semaphores:
+                self.__host_semaphores[host] = BoundedSemaphore(self.__host_concurrency)
+            return self.__host_semaphores[host]
+
+    def __fetch(
+        self, url: str, file: IO[bytes], stored: Optional[StoredMedia] = None
+    ) -> Optional[AttachmentResponse]:
+        etag = stored["etag"] if stored else None
+        last_modified = stored["last_modified"] if stored else None
+        reserved = 0
+
+        def check_size(size: Optional[int]) -> None:
+            nonlocal reserved
+            reserved = self.__policy.reserve(size)
+
+        start = file.tell()
+        try:
+            with self.__host_semaphore(url):
+                try:
+                    response = self.__mastodon.download_attachment(
+                        url,
+                        file,
+                        etag=etag,
+                        last_modified=last_modified,
+                        check_size=check_size,
+                    )
+                except RateLimitExceededException as e:
+                    e.wait()
+                    response = self.__mastodon.download_attachment(
+                        url,
+                        file,
+                        etag=etag,
+                        last_modified=last_modified,
+                        check_size=check_size,
+                    )
+        except BaseException:
+            # a failed download doesn't count against the budget
+            self.__policy.settle(reserved, 0)
+            raise
+        if response and not response["not_modified"]:
+            self.__policy.settle(reserved, file.tell() - start)
+        return response
+
+    def __fetch_any(self, urls: list[str], file: IO[bytes]) -> bool:
+        """Download the first of `urls` that works into `file`, returns False if none was found.
+
+        If none works and any of them failed with an error, the last error is raised.
+        """
+        start = file.tell()
+        error: Optional[Exception] = None
+        for url in urls:
+            try:
+                if self.__fetch(url, file):
+                    return True
+            except (requests.RequestException, RateLimitExceededException) as e:
+                error = e
+                # drop what was written before the download failed
+                file.seek(start)
+                file.truncate()
+        if error:
+            raise error
+        return False
+
+    def __fetch_into_store(
+        self, urls: list[str], attachment_id: str
+    ) -> Optional[StoredMedia]:
+        assert self.__store
+        error: Optional[Exception] = None
+        for url in urls:
+            stored = self.__store.lookup(url)
+            file = self.__store.temporary_file()
+            try:
+                with file:
+                    response = self.__fetch(url, file, stored)
+            except (requests.RequestException, RateLimitExceededException) as e:
+                remove(file.name)
+                error = e
+                continue
+            except BaseException:
+                remove(file.name)
+                raise
+            if response is None:
+                remove(file.name)
+                continue
+            if response["not_modified"] and stored:
+                remove(file.name)
+                metrics.add("media_not_modified")
+                return stored
+            stored = self.__store.add(
+                url,
+                attachment_id,
+                file.name,
+                etag=response["etag"],
+                last_modified=response["last_modified"],
+            )
+            self.__count_download(stored["size"])
+            return stored
+        if error:
+            raise error
+        return None
+
+    def __skip(self, attachment: dict, reason: str) -> None:
+        metrics.add("media_skipped")
+        self.skipped.add(attachment, reason)
+
+    def __download(self, attachment: dict) -> None:
+        url = attachment["url"]
+        reason = self.__policy.skip_reason(attachment)
+        if reason:
+            self.__skip(attachment, reason)
+            return
+        preview = self.__policy.preview(attachment)
+        path = join(self.__media_output, attachment_filename(attachment, preview))
+        if path in self.__zip_names or (not self.__zipfile and exists(path)):
+            self.skipped.remove(attachment["id"])
+            self.failed.remove(attachment["id"])
+            return
+
+        progress.attachment(path)
+        urls = attachment_urls(attachment, preview)
+
+        try:
+            if self.__store:
+                stored = self.__fetch_into_store(urls, attachment["id"])
+                found = stored is not None
+                if stored and self.__zipfile:
+                    with open(self.__store.object_path(stored["hash"]), "rb") as file:
+                        self.__write_to_zipfile(file, stored["size"], path)
+                elif stored:
+                    self.__store.link(stored["hash"], path)
+            elif self.__zipfile:
+                found = self.__download_to_zipfile(urls, path)
+            else:
+                found = self.__download_to_file(urls, path)
+        except MediaBudgetExceededException:
+            self.__skip(attachment, "budget")
+            return
+        except (requests.RequestException, RateLimitExceededException) as e:
+            # the other attachments are downloaded anyway, the failed ones
+            # can be downloaded again with mastodon-download-toots-verify --repair
+            metrics.add("media_failed")
+            self.failed.add(attachment, "error")
+            progress.warning(f"Skipping attachment {url} because of an error: {e}")
+            return
+        self.skipped.remove(attachment["id"])
+        if not found:
+            metrics.add("media_missing")
+            self.failed.add(attachment, "missing")
+            progress.warning(f"Skipping attachment {url} because it was not found")
+            return
+        self.failed.remove(attachment["id"])
+
+    def __download_to_file(self, urls: list[str], path: str) -> bool:
+        # download into a temporary file next to the destination and rename it
+        # afterwards so an interrupted download never looks like a complete file
+        part_path = path + ".part"
+        try:
+            with open(part_path, "wb") as file:
+                found = self.__fetch_any(urls, file)
+                size = file.tell()
+        except BaseException:
+            remove(part_path)
+            raise
+        if not found:
+            remove(part_path)
+            return False
+        replace(part_path, path)
+        self.__count_download(size)
+        return True
+
+    def __download_to_zipfile(self, urls: list[str], path: str) -> bool:
+        # the zip file only supports one writing handle at a time, so the
+        # attachment is spooled to disk first and copied into the archive afterwards
+        with TemporaryFile() as file:
+            if not self.__fetch_any(urls, file):
+                return False
+            size = file.tell()
+            file.seek(0)
+            self.__write_to_zipfile(file, size, path)
+        self.__count_download(size)
+        return True
+
+    def __write_to_zipfile(self, file: IO[bytes], size: int, path: str) -> None:
+        assert self.__zipfile
+        with self.__zip_lock:
+            with self.__zipfile.open(
+                path, "w", force_zip64=size >= ZIP64_LIMIT
+            ) as destination:
+                copyfileobj(file, destination)
+            self.__zip_names.add(path)
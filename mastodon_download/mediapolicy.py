@@ -0,0 +1,150 @@
+from json import dumps, load
+from os import remove, replace
+from os.path import exists
+from threading import Lock
+from typing import Optional, TypedDict
+
+MEDIA_TYPES = ("image", "gifv", "video", "audio", "unknown")
+SKIPPED_MEDIA_FILE = "skipped_media.json"
+
+
+class MediaBudgetExceededException(Exception):
+    pass
+
+
+class SkippedAttachment(TypedDict):
+    attachment: dict
+    reason: str
+
+
+class MediaPolicy:
+    """Decide which attachments are downloaded in which variant.
+
+    Attachments are filtered by their type and by the dimensions and duration
+    in their `meta`, the types in `preview_types` and the attachments with an id
+    in `preview_ids` are downloaded from their `preview_url` only. The `budget` limits the bytes downloaded in a run, it's
+    checked against the Content-Length of every response before its body is read.
+    """
+
+    def __init__(
+        self,
+        types: Optional[set[str]] = None,
+        preview_types: Optional[set[str]] = None,
+        max_dimension: Optional[int] = None,
+        max_duration: Optional[float] = None,
+        budget: Optional[int] = None,
+        preview_ids: Optional[set[str]] = None,
+    ) -> None:
+        self.__types = types
+        self.__preview_types = preview_types or set()
+        self.__preview_ids = preview_ids or set()
+        self.__max_dimension = max_dimension
+        self.__max_duration = max_duration
+        self.__budget = budget
+        self.__lock = Lock()
+        self.__used = 0
+
+    def skip_reason(self, attachment: dict) -> Optional[str]:
+        """Why the attachment is not downloaded, None if it is downloaded."""
+        if self.__types is not None and attachment["type"] not in self.__types:
+            return "type"
+        if self.preview(attachment):
+            # the preview of a large video is a small image
+            return None
+        original = (attachment.get("meta") or {}).get("original") or {}
+        if self.__max_dimension is not None and (
+            (original.get("width") or 0) > self.__max_dimension
+            or (original.get("height") or 0) > self.__max_dimension
+        ):
+            return "dimension"
+        if (
+            self.__max_duration is not None
+            and (original.get("duration") or 0) > self.__max_duration
+        ):
+            return "duration"
+        return None
+
+    def preview(self, attachment: dict) -> bool:
+        return (
+            attachment["type"] in self.__preview_types
+            or attachment["id"] in self.__preview_ids
+        ) and bool(attachment.get("preview_url"))
+
+    def reserve(self, size: Optional[int]) -> int:
+        """Take `size` bytes from the budget before a download, returns the reserved bytes.
+
+        Raises MediaBudgetExceededException if they don't fit. Responses without
+        Content-Length are allowed while the budget isn't used up, they are
+        counted afterwards with `settle`.
+        """
+        if self.__budget is None:
+            return 0
+        with self.__lock:
+            if (
+                self.__used >= self.__budget
+                or self.__used + (size or 0) > self.__budget
+            ):
+                raise MediaBudgetExceededException()
+            self.__used += size or 0
+        return size or 0
+
+    def settle(self, reserved: int, size: int) -> None:
+        """Count the actual `size` of a download `reserved` bytes were taken for."""
+        if self.__budget is None:
+            return
+        with self.__lock:
+            self.__used += size - reserved
+
+
+class SkippedMedia:
+    """Attachments that weren't downloaded and why, keyed by their id.
+
+    It lists the attachments skipped by the media policy, which a later run
+    with a looser policy submits again, and the ones that failed to download.
+    """
+
+    def __init__(self, skipped: Optional[list[SkippedAttachment]] = None) -> None:
+        self.__lock = Lock()
+        self.__skipped = {entry["attachment"]["id"]: entry for entry in skipped or []}
+
+    @classmethod
+    def load(cls, path: str) -> "SkippedMedia":
+        if not exists(path):
+            return cls()
+        with open(path) as file:
+            return cls(load(file))
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return len(self.__skipped)
+
+    @property
+    def attachments(self) -> list[dict]:
+        with self.__lock:
+            return [entry["attachment"] for entry in self.__skipped.values()]
+
+    def add(self, attachment: dict, reason: str) -> None:
+        with self.__lock:
+            self.__skipped[attachment["id"]] = {
+                "attachment": attachment,
+                "reason": reason,
+            }
+
+    def remove(self, attachment_id: str) -> None:
+        with self.__lock:
+            self.__skipped.pop(attachment_id, None)
+
+    def to_json(self) -> bytes:
+        with self.__lock:
+            return dumps(list(self.__skipped.values()), indent=2).encode("utf-8")
+
+    def save(self, path: str) -> None:
+        """Write the skipped attachments to `path`, the file is removed if there are none."""
+        if len(self) == 0:
+            if exists(path):
+                remove(path)
+            return
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(self.to_json())
+        replace(tmp_path, path)
@@ -0,0 +1,132 @@
+import sqlite3
+from hashlib import sha256
+from os import link, makedirs, remove, replace
+from os.path import exists, join
+from shutil import copyfile
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import IO, Optional, TypedDict
+
+from mastodon_download.mastodon import CHUNK_SIZE
+
+
+class StoredMedia(TypedDict):
+    hash: str
+    size: int
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+
+class MediaStore:
+    """Content-addressed store for media attachments.
+
+    Every file is stored once as `objects/<hash prefix>/<sha256 hash>`, an
+    index maps the url of an attachment to the hash of its content and the
+    ETag/Last-Modified validators of the response it was downloaded with.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.__path = path
+        self.__tmp_path = join(path, "tmp")
+        makedirs(self.__tmp_path, exist_ok=True)
+        self.__lock = Lock()
+        self.__con = sqlite3.connect(
+            join(path, "index.sqlite"), check_same_thread=False
+        )
+        self.__cur = self.__con.cursor()
+        self.__cur.execute("PRAGMA journal_mode=WAL")
+        self.__cur.execute("PRAGMA synchronous=NORMAL")
+        self.__cur.execute(
+            "CREATE TABLE IF NOT EXISTS media(url TEXT NOT NULL PRIMARY KEY, attachment_id TEXT, hash TEXT NOT NULL, size INTEGER NOT NULL, etag TEXT, last_modified TEXT)"
+        )
+        self.__cur.execute(
+            "CREATE INDEX IF NOT EXISTS media_attachment_id ON media(attachment_id)"
+        )
+        self.__con.commit()
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__cur.close()
+            self.__con.close()
+
+    def object_path(self, hash: str) -> str:
+        return join(self.__path, "objects", hash[:2], hash)
+
+    def lookup(self, url: str) -> Optional[StoredMedia]:
+        """Return the stored media for `url` if its content is still in the store."""
+        with self.__lock:
+            self.__cur.execute(
+                "SELECT hash, size, etag, last_modified FROM media WHERE url=?", (url,)
+            )
+            row = self.__cur.fetchone()
+        if row is None or not exists(self.object_path(row[0])):
+            return None
+        return {"hash": row[0], "size": row[1], "etag": row[2], "last_modified": row[3]}
+
+    def discard(self, hash: str) -> None:
+        """Remove a stored file, e.g. because it's corrupt. The urls pointing to it are downloaded again."""
+        object_path = self.object_path(hash)
+        if exists(object_path):
+            remove(object_path)
+
+    def temporary_file(self) -> IO[bytes]:
+        """A file to download into that can be added to the store using `add`."""
+        return NamedTemporaryFile(dir=self.__tmp_path, suffix=".part", delete=False)
+
+    def add(
+        self,
+        url: str,
+        attachment_id: str,
+        tmp_path: str,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> StoredMedia:
+        """Move the downloaded file at `tmp_path` into the store and index it."""
+        h = sha256()
+        size = 0
+        with open(tmp_path, "rb") as file:
+            while chunk := file.read(CHUNK_SIZE):
+                h.update(chunk)
+                size += len(chunk)
+        hash = h.hexdigest()
+
+        object_path = self.object_path(hash)
+        if exists(object_path):
+            remove(tmp_path)
+        else:
+            makedirs(join(self.__path, "objects", hash[:2]), exist_ok=True)
+            replace(tmp_path, object_path)
+        self.update(url, attachment_id, hash, size, etag, last_modified)
+        return {
+            "hash": hash,
+            "size": size,
+            "etag": etag,
+            "last_modified": last_modified,
+        }
+
+    def update(
+        self,
+        url: str,
+        attachment_id: str,
+        hash: str,
+        size: int,
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+    ) -> None:
+        with self.__lock:
+            self.__cur.execute(
+                "INSERT INTO media(url, attachment_id, hash, size, etag, last_modified) VALUES(?,?,?,?,?,?) ON CONFLICT DO UPDATE SET attachment_id=EXCLUDED.attachment_id, hash=EXCLUDED.hash, size=EXCLUDED.size, etag=EXCLUDED.etag, last_modified=EXCLUDED.last_modified",
+                (url, attachment_id, hash, size, etag, last_modified),
+            )
+            self.__con.commit()
+
+    def link(self, hash: str, path: str) -> None:
+        """Put the stored file at `path` as a hard link, or as a copy if linking isn't possible."""
+        part_path = path + ".part"
+        if exists(part_path):
+            remove(part_path)
+        try:
+            link(self.object_path(hash), part_path)
+        except OSError:
+            copyfile(self.object_path(hash), part_path)
+        replace(part_path, path)
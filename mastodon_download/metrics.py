@@ -0,0 +1,143 @@
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from json import dump, dumps
+from os import replace
+from threading import Lock
+from time import perf_counter
+from typing import Iterator, Optional
+
+METRICS_FORMATS = ("json", "ndjson", "prometheus")
+PROGRESS_MODES = ("tty", "json", "none")
+PROMETHEUS_PREFIX = "mastodon_download_"
+
+
+def _escape_label(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Metrics:
+    """Thread-safe counters of a run, names ending with `_seconds` are timers."""
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__values: dict[str, float] = {}
+
+    def add(self, name: str, value: float = 1) -> None:
+        with self.__lock:
+            self.__values[name] = self.__values.get(name, 0) + value
+
+    @contextmanager
+    def timer(self, name: str) -> Iterator[None]:
+        """Add the time spent in the `with` block to `name`."""
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, perf_counter() - start)
+
+    def snapshot(self) -> dict[str, float]:
+        with self.__lock:
+            return dict(sorted(self.__values.items()))
+
+    def write(self, path: str, format: str, labels: dict[str, str]) -> None:
+        """Write the metrics to `path`, NDJSON appends a line to the file."""
+        values = self.snapshot()
+        if format == "ndjson":
+            with open(path, "a") as file:
+                file.write(
+                    dumps(
+                        {
+                            "time": datetime.now(timezone.utc).isoformat(),
+                            **labels,
+                            **values,
+                        }
+                    )
+                    + "\n"
+                )
+            return
+
+        # written to a temporary file first because e.g. the textfile collector
+        # of the node exporter may read the file at any time
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as file:
+            if format == "json":
+                dump({**labels, **values}, file, indent=2)
+            else:
+                label_text = ",".join(
+                    f'{key}="{_escape_label(value)}"' for key, value in labels.items()
+                )
+                for name, value in values.items():
+                    metric = f"{PROMETHEUS_PREFIX}{name}_total"
+                    file.write(f"# TYPE {metric} counter\n")
+                    file.write(f"{metric}{{{label_text}}} {value}\n")
+        replace(tmp_path, path)
+
+
+class Progress:
+    """Report the progress of a run.
+
+    `tty` overwrites the current line of the terminal, `json` writes one JSON
+    object per event and line for logs, `none` only reports warnings.
+    """
+
+    def __init__(self, mode: str = "tty") -> None:
+        self.mode = mode
+
+    def __event(self, event: str, **fields) -> None:
+        print(
+            dumps(
+                {
+                    "time": datetime.now(timezone.utc).isoformat(),
+                    "event": event,
+                    **fields,
+                }
+            ),
+            flush=True,
+        )
+
+    def message(self, text: str) -> None:
+        if self.mode == "tty":
+            # clears the page or attachment line the message is written over
+            print(f"\033[K{text}")
+        elif self.mode == "json":
+            self.__event("message", message=text)
+
+    def warning(self, text: str) -> None:
+        if self.mode == "json":
+            self.__event("warning", message=text)
+        elif self.mode == "tty":
+            print(f"\033[KWarning: {text}")
+        else:
+            print(f"Warning: {text}")
+
+    def page(self, page: int, fetched: int) -> None:
+        if self.mode == "tty":
+            print(
+                f"\033[KPage {page} (already fetched: {fetched})", end="\r", flush=True
+            )
+        elif self.mode == "json":
+            self.__event("page", page=page, fetched=fetched)
+
+    def attachment(self, path: str) -> None:
+        if self.mode == "tty":
+            print(f"\033[KDownloading attachment {path}...", end="\r", flush=True)
+
+    def waiting(self, seconds: int, waited: Optional[int] = None) -> None:
+        """Report that the rate limit is exceeded, call it with `waited` every second."""
+        if self.mode == "tty":
+            if waited is None:
+                print(f"\nWaiting until rate limit is over for {seconds} seconds...")
+            else:
+                print(
+                    f"\033[KWaited for {waited}/{seconds} seconds", end="\r", flush=True
+                )
+        elif self.mode == "json" and waited is None:
+            self.__event("rate_limit_wait", seconds=seconds)
+
+    def done(self, metrics: dict[str, float]) -> None:
+        if self.mode == "json":
+            self.__event("done", **metrics)
+
+
+metrics = Metrics()
+progress = Progress()
@@ -0,0 +1,123 @@
+from datetime import datetime, timezone
+from random import uniform
+from threading import Lock
+from time import monotonic, sleep
+from typing import Mapping, Optional
+
+from mastodon_download.metrics import metrics
+
+MAX_BACKOFF = 60
+BASE_BACKOFF = 0.5
+
+
+def parse_reset(headers: Mapping[str, str]) -> Optional[datetime]:
+    reset = headers.get("X-RateLimit-Reset")
+    if not reset:
+        return None
+    try:
+        return datetime.fromisoformat(reset)
+    except ValueError:
+        return None
+
+
+def backoff(attempt: int) -> float:
+    """Exponential backoff with full jitter for the `attempt`th retry."""
+    return uniform(0, min(MAX_BACKOFF, BASE_BACKOFF * 2**attempt))
+
+
+class TokenBucket:
+    """Thread-safe token bucket that is refilled by the X-RateLimit headers of the responses.
+
+    Requests may be sent as long as the server reports remaining requests in
+    the current window, afterwards `acquire` blocks until the window is reset.
+    Additionally requests are spaced by `min_interval` seconds if it's set.
+    """
+
+    def __init__(self, min_interval: Optional[float] = None) -> None:
+        self.__lock = Lock()
+        self.__min_interval = min_interval or 0
+        self.__next_request = 0.0
+        self.__remaining: Optional[int] = None
+        self.__reset: Optional[float] = None
+
+    def acquire(self) -> None:
+        sleep(self.reserve())
+
+    def reserve(self) -> float:
+        """Take a request from the bucket, returns the seconds to wait before sending it."""
+        with self.__lock:
+            now = monotonic()
+            if self.__reset is not None and self.__reset <= now:
+                # a new window started, the next response tells how much is left
+                self.__remaining = None
+                self.__reset = None
+            start = max(self.__next_request, now)
+            if self.__remaining is not None:
+                if self.__remaining <= 0 and self.__reset is not None:
+                    start = max(start, self.__reset + uniform(0, 1))
+                    self.__remaining = None
+                    self.__reset = None
+                else:
+                    self.__remaining -= 1
+            self.__next_request = start + self.__min_interval
+        if start <= now:
+            return 0
+        metrics.add("rate_limit_wait_seconds", start - now)
+        return start - now
+
+    def update(self, headers: Mapping[str, str]) -> None:
+        remaining_header = headers.get("X-RateLimit-Remaining")
+        reset = parse_reset(headers)
+        if remaining_header is None or reset is None:
+            return
+        try:
+            remaining = int(remaining_header)
+        except ValueError:
+            return
+        reset_in = (reset - datetime.now(timezone.utc)).total_seconds()
+        with self.__lock:
+            reset_at = monotonic() + max(reset_in, 0)
+            if self.__reset is None or reset_at > self.__reset + 1:
+                self.__remaining = remaining
+            elif self.__remaining is not None:
+                # responses of concurrent requests may arrive out of order
+                self.__remaining = min(self.__remaining, remaining)
+            self.__reset = reset_at
+
+    def exhaust(self, reset: Optional[datetime]) -> None:
+        """Block all requests until `reset` after the server refused a request."""
+        with self.__lock:
+            self.__remaining = 0
+            if reset is not None:
+                reset_in = (reset - datetime.now(timezone.utc)).total_seconds()
+                self.__reset = monotonic() + max(reset_in, 0)
+            else:
+                self.__reset = monotonic() + MAX_BACKOFF
+
+
+class RateLimits:
+    """The token buckets of one instance.
+
+    The X-RateLimit budget is counted by one bucket per access token for the API
+    and one per media host. The minimum interval between requests applies per
+    host, the API and media requests to the same host are spaced together.
+    """
+
+    def __init__(self, min_interval: Optional[float] = None) -> None:
+        self.__min_interval = min_interval
+        self.__lock = Lock()
+        self.__buckets: dict[str, TokenBucket] = {}
+        self.__hosts: dict[str, TokenBucket] = {}
+
+    def bucket(self, name: str) -> TokenBucket:
+        with self.__lock:
+            if name not in self.__buckets:
+                self.__buckets[name] = TokenBucket()
+            return self.__buckets[name]
+
+    def host(self, netloc: str) -> TokenBucket:
+        """The bucket that spaces all requests to `netloc` by the minimum interval."""
+        with self.__lock:
+            if netloc not in self.__hosts:
+                self.__hosts[netloc] = TokenBucket(self.__min_interval)
+            return self.__hosts[netloc]
@@ -0,0 +1,86 @@
+from io import TextIOWrapper
+from json import JSONDecodeError, JSONDecoder
+from typing import IO, Any, Iterator, Optional
+
+READ_SIZE = 64 * 1024
+
+
+class StatusReader:
+    """Read a JSON document written by `StatusWriter` status by status.
+
+    Only the status that is currently parsed is kept in memory, so arbitrarily
+    large documents can be read.
+    """
+
+    def __init__(self, file: IO[bytes]) -> None:
+        self.__file = TextIOWrapper(file, encoding="utf-8")
+        self.__decoder = JSONDecoder()
+        self.__buffer = ""
+        self.__position = 0
+        self.account: Optional[dict] = None
+
+        self.__skip_whitespace()
+        self.optimize_json = self.__peek() == "{"
+        if self.optimize_json:
+            self.__expect("{")
+            for key in ("account", "statuses"):
+                if self.__value() != key:
+                    raise Exception(f"Invalid statuses file: Expected key {key}")
+                self.__expect(":")
+                if key == "account":
+                    self.account = self.__value()
+                    self.__expect(",")
+        self.__expect("[")
+
+    def __iter__(self) -> Iterator[dict]:
+        if self.__peek() == "]":
+            return
+        while True:
+            yield self.__value()
+            self.__skip_whitespace()
+            if self.__peek() == "]":
+                return
+            self.__expect(",")
+
+    def __fill(self) -> bool:
+        """Read the next chunk into the buffer, returns False at the end of the file."""
+        chunk = self.__file.read(READ_SIZE)
+        self.__buffer = self.__buffer[self.__position :] + chunk
+        self.__position = 0
+        return chunk != ""
+
+    def __skip_whitespace(self) -> None:
+        while True:
+            while (
+                self.__position < len(self.__buffer)
+                and self.__buffer[self.__position].isspace()
+            ):
+                self.__position += 1
+            if self.__position < len(self.__buffer) or not self.__fill():
+                return
+
+    def __peek(self) -> str:
+        self.__skip_whitespace()
+        if self.__position == len(self.__buffer):
+            raise Exception("Invalid statuses file: Unexpected end of file")
+        return self.__buffer[self.__position]
+
+    def __expect(self, char: str) -> None:
+        if self.__peek() != char:
+            raise Exception(
+                f"Invalid statuses file: Expected '{char}' but got '{self.__peek()}'"
+            )
+        self.__position += 1
+
+    def __value(self) -> Any:
+        self.__skip_whitespace()
+        while True:
+            try:
+                value, end = self.__decoder.raw_decode(self.__buffer, self.__position)
+            except JSONDecodeError:
+                # the value may continue in the next chunk
+                if not self.__fill():
+                    raise
+                continue
+            self.__position = end
+            return value
@@ -0,0 +1,51 @@
+import json
+from typing import Any
+
+try:
+    import orjson
+except ImportError:
+    orjson = None  # type: ignore[assignment]
+
+BACKEND = "orjson" if orjson else "json"
+COMPACT_SEPARATORS = (",", ":")
+
+# created once, json.dumps builds a new encoder for every call with options
+_encoder = json.JSONEncoder(separators=COMPACT_SEPARATORS, ensure_ascii=False)
+_sorted_encoder = json.JSONEncoder(
+    separators=COMPACT_SEPARATORS, ensure_ascii=False, sort_keys=True
+)
+
+
+def dumps(obj: Any, sort_keys: bool = False) -> bytes:
+    """Encode `obj` as compact UTF-8 JSON, used for everything that is stored and read again.
+
+    orjson is used if it's installed, otherwise the json module writes the same
+    bytes. Values orjson rejects (lone surrogates, integers above 64 bits) are
+    encoded by the json module. Only floats that need an exponent (e.g. 1e-05)
+    are formatted differently, they decode to the same value.
+    """
+    if orjson:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS if sort_keys else 0)
+        except TypeError:
+            pass
+    encoder = _sorted_encoder if sort_keys else _encoder
+    # lone surrogates aren't valid UTF-8, they are written as \u escapes
+    return encoder.encode(obj).encode("utf-8", "backslashreplace")
+
+
+def loads(data: bytes | str) -> Any:
+    """Decode JSON with orjson if it's installed, otherwise with the json module."""
+    if orjson:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            # orjson rejects escaped lone surrogates, the json module accepts them
+            # and raises the same error for invalid documents
+            pass
+    return json.loads(data)
+
+
+def dumps_document(obj: Any) -> bytes:
+    """Encode `obj` like `json.dumps` with its default options, the format of the JSON output."""
+    return json.dumps(obj).encode("utf-8")
@@ -0,0 +1,89 @@
+from threading import Lock
+from time import perf_counter
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+
+class ConnectionStats:
+    """Counts requests and newly established connections of a `PooledSession`."""
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.requests = 0
+        self.connections = 0
+        self.connect_time = 0.0
+
+    def add_request(self) -> None:
+        with self.__lock:
+            self.requests += 1
+
+    def add_connection(self, connect_time: float) -> None:
+        with self.__lock:
+            self.connections += 1
+            self.connect_time += connect_time
+
+    @property
+    def reused_connections(self) -> int:
+        return max(self.requests - self.connections, 0)
+
+    @property
+    def saved_time(self) -> float:
+        """Estimated time saved by reusing connections instead of opening a new one per request."""
+        if self.connections == 0:
+            return 0
+        return self.reused_connections * self.connect_time / self.connections
+
+
+def _timed_pool(
+    pool_cls: type[HTTPConnectionPool],
+    connection_cls: type[HTTPConnection],
+    stats: ConnectionStats,
+) -> type[HTTPConnectionPool]:
+    class TimedConnection(connection_cls):  # type: ignore[valid-type, misc]
+        def connect(self) -> None:
+            start = perf_counter()
+            super().connect()
+            stats.add_connection(perf_counter() - start)
+
+    class TimedConnectionPool(pool_cls):  # type: ignore[valid-type, misc]
+        ConnectionCls = TimedConnection
+
+    return TimedConnectionPool
+
+
+class _TimedAdapter(HTTPAdapter):
+    def __init__(self, stats: ConnectionStats, **kwargs) -> None:
+        self.__stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _timed_pool(HTTPConnectionPool, HTTPConnection, self.__stats),
+            "https": _timed_pool(HTTPSConnectionPool, HTTPSConnection, self.__stats),
+        }
+
+
+class PooledSession(requests.Session):
+    """A requests session that keeps connections alive and reuses them.
+
+    `pool_connections` is the number of hosts a connection pool is kept for,
+    `pool_maxsize` the number of connections kept alive per host. Responses
+    are transparently decompressed when the server sends them gzip encoded.
+    """
+
+    def __init__(self, pool_connections: int = 10, pool_maxsize: int = 10) -> None:
+        super().__init__()
+        self.stats = ConnectionStats()
+        adapter = _TimedAdapter(
+            self.stats, pool_connections=pool_connections, pool_maxsize=pool_maxsize
+        )
+        self.mount("https://", adapter)
+        self.mount("http://", adapter)
+
+    def request(self, *args, **kwargs) -> requests.Response:
+        self.stats.add_request()
+        return super().request(*args, **kwargs)
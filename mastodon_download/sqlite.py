@@ -1,32 +1,263 @@
 import sqlite3
-from json import dumps, loads
-from typing import Optional
+from datetime import datetime, timezone
+from hashlib import blake2b
+from html.parser import HTMLParser
+from os.path import abspath, exists
+from typing import Iterator, Optional
+from urllib.parse import quote
 
+from mastodon_download.checkpoint import CrawlState
+from mastodon_download.compressed import id_key
 from mastodon_download.mastodon import Account
+from mastodon_download.metrics import metrics
+from mastodon_download.serializer import dumps, loads
+
+# version of the normalized schema, stored as PRAGMA user_version
+NORMALIZED_VERSION = 1
+MIGRATION_BATCH_SIZE = 1000
+EXPORT_BATCH_SIZE = 1000
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self) -> None:
+        super().__init__()
+        self.parts: list[str] = []
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, Optional[str]]]) -> None:
+        if tag in ("br", "p"):
+            self.parts.append("\n")
+
+    def handle_data(self, data: str) -> None:
+        self.parts.append(data)
+
+
+def html_to_text(html: str) -> str:
+    extractor = _TextExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return "".join(extractor.parts).strip()
+
+
+def status_hash(status: dict) -> str:
+    """Hash of the content of a status, the embedded accounts are left out.
+
+    The counts of the accounts change all the time, they would make every
+    status look changed.
+    """
+    content = {key: value for key, value in status.items() if key != "account"}
+    if content.get("reblog"):
+        content["reblog"] = {
+            key: value for key, value in content["reblog"].items() if key != "account"
+        }
+    return blake2b(dumps(content, sort_keys=True)).hexdigest()
 
 
 class SqliteDatabase:
-    def __init__(self, path: str) -> None:
-        self.__con = sqlite3.connect(path)
+    """Stores the statuses of one account as JSON.
+
+    With `normalize` (or if the database was normalized before) the created_at,
+    visibility, reply/reblog ids and counts of every status are stored in columns
+    of the status table as well, the attachments in the media table and the text
+    in the full-text index status_fts.
+
+    Deleted statuses found by `mark_deleted` are kept with their deletion time
+    in deleted_at.
+
+    With `read_only` the database is opened without write access and left as
+    it is, databases of older versions aren't migrated.
+    """
+
+    def __init__(
+        self, path: str, normalize: bool = False, read_only: bool = False
+    ) -> None:
+        if read_only:
+            if normalize:
+                raise Exception("A database opened read-only can't be normalized")
+            if not exists(path):
+                raise Exception(f"Database {path} doesn't exist")
+            self.__con = sqlite3.connect(
+                f"file:{quote(abspath(path))}?mode=ro", uri=True
+            )
+        else:
+            self.__con = sqlite3.connect(path)
         self.__cur = self.__con.cursor()
-        self.__run_table_create()
+        if not read_only:
+            self.__run_pragmas()
+            self.__run_table_create()
+        # a database of an older version that was opened read-only may lack
+        # some tables and columns
+        self.__cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+        self.__tables = {row[0] for row in self.__cur.fetchall()}
+        self.__cur.execute("PRAGMA table_info(status)")
+        self.__status_columns = {row[1] for row in self.__cur.fetchall()}
+        self.__normalized = self.__get_version() >= NORMALIZED_VERSION
+        if normalize and not self.__normalized:
+            self.__normalize()
 
     def close(self) -> None:
         self.__cur.close()
         self.__con.close()
 
+    def __run_pragmas(self) -> None:
+        # with WAL journaling a commit doesn't need an fsync of the database file,
+        # synchronous=NORMAL is still safe against corruption in WAL mode
+        self.__cur.execute("PRAGMA journal_mode=WAL")
+        self.__cur.execute("PRAGMA synchronous=NORMAL")
+        self.__cur.execute("PRAGMA cache_size=-65536")
+        self.__cur.execute("PRAGMA temp_store=MEMORY")
+
     def __run_table_create(self) -> None:
         self.__cur.execute(
-            "CREATE TABLE IF NOT EXISTS status(id TEXT NOT NULL PRIMARY KEY, status TEXT)"
+            "CREATE TABLE IF NOT EXISTS status(id TEXT NOT NULL PRIMARY KEY, status TEXT, hash TEXT, deleted_at TEXT)"
         )
+        # databases of older versions don't have the hash and deleted_at columns
+        self.__cur.execute("PRAGMA table_info(status)")
+        columns = {row[1] for row in self.__cur.fetchall()}
+        for column in ("hash", "deleted_at"):
+            if column not in columns:
+                self.__cur.execute(f"ALTER TABLE status ADD COLUMN {column} TEXT")
         self.__cur.execute(
             "CREATE TABLE IF NOT EXISTS account(id TEXT NOT NULL PRIMARY KEY, account TEXT)"
         )
         self.__cur.execute(
             "CREATE TABLE IF NOT EXISTS newest_status(id TEXT NOT NULL PRIMARY KEY)"
         )
+        self.__cur.execute(
+            "CREATE TABLE IF NOT EXISTS crawl_state(id INTEGER NOT NULL PRIMARY KEY CHECK (id = 0), state TEXT)"
+        )
+        self.__cur.execute(
+            "CREATE TABLE IF NOT EXISTS instance(id INTEGER NOT NULL PRIMARY KEY CHECK (id = 0), domain TEXT)"
+        )
         self.__con.commit()
 
+    def __get_version(self) -> int:
+        self.__cur.execute("PRAGMA user_version")
+        return self.__cur.fetchone()[0]
+
+    def __normalize(self) -> None:
+        """Migrate the database to the normalized schema in one transaction."""
+        with self.__con:
+            self.__cur.execute("BEGIN")
+            for column in (
+                "created_at TEXT",
+                "visibility TEXT",
+                "language TEXT",
+                "in_reply_to_id TEXT",
+                "reblog_id TEXT",
+                "replies_count INTEGER",
+                "reblogs_count INTEGER",
+                "favourites_count INTEGER",
+            ):
+                self.__cur.execute(f"ALTER TABLE status ADD COLUMN {column}")
+            self.__cur.execute("CREATE INDEX status_created_at ON status(created_at)")
+            self.__cur.execute(
+                "CREATE INDEX status_in_reply_to_id ON status(in_reply_to_id)"
+            )
+            self.__cur.execute("CREATE INDEX status_reblog_id ON status(reblog_id)")
+            self.__cur.execute(
+                "CREATE TABLE media(id TEXT NOT NULL PRIMARY KEY, status_id TEXT NOT NULL REFERENCES status(id), type TEXT, url TEXT, remote_url TEXT, preview_url TEXT, description TEXT)"
+            )
+            self.__cur.execute("CREATE INDEX media_status_id ON media(status_id)")
+            try:
+                self.__cur.execute(
+                    "CREATE VIRTUAL TABLE status_fts USING fts5(spoiler_text, content, tokenize='unicode61 remove_diacritics 2')"
+                )
+            except sqlite3.OperationalError as e:
+                raise Exception(
+                    f"Can't create the full-text index, SQLite must be built with FTS5: {e}"
+                )
+
+            last_rowid = 0
+            reader = self.__con.cursor()
+            while True:
+                reader.execute(
+                    "SELECT rowid, status FROM status WHERE rowid>? ORDER BY rowid LIMIT ?",
+                    (last_rowid, MIGRATION_BATCH_SIZE),
+                )
+                rows = reader.fetchall()
+                if not rows:
+                    break
+                self.__index_statuses([loads(row[1]) for row in rows])
+                last_rowid = rows[-1][0]
+            reader.close()
+            self.__cur.execute(f"PRAGMA user_version={NORMALIZED_VERSION}")
+        self.__normalized = True
+
+    def __index_statuses(self, statuses: list[dict]) -> None:
+        """Fill the columns, media and full-text index of already inserted statuses."""
+        self.__cur.executemany(
+            "UPDATE status SET created_at=?, visibility=?, language=?, in_reply_to_id=?, reblog_id=?, replies_count=?, reblogs_count=?, favourites_count=? WHERE id=?",
+            [
+                (
+                    status["created_at"],
+                    status.get("visibility"),
+                    status.get("language"),
+                    status.get("in_reply_to_id"),
+                    status["reblog"]["id"] if status.get("reblog") else None,
+                    status.get("replies_count"),
+                    status.get("reblogs_count"),
+                    status.get("favourites_count"),
+                    status["id"],
+                )
+                for status in statuses
+            ],
+        )
+        self.__cur.executemany(
+            "DELETE FROM media WHERE status_id=?",
+            [(status["id"],) for status in statuses],
+        )
+        self.__cur.executemany(
+            "INSERT INTO media(id, status_id, type, url, remote_url, preview_url, description) VALUES(?,?,?,?,?,?,?) ON CONFLICT DO UPDATE SET status_id=EXCLUDED.status_id, type=EXCLUDED.type, url=EXCLUDED.url, remote_url=EXCLUDED.remote_url, preview_url=EXCLUDED.preview_url, description=EXCLUDED.description",
+            [
+                (
+                    attachment["id"],
+                    status["id"],
+                    attachment.get("type"),
+                    attachment.get("url"),
+                    attachment.get("remote_url"),
+                    attachment.get("preview_url"),
+                    attachment.get("description"),
+                )
+                for status in statuses
+                for attachment in status.get("media_attachments", [])
+            ],
+        )
+        self.__cur.executemany(
+            "DELETE FROM status_fts WHERE rowid=(SELECT rowid FROM status WHERE id=?)",
+            [(status["id"],) for status in statuses],
+        )
+        # the text of a reblog is the text of the reblogged status
+        self.__cur.executemany(
+            "INSERT INTO status_fts(rowid, spoiler_text, content) SELECT rowid, ?, ? FROM status WHERE id=?",
+            [
+                (
+                    (status.get("reblog") or status).get("spoiler_text") or "",
+                    html_to_text((status.get("reblog") or status).get("content") or ""),
+                    status["id"],
+                )
+                for status in statuses
+            ],
+        )
+
+    def search(
+        self, query: str, limit: Optional[int] = None, include_deleted: bool = False
+    ) -> list[dict]:
+        """Return the statuses matching the FTS5 `query`, best matches first.
+
+        Statuses marked as deleted by a refresh are left out unless
+        `include_deleted` is set.
+        """
+        if not self.__normalized:
+            raise Exception(
+                "The database has no full-text index, sync it once with `--normalize-sqlite`"
+            )
+        deleted = "" if include_deleted else " AND status.deleted_at IS NULL"
+        self.__cur.execute(
+            f"SELECT status.status FROM status_fts JOIN status ON status.rowid=status_fts.rowid WHERE status_fts MATCH ?{deleted} ORDER BY rank LIMIT ?",
+            (query, -1 if limit is None else limit),
+        )
+        return [loads(row[0]) for row in self.__cur.fetchall()]
+
     def set_account(self, account: Account) -> None:
         self.__cur.execute("SELECT id, account FROM account")
         accounts = self.__cur.fetchall()
@@ -45,10 +276,63 @@ class SqliteDatabase:
 
         self.__cur.execute(
             "INSERT INTO account(id, account) VALUES(?, ?) ON CONFLICT DO UPDATE SET account=EXCLUDED.account",
-            (account["id"], dumps(account)),
+            (account["id"], dumps(account).decode("utf-8")),
         )
         self.__con.commit()
 
+    def get_account(self) -> Optional[Account]:
+        if "account" not in self.__tables:
+            return None
+        self.__cur.execute("SELECT account FROM account")
+        row = self.__cur.fetchone()
+        return loads(row[0]) if row else None
+
+    def set_instance(self, domain: str) -> None:
+        """Store the domain of the instance the statuses are downloaded from.
+
+        For an account of another instance (`--user`) it's not the domain of
+        the account.
+        """
+        with self.__con:
+            self.__cur.execute(
+                "INSERT INTO instance(id, domain) VALUES(0, ?) ON CONFLICT DO UPDATE SET domain=EXCLUDED.domain",
+                (domain,),
+            )
+
+    def get_instance(self) -> Optional[str]:
+        if "instance" not in self.__tables:
+            return None
+        self.__cur.execute("SELECT domain FROM instance")
+        row = self.__cur.fetchone()
+        return row[0] if row else None
+
+    def iter_statuses(
+        self, batch_size: int = EXPORT_BATCH_SIZE
+    ) -> Iterator[list[dict]]:
+        """Yield all statuses that aren't deleted newest first in batches of `batch_size`.
+
+        The statuses are read with a cursor over the primary key, so only one
+        batch is kept in memory and nothing has to be sorted.
+        """
+        not_deleted = (
+            " AND deleted_at IS NULL" if "deleted_at" in self.__status_columns else ""
+        )
+        cursor = self.__con.cursor()
+        try:
+            # the ids are numeric strings, the primary key only orders ids of
+            # the same length like numbers
+            cursor.execute("SELECT DISTINCT length(id) FROM status ORDER BY 1 DESC")
+            lengths = [row[0] for row in cursor.fetchall()]
+            for length in lengths:
+                cursor.execute(
+                    f"SELECT status FROM status WHERE length(id)=?{not_deleted} ORDER BY id DESC",
+                    (length,),
+                )
+                while rows := cursor.fetchmany(batch_size):
+                    yield [loads(row[0]) for row in rows]
+        finally:
+            cursor.close()
+
     def get_newest_status(self) -> Optional[str]:
         self.__cur.execute("SELECT id FROM newest_status")
         statuses = self.__cur.fetchall()
@@ -59,17 +343,100 @@ class SqliteDatabase:
         return statuses[0][0]
 
     def set_newest_status(self, status_id: str) -> None:
+        with self.__con:
+            self.__set_newest_status(status_id)
+
+    def __set_newest_status(self, status_id: str) -> None:
+        # a crawl is complete once the newest status is set
+        self.__cur.execute("DELETE FROM crawl_state")
         self.__cur.execute("DELETE FROM newest_status")
         self.__cur.execute("INSERT INTO newest_status(id) VALUES(?)", (status_id,))
-        self.__con.commit()
+
+    def get_crawl_state(self) -> Optional[CrawlState]:
+        self.__cur.execute("SELECT state FROM crawl_state")
+        row = self.__cur.fetchone()
+        if row is None:
+            return None
+        return loads(row[0])
 
     def has_status(self, status_id: str) -> bool:
         self.__cur.execute("SELECT id FROM status WHERE id=?", (status_id,))
         return self.__cur.fetchone() is not None
 
     def add_status(self, status: dict) -> None:
+        self.add_statuses([status])
+
+    def add_statuses(
+        self,
+        statuses: list[dict],
+        newest_status: Optional[str] = None,
+        crawl_state: Optional[CrawlState] = None,
+    ) -> None:
+        """Add a page of statuses in one transaction.
+
+        If `newest_status` or `crawl_state` are passed they are stored in the same transaction.
+        """
+        with metrics.timer("db_write_seconds"), self.__con:
+            self.__cur.executemany(
+                "INSERT INTO status(id, status, hash) VALUES(?,?,?) ON CONFLICT DO UPDATE SET status=EXCLUDED.status, hash=EXCLUDED.hash, deleted_at=NULL",
+                [
+                    (
+                        status["id"],
+                        dumps(status).decode("utf-8"),
+                        status_hash(status),
+                    )
+                    for status in statuses
+                ],
+            )
+            if self.__normalized:
+                self.__index_statuses(statuses)
+            if newest_status:
+                self.__set_newest_status(newest_status)
+            if crawl_state:
+                self.__cur.execute(
+                    "INSERT INTO crawl_state(id, state) VALUES(0, ?) ON CONFLICT DO UPDATE SET state=EXCLUDED.state",
+                    (dumps(crawl_state).decode("utf-8"),),
+                )
+
+    def refresh_statuses(self, statuses: list[dict]) -> int:
+        """Store the statuses of a page that are new or changed, returns their number.
+
+        The statuses are compared with the stored ones by `status_hash`, the
+        unchanged statuses aren't written at all.
+        """
         self.__cur.execute(
-            "INSERT INTO status(id, status) VALUES(?,?) ON CONFLICT DO UPDATE SET status=EXCLUDED.status",
-            (status["id"], dumps(status)),
+            f"SELECT id, hash, CASE WHEN hash IS NULL THEN status END, deleted_at FROM status WHERE id IN ({','.join('?' * len(statuses))})",
+            [status["id"] for status in statuses],
         )
-        self.__con.commit()
+        stored: dict[str, tuple[str, Optional[str]]] = {}
+        for status_id, hash, status, deleted_at in self.__cur.fetchall():
+            # rows stored before the hash column was added
+            stored[status_id] = (hash or status_hash(loads(status)), deleted_at)
+        changed = [
+            status
+            for status in statuses
+            if stored.get(status["id"]) != (status_hash(status), None)
+        ]
+        if changed:
+            self.add_statuses(changed)
+        return len(changed)
+
+    def mark_deleted(self, ids: set[str], since_id: Optional[str] = None) -> int:
+        """Mark the stored statuses newer than `since_id` that are not in `ids` as deleted, returns their number."""
+        cursor = self.__con.cursor()
+        cursor.execute("SELECT id FROM status WHERE deleted_at IS NULL")
+        deleted = [
+            status_id
+            for (status_id,) in cursor
+            if status_id not in ids
+            and (since_id is None or id_key(status_id) > id_key(since_id))
+        ]
+        cursor.close()
+        if deleted:
+            deleted_at = datetime.now(timezone.utc).isoformat()
+            with metrics.timer("db_write_seconds"), self.__con:
+                self.__cur.executemany(
+                    "UPDATE status SET deleted_at=? WHERE id=?",
+                    [(deleted_at, status_id) for status_id in deleted],
+                )
+        return len(deleted)
@@ -0,0 +1,319 @@
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from hashlib import sha256
+from os import remove
+from os.path import exists, getsize, join
+from typing import Iterator, Optional, TypedDict
+
+from mastodon_download.args import parser as backup_parser
+from mastodon_download.compressed import iter_statuses as iter_compressed_statuses
+from mastodon_download.mastodon import CHUNK_SIZE, Mastodon
+from mastodon_download.media import (
+    FAILED_MEDIA_FILE,
+    MediaDownloader,
+    attachment_filename,
+    attachment_urls,
+    find_attachment,
+)
+from mastodon_download.mediapolicy import (
+    SKIPPED_MEDIA_FILE,
+    MediaPolicy,
+    SkippedMedia,
+)
+from mastodon_download.mediastore import MediaStore, StoredMedia
+from mastodon_download.metrics import progress
+from mastodon_download.reader import StatusReader
+from mastodon_download.sqlite import SqliteDatabase
+
+SQLITE_HEADER = b"SQLite format 3\x00"
+PROBLEMS = {
+    "missing": "is missing",
+    "size": "has the wrong size",
+    "hash": "has the wrong hash",
+}
+
+parser = ArgumentParser("mastodon-download-toots-verify")
+parser.add_argument(
+    "archive",
+    type=str,
+    help="SQLite database, JSON or compressed JSON file written by mastodon-download-toots",
+)
+parser.add_argument(
+    "--media-output",
+    type=str,
+    required=True,
+    help="The media directory of the archive (the --media-output of the download)",
+)
+parser.add_argument(
+    "--media-store",
+    type=str,
+    help="The media store of the download, the size and hash of every attachment are compared with it",
+)
+parser.add_argument(
+    "-w",
+    "--workers",
+    type=int,
+    default=4,
+    help="Number of files checked and attachments downloaded at the same time",
+)
+parser.add_argument(
+    "--repair",
+    action="store_true",
+    help="Download the missing and corrupt attachments again",
+)
+parser.add_argument(
+    "--domain",
+    type=str,
+    help="Domain of the instance the attachments are downloaded from with --repair, the one passed to mastodon-download-toots. Required unless the archive is a sqlite database, which records it",
+)
+parser.add_argument(
+    "--account-profile",
+    type=str,
+    help="The account profile used for the download",
+)
+parser.add_argument(
+    "-c",
+    "--cache-dir",
+    type=str,
+    default=backup_parser.get_default("cache_dir"),
+)
+
+
+class MediaProblem(TypedDict):
+    attachment: dict
+    path: str
+    # whether the file is the preview of the attachment, missing files are
+    # repaired as originals
+    preview: bool
+    # missing, size or hash
+    reason: str
+    stored: Optional[StoredMedia]
+
+
+class VerifyResult(TypedDict):
+    attachments: int
+    skipped: int
+    problems: list[MediaProblem]
+
+
+def iter_archive(path: str) -> Iterator[dict]:
+    """Iterate over the statuses of a sqlite database, JSON or compressed JSON file."""
+    with open(path, "rb") as file:
+        header = file.read(len(SQLITE_HEADER))
+    if header == SQLITE_HEADER:
+        database = SqliteDatabase(path, read_only=True)
+        try:
+            for statuses in database.iter_statuses():
+                yield from statuses
+        finally:
+            database.close()
+    elif header.startswith(b"\x1f\x8b"):
+        yield from iter_compressed_statuses(path)
+    elif header.startswith(b"PK"):
+        raise Exception(
+            "Zip files can't be verified, mastodon-download-toots -z --update downloads the attachments that are missing in a zip file"
+        )
+    else:
+        with open(path, "rb") as file:
+            yield from StatusReader(file)
+
+
+def archive_instance(path: str) -> Optional[str]:
+    """The domain of the instance a sqlite database was downloaded from, None for other archives.
+
+    JSON files don't record it, the domain of their account is a different
+    instance if they were downloaded with --user.
+    """
+    with open(path, "rb") as file:
+        header = file.read(len(SQLITE_HEADER))
+    if header != SQLITE_HEADER:
+        return None
+    database = SqliteDatabase(path, read_only=True)
+    try:
+        return database.get_instance()
+    finally:
+        database.close()
+
+
+def check_file(path: str, stored: Optional[StoredMedia]) -> Optional[str]:
+    """Why the file at `path` is corrupt, None if it's fine.
+
+    Without `stored` media only empty files are found.
+    """
+    size = getsize(path)
+    if stored is None:
+        return "size" if size == 0 else None
+    if size != stored["size"]:
+        return "size"
+    h = sha256()
+    with open(path, "rb") as file:
+        while chunk := file.read(CHUNK_SIZE):
+            h.update(chunk)
+    return "hash" if h.hexdigest() != stored["hash"] else None
+
+
+def verify(
+    statuses: Iterator[dict],
+    media_output: str,
+    store: Optional[MediaStore] = None,
+    workers: int = 4,
+) -> VerifyResult:
+    """Check that the attachments of `statuses` are in `media_output` and not corrupt.
+
+    The files are checked by `workers` threads. The attachments in the
+    skipped_media.json file of the media directory are left out.
+    """
+    skipped = {
+        attachment["id"]
+        for attachment in SkippedMedia.load(
+            join(media_output, SKIPPED_MEDIA_FILE)
+        ).attachments
+    }
+    result: VerifyResult = {"attachments": 0, "skipped": 0, "problems": []}
+    seen: set[str] = set()
+    checks: deque[tuple[MediaProblem, Future[Optional[str]]]] = deque()
+
+    def collect(limit: int) -> None:
+        while len(checks) > limit:
+            problem, future = checks.popleft()
+            reason = future.result()
+            if reason:
+                problem["reason"] = reason
+                result["problems"].append(problem)
+
+    with ThreadPoolExecutor(workers) as executor:
+        for status in statuses:
+            for attachment in status["media_attachments"]:
+                if attachment["id"] in seen:
+                    continue
+                seen.add(attachment["id"])
+                result["attachments"] += 1
+                if attachment["id"] in skipped:
+                    result["skipped"] += 1
+                    continue
+                found = find_attachment(attachment, media_output)
+                if found is None:
+                    path = join(media_output, attachment_filename(attachment))
+                    result["problems"].append(
+                        {
+                            "attachment": attachment,
+                            "path": path,
+                            "preview": False,
+                            "reason": "missing",
+                            "stored": None,
+                        }
+                    )
+                    continue
+                path, preview = found
+                urls = attachment_urls(attachment, preview)
+                stored = None
+                if store:
+                    stored = next(
+                        filter(None, (store.lookup(url) for url in urls)), None
+                    )
+                problem: MediaProblem = {
+                    "attachment": attachment,
+                    "path": path,
+                    "preview": preview,
+                    "reason": "",
+                    "stored": stored,
+                }
+                checks.append((problem, executor.submit(check_file, path, stored)))
+                # only a few checks are queued, so the statuses are read as
+                # fast as the files are checked
+                collect(workers * 4)
+        collect(0)
+    return result
+
+
+def repair(
+    problems: list[MediaProblem],
+    mastodon: Mastodon,
+    media_output: str,
+    store: Optional[MediaStore] = None,
+    workers: int = 4,
+) -> MediaDownloader:
+    """Download the attachments of `problems` again with `workers` concurrent downloads.
+
+    Corrupt files are removed from the media directory and the media store
+    first, corrupt previews are downloaded as previews again. The attachments
+    that still fail are listed in failed_media.json.
+    """
+    failed_media_path = join(media_output, FAILED_MEDIA_FILE)
+    policy = MediaPolicy(
+        preview_ids={
+            problem["attachment"]["id"] for problem in problems if problem["preview"]
+        }
+    )
+    downloader = MediaDownloader(
+        mastodon,
+        media_output,
+        store=store,
+        workers=workers,
+        policy=policy,
+        failed=SkippedMedia.load(failed_media_path),
+    )
+    try:
+        for problem in problems:
+            if exists(problem["path"]):
+                remove(problem["path"])
+            if store and problem["stored"]:
+                store.discard(problem["stored"]["hash"])
+            downloader.submit(problem["attachment"])
+        downloader.close()
+    except BaseException:
+        downloader.close(abort=True)
+        raise
+    finally:
+        downloader.failed.save(failed_media_path)
+    return downloader
+
+
+def main() -> None:
+    args = parser.parse_args()
+    if not exists(args.archive):
+        raise Exception(f"Archive {args.archive} doesn't exist")
+
+    store = MediaStore(args.media_store) if args.media_store else None
+    try:
+        result = verify(
+            iter_archive(args.archive), args.media_output, store, args.workers
+        )
+        problems = result["problems"]
+        for problem in problems:
+            progress.warning(f"{problem['path']} {PROBLEMS[problem['reason']]}")
+        print(
+            f"Checked {result['attachments']} attachments: {result['attachments'] - result['skipped'] - len(problems)} ok, {len(problems)} missing or corrupt, {result['skipped']} skipped by the media options"
+        )
+        if not problems or not args.repair:
+            if problems:
+                raise SystemExit(1)
+            return
+
+        domain = args.domain or archive_instance(args.archive)
+        if not domain:
+            raise Exception(
+                "The archive doesn't record the instance it was downloaded from, pass --domain"
+            )
+        mastodon = Mastodon.from_instance_domain(
+            domain, args.cache_dir, account_profile=args.account_profile
+        )
+        if not mastodon.authorized:
+            raise Exception(
+                "Not authorized, run mastodon-download-toots once with the same domain and account profile to login"
+            )
+        downloader = repair(problems, mastodon, args.media_output, store, args.workers)
+    finally:
+        if store:
+            store.close()
+    failed = {attachment["id"] for attachment in downloader.failed.attachments}
+    repaired = sum(problem["attachment"]["id"] not in failed for problem in problems)
+    progress.message(
+        f"Repaired {repaired} of {len(problems)} attachments, downloaded {downloader.downloaded} attachments ({downloader.downloaded_bytes} bytes)"
+    )
+    if len(downloader.failed):
+        progress.warning(
+            f"{len(downloader.failed)} attachments couldn't be downloaded, they are listed in {join(args.media_output, FAILED_MEDIA_FILE)}"
+        )
+        raise SystemExit(1)
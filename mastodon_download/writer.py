@@ -0,0 +1,46 @@
+from typing import IO, Optional
+
+from mastodon_download.serializer import dumps_document
+
+
+class StatusWriter:
+    """Write statuses page by page as one JSON document.
+
+    The output is exactly what `json.dumps` would produce for the list of all
+    statuses, or for `{"account": ..., "statuses": [...]}` with `optimize_json`,
+    without having to keep all statuses in memory.
+    """
+
+    def __init__(
+        self, file: IO[bytes], optimize_json: bool = False, count: int = 0
+    ) -> None:
+        """Pass the number of statuses already in `file` as `count` to continue writing it."""
+        self.__file = file
+        self.__optimize_json = optimize_json
+        self.count = count
+
+    def write(self, statuses: list[dict]) -> None:
+        for status in statuses:
+            if self.count == 0:
+                self.__write_start(status)
+            else:
+                self.__file.write(b", ")
+            if self.__optimize_json:
+                status = {k: v for k, v in status.items() if k != "account"}
+            self.__file.write(dumps_document(status))
+            self.count += 1
+
+    def close(self) -> None:
+        """Finish the JSON document, the underlying file is not closed."""
+        if self.count == 0:
+            self.__write_start(None)
+        self.__file.write(b"]}" if self.__optimize_json else b"]")
+
+    def __write_start(self, first_status: Optional[dict]) -> None:
+        if self.__optimize_json:
+            account = first_status["account"] if first_status else None
+            self.__file.write(
+                b'{"account": ' + dumps_document(account) + b', "statuses": ['
+            )
+        else:
+            self.__file.write(b"[")
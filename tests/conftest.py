@@ -0,0 +1,78 @@
+import os
+import subprocess
+import sys
+from os.path import abspath, dirname, join
+from typing import Iterator, Optional
+
+import pytest
+
+REPOSITORY = dirname(dirname(abspath(__file__)))
+sys.path.insert(0, join(REPOSITORY, "benchmarks"))
+
+from mock_server import ACCOUNT, MockInstance, MockServer  # noqa: E402
+
+# runs the tool and kills the process without any cleanup, like SIGKILL, once
+# the given number of zip members are opened for writing
+KILL_AFTER_MEMBERS = """
+import os, sys, zipfile
+limit = int(sys.argv.pop(1))
+original_open = zipfile.ZipFile.open
+opened = 0
+def open(self, name, mode="r", *args, **kwargs):
+    global opened
+    if mode == "w":
+        opened += 1
+        if opened > limit:
+            os._exit(9)
+    return original_open(self, name, mode, *args, **kwargs)
+zipfile.ZipFile.open = open
+from mastodon_download import main
+sys.argv[0] = "mastodon-download-toots"
+main()
+"""
+
+
+@pytest.fixture
+def instance() -> MockInstance:
+    return MockInstance(statuses=200)
+
+
+@pytest.fixture
+def server(instance: MockInstance) -> Iterator[MockServer]:
+    server = MockServer(instance)
+    server.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def run_tool(
+    cwd: str,
+    *args: str,
+    kill_after_members: Optional[int] = None,
+    check: bool = True,
+) -> subprocess.CompletedProcess:
+    """Run mastodon-download-toots in `cwd` with the cache directory cache.
+
+    With `kill_after_members` the process is killed while it opens that many
+    plus one members of a zip file.
+    """
+    command = (
+        [sys.executable, "-c", KILL_AFTER_MEMBERS, str(kill_after_members)]
+        if kill_after_members is not None
+        else [sys.executable, "-m", "mastodon_download"]
+    )
+    result = subprocess.run(
+        [*command, "-c", "cache", "--progress", "none", *args],
+        cwd=cwd,
+        env={**os.environ, "PYTHONPATH": REPOSITORY},
+        # the authorization code asked for on the first run
+        input=b"code\n",
+        capture_output=True,
+        timeout=120,
+    )
+    if check and result.returncode != 0:
+        raise AssertionError(
+            f"mastodon-download-toots {' '.join(args)} failed with {result.returncode}:\n{result.stderr.decode()}"
+        )
+    return result
@@ -0,0 +1,65 @@
+import asyncio
+
+import pytest
+
+from mastodon_download.aio import AsyncMastodon
+from mastodon_download.crawl import crawl
+from mastodon_download.credentials import credential_store
+from tests.test_media import attachment
+from tests.test_media import client as sync_client
+
+pytest.importorskip("httpx")
+
+
+def client(cache_dir: str, url: str) -> AsyncMastodon:
+    credential_store(cache_dir).set_token(
+        url, None, {"access_token": "token", "token_type": "Bearer"}
+    )
+    return AsyncMastodon(url, cache_dir)
+
+
+def test_crawl_yields_the_pages_of_the_sync_crawl(tmp_path, server, instance):
+    async def pages() -> list[list[dict]]:
+        async with client(str(tmp_path), server.url) as mastodon:
+            account = await mastodon.get_me()
+            return [page async for page in mastodon.crawl(account["id"])]
+
+    pages = asyncio.run(pages())
+    mastodon = sync_client(str(tmp_path), server.url)
+    assert pages == list(crawl(mastodon, mastodon.get_me()["id"]))
+    assert sum(len(page) for page in pages) == instance.status_count
+
+
+def test_iter_statuses_pages_forward_from_min_id(tmp_path, server, instance):
+    ids = [status["id"] for status in instance.page(server.url, 200, None, None, None)]
+
+    async def statuses() -> list[dict]:
+        async with client(str(tmp_path), server.url) as mastodon:
+            account = await mastodon.get_me()
+            return [
+                status
+                async for status in mastodon.iter_statuses(
+                    account["id"], min_id=ids[50]
+                )
+            ]
+
+    # pages forward start with the oldest page, its statuses are newest first
+    assert sorted(status["id"] for status in asyncio.run(statuses())) == sorted(
+        ids[:50]
+    )
+
+
+def test_download_attachment(tmp_path, server, instance):
+    async def download() -> None:
+        async with client(str(tmp_path), server.url) as mastodon:
+            with open(tmp_path / "1.png", "wb") as file:
+                response = await mastodon.download_attachment(
+                    attachment(server.url, "1")["url"], file
+                )
+            assert response is not None and not response["not_modified"]
+            with open(tmp_path / "2.png", "wb") as file:
+                missing = f"{server.url}/missing/2.png"
+                assert await mastodon.download_attachment(missing, file) is None
+
+    asyncio.run(download())
+    assert (tmp_path / "1.png").stat().st_size == instance.media_size
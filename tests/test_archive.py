@@ -0,0 +1,77 @@
+from io import BytesIO
+from zipfile import ZIP_STORED, ZipFile
+
+from mastodon_download.archive import (
+    TailBackup,
+    extract_member,
+    is_intact,
+    remove_member,
+    write_member,
+)
+
+
+def write(zipfile: ZipFile, name: str, data: bytes) -> None:
+    write_member(zipfile, name, BytesIO(data), len(data), ZIP_STORED)
+
+
+def test_append_and_remove(tmp_path):
+    path = tmp_path / "out.zip"
+    with ZipFile(path, "x") as zipfile:
+        write(zipfile, "media/1.png", b"1" * 1000)
+        write(zipfile, "statuses.json", b"[]")
+
+    with ZipFile(path, "a") as zipfile:
+        extracted = extract_member(zipfile, "statuses.json")
+        assert extracted is not None
+        info, file = extracted
+        assert file.read() == b"[]"
+        assert extract_member(zipfile, "missing.json") is None
+        remove_member(zipfile, info)
+        write(zipfile, "media/2.png", b"2" * 1000)
+        write(zipfile, "statuses.json", b"[{}]")
+
+    with ZipFile(path) as zipfile:
+        assert zipfile.testzip() is None
+        assert zipfile.namelist() == ["media/1.png", "media/2.png", "statuses.json"]
+        assert zipfile.read("statuses.json") == b"[{}]"
+        assert zipfile.read("media/1.png") == b"1" * 1000
+
+
+def test_tail_backup_restores_killed_append(tmp_path):
+    path = tmp_path / "out.zip"
+    with ZipFile(path, "x") as zipfile:
+        write(zipfile, "media/1.png", b"1" * 1000)
+        write(zipfile, "statuses.json", b"[]")
+    with open(path, "rb") as file:
+        original = file.read()
+
+    tail = TailBackup(str(tmp_path), str(path))
+    zipfile = ZipFile(path, "a")
+    info = zipfile.getinfo("statuses.json")
+    remove_member(zipfile, info)
+    tail.save(zipfile.start_dir)
+    with zipfile.open("media/2.png", "w") as member:
+        member.write(b"2" * 5000)
+    # the process is killed before the central directory is written
+    zipfile.fp.flush()
+    assert not is_intact(str(path))
+
+    assert tail.restore()
+    with open(path, "rb") as file:
+        assert file.read() == original
+    assert not tail.restore()
+
+
+def test_tail_backup_keeps_closed_archive(tmp_path):
+    path = tmp_path / "out.zip"
+    with ZipFile(path, "x") as zipfile:
+        write(zipfile, "statuses.json", b"[]")
+
+    tail = TailBackup(str(tmp_path), str(path))
+    with ZipFile(path, "a") as zipfile:
+        tail.save(zipfile.start_dir)
+        write(zipfile, "media/1.png", b"1" * 1000)
+    # killed after the archive was closed, before the copy was removed
+    assert not tail.restore()
+    with ZipFile(path) as zipfile:
+        assert zipfile.namelist() == ["statuses.json", "media/1.png"]
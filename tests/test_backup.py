@@ -0,0 +1,109 @@
+import json
+import sqlite3
+from datetime import datetime
+from os import listdir
+from os.path import getsize
+from urllib.parse import urlparse
+from zipfile import ZipFile
+
+from tests.conftest import ACCOUNT, run_tool
+
+
+def test_json(tmp_path, server, instance):
+    run_tool(str(tmp_path), "-o", "out.json", server.url)
+    with open(tmp_path / "out.json") as file:
+        statuses = json.load(file)
+    assert len(statuses) == instance.status_count
+    ids = [int(status["id"]) for status in statuses]
+    assert ids == sorted(ids, reverse=True)
+
+
+def test_media_directory(tmp_path, server, instance):
+    instance.media = 2
+    instance.media_size = 10000
+    run_tool(
+        str(tmp_path),
+        "-m",
+        "--media-output",
+        "media",
+        "--media-workers",
+        "8",
+        "--media-host-concurrency",
+        "4",
+        "-o",
+        "out.json",
+        server.url,
+    )
+    files = listdir(tmp_path / "media")
+    assert len(files) == 2 * instance.status_count
+    assert all(getsize(tmp_path / "media" / name) == 10000 for name in files)
+    assert instance.requests["media"] == 2 * instance.status_count
+
+
+def test_zip(tmp_path, server, instance):
+    instance.media = 1
+    run_tool(str(tmp_path), "-z", "-o", "out.zip", server.url)
+    with ZipFile(tmp_path / "out.zip") as zipfile:
+        assert zipfile.testzip() is None
+        statuses = json.loads(zipfile.read("statuses.json"))
+        media = [name for name in zipfile.namelist() if name.startswith("media/")]
+    assert len(statuses) == instance.status_count
+    assert len(media) == instance.status_count
+
+
+def test_sqlite_incremental(tmp_path, server, instance):
+    run_tool(str(tmp_path), "-s", "-o", "out.sqlite", server.url)
+    instance.add_statuses(30)
+    instance.reset_counters()
+    run_tool(str(tmp_path), "-s", "-o", "out.sqlite", server.url)
+    assert instance.statuses_sent == 30
+
+    con = sqlite3.connect(tmp_path / "out.sqlite")
+    assert con.execute("SELECT count(*) FROM status").fetchone()[0] == 230
+    con.close()
+
+
+def test_sqlite_incremental_requests(tmp_path, server, instance):
+    statuses_path = f"/api/v1/accounts/{ACCOUNT['id']}/statuses"
+    run_tool(str(tmp_path), "-s", "-o", "out.sqlite", server.url)
+    instance.add_statuses(39)
+    instance.reset_counters()
+    run_tool(str(tmp_path), "-s", "-o", "out.sqlite", server.url)
+    # a short page is the newest page
+    assert instance.requests[statuses_path] == 1
+
+    # a full newest page can only be told apart from an older page by the
+    # empty page after it
+    instance.add_statuses(80)
+    instance.reset_counters()
+    run_tool(str(tmp_path), "-s", "-o", "out.sqlite", server.url)
+    assert instance.requests[statuses_path] == 3
+    assert instance.statuses_sent == 80
+
+
+def test_json_progress(tmp_path, server, instance):
+    # logs in first, the login prompt isn't reported as JSON
+    run_tool(str(tmp_path), "-o", "first.json", server.url)
+    result = run_tool(str(tmp_path), "--progress", "json", "-o", "out.json", server.url)
+    assert b"\033" not in result.stdout
+    events = [json.loads(line) for line in result.stdout.splitlines()]
+    assert events[-1]["event"] == "done"
+    assert len([event for event in events if event["event"] == "page"]) == 5
+    assert any(
+        event["message"].startswith("Reused connections")
+        for event in events
+        if event["event"] == "message"
+    )
+
+
+def test_default_names_use_the_host_of_an_url(tmp_path, server, instance):
+    instance.media = 1
+    run_tool(str(tmp_path), "-m", server.url)
+    host = urlparse(server.url).netloc
+    date = datetime.now().strftime("%Y-%m-%d")
+    assert sorted(listdir(tmp_path)) == [
+        f"bench_{host}_{date}.json",
+        f"bench_{host}_media",
+        "cache",
+    ]
+    assert len(listdir(tmp_path / f"bench_{host}_media")) == instance.status_count
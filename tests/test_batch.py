@@ -0,0 +1,63 @@
+import os
+import sqlite3
+import subprocess
+import sys
+from time import perf_counter
+
+from mastodon_download.credentials import credential_store
+from tests.conftest import REPOSITORY
+
+
+def test_accounts_share_the_rate_limit(tmp_path, server, instance):
+    instance.add_statuses(1800)
+    os.mkdir(tmp_path / "cache")
+    store = credential_store(str(tmp_path / "cache"))
+    for profile in ("a", "b"):
+        store.set_token(
+            server.url, profile, {"access_token": "token", "token_type": "Bearer"}
+        )
+    with open(tmp_path / "batch.toml", "w") as file:
+        file.write(f"""cache_dir = "cache"
+
+[instances."{server.url}"]
+rate_limit = 50
+
+[[accounts]]
+domain = "{server.url}"
+account_profile = "a"
+sync_sqlite = true
+output = "a.sqlite"
+
+[[accounts]]
+domain = "{server.url}"
+account_profile = "b"
+sync_sqlite = true
+output = "b.sqlite"
+""")
+
+    start = perf_counter()
+    subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "from mastodon_download.batch import main; main()",
+            "batch.toml",
+        ],
+        cwd=tmp_path,
+        env={**os.environ, "PYTHONPATH": REPOSITORY},
+        capture_output=True,
+        check=True,
+        timeout=120,
+    )
+    seconds = perf_counter() - start
+
+    for output in ("a.sqlite", "b.sqlite"):
+        con = sqlite3.connect(tmp_path / output)
+        assert con.execute("SELECT count(*) FROM status").fetchone()[0] == 2000
+        con.close()
+    requests = sum(
+        count for path, count in instance.requests.items() if path.startswith("/api/")
+    )
+    assert requests > 100
+    # the requests of both accounts are spaced by 20ms together
+    assert seconds > (requests - 1) / 50
@@ -0,0 +1,27 @@
+from os.path import exists
+
+from mastodon_download.checkpoint import Checkpoint, CrawlState
+
+
+def test_save_load_remove(tmp_path):
+    checkpoint = Checkpoint(str(tmp_path), "mastodon.example 1 zip")
+    assert checkpoint.load() is None
+    state: CrawlState = {
+        "output": "out.zip",
+        "max_id": "100",
+        "page": 3,
+        "status_count": 80,
+        "newest_status": "200",
+        "statuses_offset": 1234,
+        "pending_media": [{"id": "1"}],
+    }
+    checkpoint.save(state)
+    with open(checkpoint.spool_path, "wb") as file:
+        file.write(b"[")
+    assert checkpoint.load() == state
+    # every key has its own files
+    assert Checkpoint(str(tmp_path), "mastodon.example 2 zip").load() is None
+
+    checkpoint.remove()
+    assert checkpoint.load() is None
+    assert not exists(checkpoint.spool_path)
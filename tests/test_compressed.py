@@ -0,0 +1,68 @@
+import gzip
+import json
+
+from mastodon_download.compressed import (
+    CompressedStatusWriter,
+    find_status,
+    index_path,
+    iter_statuses,
+    load_index,
+)
+
+
+def pages(count: int, size: int = 40) -> list[list[dict]]:
+    statuses = [
+        {"id": str(1000 + i), "content": f"<p>status {i} é</p>"}
+        for i in reversed(range(count))
+    ]
+    return [statuses[i : i + size] for i in range(0, count, size)]
+
+
+def write(path: str, pages: list[list[dict]]) -> None:
+    with open(path, "wb") as file, open(index_path(path), "wb") as index_file:
+        writer = CompressedStatusWriter(file, index_file)
+        for page in pages:
+            writer.write(page)
+        writer.close()
+
+
+def test_find_status_reads_single_pages(tmp_path):
+    path = str(tmp_path / "statuses.ndjson.gz")
+    write(path, pages(100))
+
+    index = load_index(path)
+    assert [(entry["max_id"], entry["min_id"]) for entry in index] == [
+        ("1099", "1060"),
+        ("1059", "1020"),
+        ("1019", "1000"),
+    ]
+    assert find_status(path, "1042", index) == {
+        "id": "1042",
+        "content": "<p>status 42 é</p>",
+    }
+    assert find_status(path, "1100") is None
+    with gzip.open(path) as file:
+        assert [json.loads(line)["id"] for line in file] == [
+            status["id"] for page in pages(100) for status in page
+        ]
+    assert len(list(iter_statuses(path))) == 100
+
+
+def test_resume_drops_index_entries_behind_the_offset(tmp_path):
+    path = str(tmp_path / "statuses.ndjson.gz")
+    first, second, third = pages(100)
+    write(path, [first, second, third])
+    offset = load_index(path)[1]["offset"]
+
+    with open(path, "r+b") as file, open(index_path(path), "r+b") as index_file:
+        file.truncate(offset)
+        file.seek(offset)
+        writer = CompressedStatusWriter(file, index_file, count=len(first))
+        writer.write(second)
+        writer.write(third)
+        assert writer.count == 100
+
+    assert len(load_index(path)) == 3
+    assert [status["id"] for status in iter_statuses(path)] == [
+        status["id"] for page in (first, second, third) for status in page
+    ]
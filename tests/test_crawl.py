@@ -0,0 +1,48 @@
+from typing import Optional
+
+from mastodon_download.crawl import crawl, crawl_parallel
+
+
+class FakeMastodon:
+    """Serve the statuses of one account like the statuses API, newest first."""
+
+    def __init__(self, ids: list[int]) -> None:
+        self.statuses = [{"id": str(i)} for i in sorted(ids, reverse=True)]
+
+    def get_user_statuses(
+        self,
+        account_id: str,
+        limit: int,
+        max_id: Optional[str] = None,
+        min_id: Optional[str] = None,
+        since_id: Optional[str] = None,
+    ) -> list[dict]:
+        statuses = [
+            status
+            for status in self.statuses
+            if (max_id is None or int(status["id"]) < int(max_id))
+            and (since_id is None or int(status["id"]) > int(since_id))
+            and (min_id is None or int(status["id"]) > int(min_id))
+        ]
+        # min_id returns the statuses directly after it
+        return statuses[-limit:] if min_id is not None else statuses[:limit]
+
+
+def ids(pages) -> list[str]:
+    return [status["id"] for page in pages for status in page]
+
+
+def test_crawl_parallel_yields_the_order_of_crawl():
+    # unevenly spread ids so the windows contain different numbers of statuses
+    mastodon = FakeMastodon([10**6 + i * i * 7 for i in range(500)])
+    expected = ids(crawl(mastodon, "1"))  # type: ignore[arg-type]
+    assert len(expected) == 500
+
+    for workers in (1, 3, 8):
+        assert ids(crawl_parallel(mastodon, "1", workers)) == expected  # type: ignore[arg-type]
+
+    max_id = expected[100]
+    assert (
+        ids(crawl_parallel(mastodon, "1", 4, max_id=max_id))  # type: ignore[arg-type]
+        == expected[101:]
+    )
@@ -0,0 +1,64 @@
+import json
+
+import requests
+
+from mastodon_download.credentials import CredentialStore
+from mastodon_download.mastodon import Mastodon
+from mastodon_download.metrics import metrics
+
+INSTANCE_URL = "https://mastodon.example"
+
+
+class FakeSession(requests.Session):
+    """Answers every request with an account and records the Authorization headers."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.authorization: list[str] = []
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        self.authorization.append(kwargs["headers"].get("Authorization"))
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = json.dumps(
+            {"id": "1", "username": "user", "acct": "user"}
+        ).encode("utf-8")
+        return response
+
+
+def test_token_file_is_read_once(tmp_path):
+    # written by a store of another process
+    CredentialStore(str(tmp_path)).set_token(
+        INSTANCE_URL, None, {"access_token": "token", "token_type": "Bearer"}
+    )
+    reads = metrics.snapshot().get("credential_file_reads", 0)
+
+    session = FakeSession()
+    for _ in range(2):
+        mastodon = Mastodon(INSTANCE_URL, str(tmp_path), session=session)
+        assert mastodon.authorized
+        for _ in range(3):
+            assert mastodon.get_me()["username"] == "user"
+
+    assert session.authorization == ["Bearer token"] * 6
+    assert metrics.snapshot()["credential_file_reads"] == reads + 1
+
+
+def test_profile_token_is_migrated_from_the_instance_file(tmp_path):
+    old_token = {"access_token": "old", "token_type": "Bearer"}
+    # written before tokens were stored per account profile
+    CredentialStore(str(tmp_path)).set_token(INSTANCE_URL, None, old_token)
+
+    assert CredentialStore(str(tmp_path)).token(INSTANCE_URL, "work") == old_token
+    # a later login without profile doesn't change the token of the profile
+    CredentialStore(str(tmp_path)).set_token(
+        INSTANCE_URL, None, {"access_token": "new", "token_type": "Bearer"}
+    )
+    store = CredentialStore(str(tmp_path))
+    assert store.token(INSTANCE_URL, "work") == old_token
+    assert store.token(INSTANCE_URL, None) == {
+        "access_token": "new",
+        "token_type": "Bearer",
+    }
+    assert CredentialStore(str(tmp_path)).token(INSTANCE_URL, "other") is not None
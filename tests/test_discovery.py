@@ -0,0 +1,40 @@
+import json
+
+import requests
+
+from mastodon_download.mastodon import Mastodon
+
+
+class FakeSession(requests.Session):
+    """Answers the discovery requests of mastodon.example and counts them."""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.count = 0
+
+    def request(self, method, url, *args, **kwargs) -> requests.Response:
+        self.count += 1
+        body: dict = {}
+        if url.endswith("/.well-known/nodeinfo"):
+            body = {"links": [{"href": "https://mastodon.example/nodeinfo/2.0"}]}
+        elif url.endswith("/nodeinfo/2.0"):
+            body = {"software": {"name": "mastodon"}}
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = json.dumps(body).encode("utf-8")
+        return response
+
+
+def test_discovery_is_cached(tmp_path):
+    session = FakeSession()
+    url = Mastodon.discover("mastodon.example", session, str(tmp_path))
+    assert url == "https://mastodon.example"
+    requests_made = session.count
+    assert requests_made > 0
+
+    assert Mastodon.discover("mastodon.example", session, str(tmp_path)) == url
+    assert session.count == requests_made
+    # without the cache the instance is discovered again
+    Mastodon.discover("mastodon.example", session, str(tmp_path), ttl=0)
+    assert session.count == 2 * requests_made
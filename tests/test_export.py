@@ -0,0 +1,87 @@
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+from zipfile import ZipFile
+
+from mastodon_download.media import attachment_filename
+from mastodon_download.sqlite import SqliteDatabase
+from tests.conftest import REPOSITORY, MockInstance
+
+
+def run_export(cwd: str, *args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "from mastodon_download.export import main; main()",
+            *args,
+        ],
+        cwd=cwd,
+        env={**os.environ, "PYTHONPATH": REPOSITORY},
+        capture_output=True,
+        check=True,
+        timeout=120,
+    )
+
+
+def test_export_doesnt_migrate_the_database(tmp_path, instance):
+    # a database of the first versions
+    con = sqlite3.connect(tmp_path / "old.sqlite")
+    con.execute("CREATE TABLE status(id TEXT NOT NULL PRIMARY KEY, status TEXT)")
+    con.execute("CREATE TABLE account(id TEXT NOT NULL PRIMARY KEY, account TEXT)")
+    con.executemany(
+        "INSERT INTO status VALUES(?, ?)",
+        [
+            (status["id"], json.dumps(status))
+            for status in instance.page(
+                "https://mastodon.example", 50, None, None, None
+            )
+        ],
+    )
+    con.commit()
+    con.close()
+    with open(tmp_path / "old.sqlite", "rb") as file:
+        before = file.read()
+
+    run_export(str(tmp_path), "-o", "out.json", "old.sqlite")
+
+    with open(tmp_path / "old.sqlite", "rb") as file:
+        assert file.read() == before
+    with open(tmp_path / "out.json") as file:
+        assert len(json.load(file)) == 50
+
+
+def test_export_includes_previews(tmp_path):
+    statuses = MockInstance(statuses=10, media=1).page(
+        "https://mastodon.example", 10, None, None, None
+    )
+    database = SqliteDatabase(str(tmp_path / "toots.sqlite"))
+    database.add_statuses(statuses)
+    database.close()
+    attachments = [
+        attachment for status in statuses for attachment in status["media_attachments"]
+    ]
+    media = tmp_path / "media"
+    media.mkdir()
+    # the original of the first attachment, the preview of the second one
+    (media / attachment_filename(attachments[0])).write_bytes(b"original")
+    (media / attachment_filename(attachments[1], preview=True)).write_bytes(b"preview")
+
+    run_export(
+        str(tmp_path),
+        "-z",
+        "--media-output",
+        "media",
+        "-o",
+        "out.zip",
+        "toots.sqlite",
+    )
+
+    with ZipFile(tmp_path / "out.zip") as zipfile:
+        assert zipfile.read(f"media/{attachments[0]['id']}.png") == b"original"
+        assert zipfile.read(f"media/{attachments[1]['id']}_preview.png") == b"preview"
+        assert (
+            len([name for name in zipfile.namelist() if name.startswith("media/")]) == 2
+        )
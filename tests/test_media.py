@@ -0,0 +1,97 @@
+from threading import Event
+from time import perf_counter, sleep
+from zipfile import ZipFile
+
+from mastodon_download import media
+from mastodon_download.credentials import credential_store
+from mastodon_download.mastodon import Mastodon
+from mastodon_download.media import MediaDownloader
+from mastodon_download.mediastore import MediaStore
+
+
+def attachment(url: str, id: str) -> dict:
+    return {
+        "id": id,
+        "type": "image",
+        "url": f"{url}/media/{id}.png",
+        "remote_url": None,
+        "preview_url": None,
+    }
+
+
+def client(cache_dir: str, url: str) -> Mastodon:
+    credential_store(cache_dir).set_token(
+        url, None, {"access_token": "token", "token_type": "Bearer"}
+    )
+    return Mastodon(url, cache_dir)
+
+
+def test_zip_write_doesnt_block_submit(tmp_path, server, monkeypatch):
+    writing = Event()
+    copyfileobj = media.copyfileobj
+
+    def slow_copyfileobj(source, destination) -> None:
+        writing.set()
+        sleep(1)
+        copyfileobj(source, destination)
+
+    monkeypatch.setattr(media, "copyfileobj", slow_copyfileobj)
+    with ZipFile(tmp_path / "out.zip", "x") as zipfile:
+        downloader = MediaDownloader(
+            client(str(tmp_path), server.url), "media", zipfile=zipfile, workers=2
+        )
+        downloader.submit(attachment(server.url, "1"))
+        assert writing.wait(5)
+        # while the first attachment is copied into the archive
+        start = perf_counter()
+        downloader.submit(attachment(server.url, "2"))
+        assert len(downloader.pending) >= 1
+        assert perf_counter() - start < 0.5
+        downloader.close()
+    with ZipFile(tmp_path / "out.zip") as zipfile:
+        assert sorted(zipfile.namelist()) == ["media/1.png", "media/2.png"]
+
+
+# nothing listens on port 1, the connection is refused
+UNREACHABLE_URL = "http://127.0.0.1:1/media/remote.png"
+
+
+def remote_attachment(url: str, id: str) -> dict:
+    return {**attachment(url, id), "remote_url": UNREACHABLE_URL}
+
+
+def test_falls_back_to_the_next_url(tmp_path, server):
+    (tmp_path / "media").mkdir()
+    downloader = MediaDownloader(
+        client(str(tmp_path), server.url), str(tmp_path / "media")
+    )
+    downloader.submit(remote_attachment(server.url, "1"))
+    downloader.close()
+    assert (tmp_path / "media" / "1.png").stat().st_size == 64 * 1024
+    assert len(downloader.failed) == 0
+
+
+def test_falls_back_to_the_next_url_with_store(tmp_path, server):
+    (tmp_path / "media").mkdir()
+    store = MediaStore(str(tmp_path / "store"))
+    downloader = MediaDownloader(
+        client(str(tmp_path), server.url), str(tmp_path / "media"), store=store
+    )
+    downloader.submit(remote_attachment(server.url, "1"))
+    downloader.close()
+    store.close()
+    assert (tmp_path / "media" / "1.png").stat().st_size == 64 * 1024
+    assert len(downloader.failed) == 0
+
+
+def test_fails_if_every_url_fails(tmp_path, server):
+    (tmp_path / "media").mkdir()
+    downloader = MediaDownloader(
+        client(str(tmp_path), server.url), str(tmp_path / "media")
+    )
+    failing = {**remote_attachment(server.url, "1"), "url": UNREACHABLE_URL}
+    downloader.submit(failing)
+    downloader.submit(attachment(server.url, "2"))
+    downloader.close()
+    assert [a["id"] for a in downloader.failed.attachments] == ["1"]
+    assert sorted(path.name for path in (tmp_path / "media").iterdir()) == ["2.png"]
@@ -0,0 +1,77 @@
+import json
+from os import listdir
+from typing import IO, Callable, Optional
+
+from mastodon_download.media import MediaDownloader
+from mastodon_download.mediapolicy import MediaPolicy
+
+
+class FakeMastodon:
+    """Serve attachments of 100 bytes, with or without a Content-Length."""
+
+    def __init__(self, content_length: bool) -> None:
+        self.content_length = content_length
+        self.requests: list[str] = []
+
+    def download_attachment(
+        self,
+        url: str,
+        file: IO[bytes],
+        etag: Optional[str] = None,
+        last_modified: Optional[str] = None,
+        check_size: Optional[Callable[[Optional[int]], None]] = None,
+    ) -> dict:
+        self.requests.append(url)
+        if check_size:
+            check_size(100 if self.content_length else None)
+        file.write(b"x" * 100)
+        return {"not_modified": False, "etag": None, "last_modified": None}
+
+
+def attachment(id: str) -> dict:
+    return {
+        "id": id,
+        "type": "image",
+        "url": f"https://files.example/{id}.png",
+        "remote_url": None,
+        "preview_url": f"https://files.example/{id}_small.png",
+    }
+
+
+def download(tmp_path, mastodon: FakeMastodon, budget: int) -> MediaDownloader:
+    downloader = MediaDownloader(
+        mastodon,  # type: ignore[arg-type]
+        str(tmp_path),
+        workers=1,
+        policy=MediaPolicy(budget=budget),
+    )
+    for id in ("1", "2", "3", "4"):
+        downloader.submit(attachment(id))
+    downloader.close()
+    return downloader
+
+
+def test_budget_is_checked_against_the_content_length(tmp_path):
+    mastodon = FakeMastodon(content_length=True)
+    downloader = download(tmp_path, mastodon, budget=250)
+
+    assert sorted(listdir(tmp_path)) == ["1.png", "2.png"]
+    assert downloader.downloaded_bytes == 200
+    # the body of a rejected response isn't read
+    assert len(mastodon.requests) == 4
+    assert [
+        (entry["attachment"]["id"], entry["reason"])
+        for entry in json.loads(downloader.skipped.to_json())
+    ] == [("3", "budget"), ("4", "budget")]
+
+
+def test_downloads_without_content_length_are_counted_afterwards(tmp_path):
+    mastodon = FakeMastodon(content_length=False)
+    downloader = download(tmp_path, mastodon, budget=250)
+
+    # the third download starts while the budget isn't used up yet
+    assert sorted(listdir(tmp_path)) == ["1.png", "2.png", "3.png"]
+    assert mastodon.requests == [f"https://files.example/{id}.png" for id in "1234"]
+    assert [
+        entry["attachment"]["id"] for entry in json.loads(downloader.skipped.to_json())
+    ] == ["4"]
@@ -0,0 +1,69 @@
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from threading import Thread
+from time import perf_counter
+from typing import Callable
+
+from mastodon_download.credentials import credential_store
+from mastodon_download.mastodon import Mastodon
+from mastodon_download.ratelimit import RateLimits, TokenBucket
+
+
+def test_interval_is_shared_per_host():
+    limits = RateLimits(0.1)
+    assert limits.host("mastodon.example") is limits.host("mastodon.example")
+    assert limits.host("mastodon.example") is not limits.host("files.example")
+    # the X-RateLimit buckets don't space the requests
+    assert limits.bucket("api ").reserve() == 0
+    assert limits.bucket("api ").reserve() == 0
+
+    host = limits.host("mastodon.example")
+    waits = [host.reserve() for _ in range(5)]
+    assert waits[0] == 0
+    assert waits[-1] > 0.35
+    assert limits.host("files.example").reserve() == 0
+
+
+def test_update_ignores_invalid_headers():
+    bucket = TokenBucket()
+    reset = (datetime.now(timezone.utc) + timedelta(minutes=5)).isoformat()
+    for remaining in ("", "many", "1.5"):
+        bucket.update({"X-RateLimit-Remaining": remaining, "X-RateLimit-Reset": reset})
+    bucket.update({"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": "tomorrow"})
+    assert bucket.reserve() == 0
+
+    bucket.update({"X-RateLimit-Remaining": "0", "X-RateLimit-Reset": reset})
+    assert bucket.reserve() > 200
+
+
+def client(cache_dir: str, url: str, limits: RateLimits, profile=None) -> Mastodon:
+    credential_store(cache_dir).set_token(
+        url, profile, {"access_token": "token", "token_type": "Bearer"}
+    )
+    return Mastodon(url, cache_dir, account_profile=profile, rate_limits=limits)
+
+
+def timed_requests(*requests: Callable[[], object]) -> float:
+    """Send the requests in one thread each, returns the seconds until all are done."""
+    start = perf_counter()
+    threads = [Thread(target=request) for request in requests]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return perf_counter() - start
+
+
+def test_api_and_media_share_the_interval(tmp_path, server):
+    mastodon = client(str(tmp_path), server.url, RateLimits(0.05))
+
+    def api() -> None:
+        for _ in range(10):
+            mastodon.get_user_statuses("1", limit=1)
+
+    def media() -> None:
+        for _ in range(10):
+            mastodon.download_attachment(f"{server.url}/media/1.png", BytesIO())
+
+    # 20 requests to the same host, 50ms apart
+    assert timed_requests(api, media) > 0.9
@@ -0,0 +1,79 @@
+import json
+import sys
+from typing import Optional
+
+import pytest
+
+import mastodon_download
+
+ACCOUNT = {"id": "1", "username": "bench", "acct": "bench"}
+
+
+class Interrupted(Exception):
+    pass
+
+
+class FakeMastodon:
+    """Serves the statuses of one account from memory, newest first."""
+
+    def __init__(self, count: int, fail_at_request: Optional[int] = None) -> None:
+        self.statuses = [
+            {"id": str(1000 + i), "account": ACCOUNT, "media_attachments": []}
+            for i in reversed(range(count))
+        ]
+        self.fail_at_request = fail_at_request
+        self.requests = 0
+        self.authorized = True
+
+    def from_instance_domain(self, *args, **kwargs) -> "FakeMastodon":
+        return self
+
+    def get_me(self) -> dict:
+        return ACCOUNT
+
+    def get_user_statuses(
+        self,
+        account_id: str,
+        max_id: Optional[str] = None,
+        limit: Optional[int] = None,
+        min_id: Optional[str] = None,
+        since_id: Optional[str] = None,
+    ) -> list[dict]:
+        self.requests += 1
+        if self.requests == self.fail_at_request:
+            raise Interrupted()
+        limit = limit or 20
+        statuses = [
+            status
+            for status in self.statuses
+            if (max_id is None or int(status["id"]) < int(max_id))
+            and (since_id is None or int(status["id"]) > int(since_id))
+            and (min_id is None or int(status["id"]) > int(min_id))
+        ]
+        return statuses[-limit:] if min_id is not None else statuses[:limit]
+
+
+def run(monkeypatch, mastodon: FakeMastodon, *args: str) -> None:
+    monkeypatch.setattr(mastodon_download, "Mastodon", mastodon)
+    monkeypatch.setattr(
+        sys,
+        "argv",
+        ["mastodon-download-toots", "-c", "cache", *args, "mastodon.example"],
+    )
+    mastodon_download.main()
+
+
+def test_resume_json(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "cache").mkdir()
+    mastodon = FakeMastodon(200, fail_at_request=4)
+    with pytest.raises(Interrupted):
+        run(monkeypatch, mastodon, "-o", "out.json")
+
+    # the resumed download continues with the page that failed
+    mastodon.fail_at_request = None
+    mastodon.requests = 0
+    run(monkeypatch, mastodon, "-o", "out.json", "--resume")
+    assert mastodon.requests == 3
+    with open(tmp_path / "out.json") as file:
+        assert json.load(file) == mastodon.statuses
@@ -0,0 +1,31 @@
+import pytest
+
+from mastodon_download import serializer
+
+pytest.importorskip("orjson")
+
+STATUSES = [
+    {
+        "id": "109876543210",
+        "content": '<p>Grüße 🐘 "quoted" \\ back\nslash</p>',
+        "sensitive": False,
+        "spoiler_text": "",
+        "favourites_count": 3,
+        "poll": None,
+        "media_attachments": [{"id": "1", "meta": {"original": {"aspect": 1.5}}}],
+        "tags": [],
+        "lone_surrogate": "\ud800",
+    },
+    {"id": "2", "b": 1, "a": [0.5, -1, True, None, {}]},
+    # orjson only encodes integers up to 64 bits
+    {"id": "3", "content": "<p>Grüße</p>", "count": 2**64},
+]
+
+
+@pytest.mark.parametrize("sort_keys", [False, True])
+@pytest.mark.parametrize("obj", [*STATUSES, STATUSES])
+def test_backends_write_the_same_bytes(monkeypatch, obj, sort_keys):
+    encoded = serializer.dumps(obj, sort_keys=sort_keys)
+    monkeypatch.setattr(serializer, "orjson", None)
+    assert serializer.dumps(obj, sort_keys=sort_keys) == encoded
+    assert serializer.loads(encoded) == obj
@@ -0,0 +1,135 @@
+import json
+import os
+import sqlite3
+
+import pytest
+
+from mastodon_download.sqlite import NORMALIZED_VERSION, SqliteDatabase
+
+
+def status(id: int, content: str = "", media: int = 0) -> dict:
+    return {
+        "id": str(id),
+        "created_at": f"2024-01-01T00:00:{id % 60:02}.000Z",
+        "visibility": "public",
+        "content": f"<p>{content}</p>",
+        "spoiler_text": "",
+        "reblog": None,
+        "media_attachments": [
+            {
+                "id": f"{id}{k}",
+                "type": "image",
+                "url": f"https://files.example/{id}{k}.png",
+                "remote_url": None,
+                "preview_url": None,
+                "description": None,
+            }
+            for k in range(media)
+        ],
+    }
+
+
+def test_migrates_old_schema(tmp_path):
+    path = str(tmp_path / "old.sqlite")
+    # the schema of the first versions, without the hash and deleted_at columns
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE status(id TEXT NOT NULL PRIMARY KEY, status TEXT)")
+    con.execute("INSERT INTO status VALUES('1', '{\"id\": \"1\"}')")
+    con.commit()
+    con.close()
+
+    database = SqliteDatabase(path)
+    database.close()
+
+    con = sqlite3.connect(path)
+    columns = {row[1] for row in con.execute("PRAGMA table_info(status)")}
+    tables = {
+        row[0]
+        for row in con.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    }
+    con.close()
+    assert {"hash", "deleted_at"} <= columns
+    assert {"account", "newest_status", "crawl_state"} <= tables
+
+
+def test_normalize_indexes_existing_statuses(tmp_path):
+    path = str(tmp_path / "out.sqlite")
+    database = SqliteDatabase(path)
+    database.add_statuses(
+        [status(1, "elephants in the snow", media=2), status(2, "a quiet day")]
+    )
+    database.close()
+
+    database = SqliteDatabase(path, normalize=True)
+    assert [s["id"] for s in database.search("elephant*")] == ["1"]
+    # statuses added later are indexed as they are stored
+    database.add_statuses([status(3, "more elephants")])
+    assert {s["id"] for s in database.search("elephants")} == {"1", "3"}
+    database.close()
+
+    con = sqlite3.connect(path)
+    assert con.execute("PRAGMA user_version").fetchone()[0] == NORMALIZED_VERSION
+    assert con.execute("SELECT count(*) FROM media").fetchone()[0] == 2
+    con.close()
+
+
+def test_iter_statuses_newest_first(tmp_path):
+    database = SqliteDatabase(str(tmp_path / "out.sqlite"))
+    database.add_statuses([status(id) for id in (9, 10, 100, 11)])
+    ids = [s["id"] for batch in database.iter_statuses(batch_size=2) for s in batch]
+    database.close()
+    assert ids == ["100", "11", "10", "9"]
+
+
+def test_refresh_and_mark_deleted(tmp_path):
+    database = SqliteDatabase(str(tmp_path / "out.sqlite"))
+    database.add_statuses([status(id) for id in (1, 2, 3)])
+    assert database.refresh_statuses([status(1), status(2, "edited")]) == 1
+    assert database.mark_deleted({"1", "2"}) == 1
+    ids = [s["id"] for batch in database.iter_statuses() for s in batch]
+    database.close()
+    assert ids == ["2", "1"]
+
+
+def test_read_only_leaves_old_schema(tmp_path):
+    path = str(tmp_path / "old.sqlite")
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE status(id TEXT NOT NULL PRIMARY KEY, status TEXT)")
+    con.executemany(
+        "INSERT INTO status VALUES(?, ?)",
+        [(str(id), json.dumps(status(id))) for id in (1, 2)],
+    )
+    con.commit()
+    con.close()
+    with open(path, "rb") as file:
+        before = file.read()
+
+    database = SqliteDatabase(path, read_only=True)
+    ids = [s["id"] for batch in database.iter_statuses() for s in batch]
+    assert ids == ["2", "1"]
+    assert database.get_account() is None
+    assert database.get_instance() is None
+    with pytest.raises(sqlite3.OperationalError):
+        database.add_statuses([status(3)])
+    database.close()
+
+    with open(path, "rb") as file:
+        assert file.read() == before
+    assert sorted(os.listdir(tmp_path)) == ["old.sqlite"]
+
+
+def test_read_only_requires_existing_database(tmp_path):
+    with pytest.raises(Exception, match="doesn't exist"):
+        SqliteDatabase(str(tmp_path / "missing.sqlite"), read_only=True)
+    assert not (tmp_path / "missing.sqlite").exists()
+
+
+def test_search_leaves_out_deleted_statuses(tmp_path):
+    database = SqliteDatabase(str(tmp_path / "out.sqlite"), normalize=True)
+    database.add_statuses([status(1, "elephants"), status(2, "more elephants")])
+    assert database.mark_deleted({"2"}) == 1
+
+    assert [s["id"] for s in database.search("elephants")] == ["2"]
+    found = database.search("elephants", include_deleted=True)
+    assert {s["id"] for s in found} == {"1", "2"}
+    database.close()
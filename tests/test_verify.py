@@ -0,0 +1,106 @@
+import os
+import subprocess
+import sys
+
+from tests.conftest import REPOSITORY, run_tool
+
+
+def run_verify(cwd: str, *args: str) -> subprocess.CompletedProcess:
+    return subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "from mastodon_download.verify import main; main()",
+            "-c",
+            "cache",
+            *args,
+        ],
+        cwd=cwd,
+        env={**os.environ, "PYTHONPATH": REPOSITORY},
+        capture_output=True,
+        timeout=120,
+    )
+
+
+def test_repair_uses_the_instance_of_the_database(tmp_path, server, instance):
+    instance.media = 1
+    run_tool(
+        str(tmp_path),
+        "-s",
+        "-m",
+        "--media-output",
+        "media",
+        "-o",
+        "out.sqlite",
+        server.url,
+    )
+    removed = sorted(os.listdir(tmp_path / "media"))[:3]
+    for name in removed:
+        os.remove(tmp_path / "media" / name)
+
+    result = run_verify(str(tmp_path), "out.sqlite", "--media-output", "media")
+    assert result.returncode == 1
+    assert b"3 missing or corrupt" in result.stdout
+
+    # the account of the archive is on mastodon.example, the statuses were
+    # downloaded from the mock instance
+    result = run_verify(
+        str(tmp_path), "out.sqlite", "--media-output", "media", "--repair"
+    )
+    assert result.returncode == 0, result.stderr
+    assert b"Repaired 3 of 3 attachments" in result.stdout
+    assert set(removed) <= set(os.listdir(tmp_path / "media"))
+
+
+def test_repair_of_json_requires_domain(tmp_path, server, instance):
+    instance.media = 1
+    run_tool(
+        str(tmp_path), "-m", "--media-output", "media", "-o", "out.json", server.url
+    )
+    os.remove(tmp_path / "media" / sorted(os.listdir(tmp_path / "media"))[0])
+
+    result = run_verify(
+        str(tmp_path), "out.json", "--media-output", "media", "--repair"
+    )
+    assert result.returncode == 1
+    assert b"pass --domain" in result.stderr
+
+    result = run_verify(
+        str(tmp_path),
+        "out.json",
+        "--media-output",
+        "media",
+        "--repair",
+        "--domain",
+        server.url,
+    )
+    assert result.returncode == 0, result.stderr
+    assert b"Repaired 1 of 1 attachments" in result.stdout
+
+
+def test_repair_downloads_the_preview_again(tmp_path, server, instance):
+    instance.media = 1
+    run_tool(
+        str(tmp_path),
+        "-s",
+        "-m",
+        "--media-output",
+        "media",
+        "--media-preview-types",
+        "image",
+        "-o",
+        "out.sqlite",
+        server.url,
+    )
+    names = sorted(os.listdir(tmp_path / "media"))
+    assert all(name.endswith("_preview.png") for name in names)
+    # an interrupted write leaves an empty file
+    open(tmp_path / "media" / names[0], "w").close()
+
+    result = run_verify(
+        str(tmp_path), "out.sqlite", "--media-output", "media", "--repair"
+    )
+    assert result.returncode == 0, result.stderr
+    assert b"Repaired 1 of 1 attachments" in result.stdout
+    assert sorted(os.listdir(tmp_path / "media")) == names
+    assert os.path.getsize(tmp_path / "media" / names[0]) > 0
@@ -0,0 +1,53 @@
+import json
+from io import BytesIO
+
+from mastodon_download.writer import StatusWriter
+
+ACCOUNT = {"id": "1", "username": "bench", "acct": "bench"}
+
+
+def statuses(count: int) -> list[dict]:
+    return [
+        {
+            "id": str(100 - i),
+            "content": f"<p>status {i} Grüße 🐘</p>",
+            "account": ACCOUNT,
+            "media_attachments": [],
+        }
+        for i in range(count)
+    ]
+
+
+def write(pages: list[list[dict]], optimize_json: bool) -> bytes:
+    file = BytesIO()
+    writer = StatusWriter(file, optimize_json=optimize_json)
+    for page in pages:
+        writer.write(page)
+    writer.close()
+    return file.getvalue()
+
+
+def test_output_is_identical_to_dumps():
+    all_statuses = statuses(85)
+    pages = [all_statuses[i : i + 40] for i in range(0, 85, 40)]
+    assert write(pages, optimize_json=False) == json.dumps(all_statuses).encode()
+
+
+def test_optimized_output_is_identical_to_dumps():
+    all_statuses = statuses(85)
+    pages = [all_statuses[i : i + 40] for i in range(0, 85, 40)]
+    optimized = {
+        "account": ACCOUNT,
+        "statuses": [
+            {k: v for k, v in status.items() if k != "account"}
+            for status in all_statuses
+        ],
+    }
+    assert write(pages, optimize_json=True) == json.dumps(optimized).encode()
+
+
+def test_empty_output():
+    assert write([], optimize_json=False) == b"[]"
+    assert write([], optimize_json=True) == json.dumps(
+        {"account": None, "statuses": []}
+    ).encode("utf-8")
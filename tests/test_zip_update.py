@@ -0,0 +1,120 @@
+import json
+from zipfile import ZipFile
+
+import pytest
+
+from mastodon_download.archive import is_intact
+from tests.conftest import run_tool
+
+
+def archive_contents(path) -> tuple[list[str], list[str]]:
+    """The status ids and the attachments of a zip file."""
+    with ZipFile(path) as zipfile:
+        assert zipfile.testzip() is None
+        statuses = json.loads(zipfile.read("statuses.json"))
+        media = [name for name in zipfile.namelist() if name.startswith("media/")]
+    return [status["id"] for status in statuses], media
+
+
+def test_update(tmp_path, server, instance):
+    instance.media = 1
+    run_tool(str(tmp_path), "-z", "-o", "out.zip", server.url)
+    instance.add_statuses(50)
+    instance.reset_counters()
+    run_tool(str(tmp_path), "-z", "--update", "-o", "out.zip", server.url)
+
+    ids, media = archive_contents(tmp_path / "out.zip")
+    assert len(ids) == len(set(ids)) == 250
+    assert len(media) == 250
+    assert instance.requests["media"] == 50
+
+
+# killed while downloading the new attachments and while writing statuses.json
+@pytest.mark.parametrize("kill_after_members", [10, 50])
+def test_update_after_kill(tmp_path, server, instance, kill_after_members):
+    instance.media = 1
+    run_tool(str(tmp_path), "-z", "-o", "out.zip", server.url)
+    instance.add_statuses(50)
+    killed = run_tool(
+        str(tmp_path),
+        "-z",
+        "--update",
+        "--media-workers",
+        "1",
+        "-o",
+        "out.zip",
+        server.url,
+        kill_after_members=kill_after_members,
+        check=False,
+    )
+    assert killed.returncode == 9
+
+    assert not is_intact(str(tmp_path / "out.zip"))
+
+    # the next update puts the archive back as it was before the killed one
+    result = run_tool(str(tmp_path), "-z", "--update", "-o", "out.zip", server.url)
+    assert b"Restored out.zip" in result.stdout
+    ids, media = archive_contents(tmp_path / "out.zip")
+    assert len(ids) == len(set(ids)) == 250
+    assert len(media) == 250
+
+
+@pytest.mark.parametrize("kill_after_members", [45, 150])
+def test_resume_after_kill(tmp_path, server, instance, kill_after_members):
+    instance.media = 1
+    killed = run_tool(
+        str(tmp_path),
+        "-z",
+        "--crawl-workers",
+        "1",
+        "--media-workers",
+        "1",
+        "-o",
+        "out.zip",
+        server.url,
+        kill_after_members=kill_after_members,
+        check=False,
+    )
+    assert killed.returncode == 9
+
+    # the archive was never closed, the attachments are downloaded again
+    result = run_tool(str(tmp_path), "-z", "--resume", "-o", "out.zip", server.url)
+    assert b"downloaded again" in result.stdout
+    ids, media = archive_contents(tmp_path / "out.zip")
+    assert len(ids) == len(set(ids)) == 200
+    assert len(media) == 200
+
+
+def test_resume_after_interrupted_resume(tmp_path, server, instance):
+    instance.media = 1
+    run_tool(
+        str(tmp_path),
+        "-z",
+        "--crawl-workers",
+        "1",
+        "--media-workers",
+        "1",
+        "-o",
+        "out.zip",
+        server.url,
+        kill_after_members=45,
+        check=False,
+    )
+    # the resume is killed as well, after the rebuilt archive got its attachments
+    killed = run_tool(
+        str(tmp_path),
+        "-z",
+        "--resume",
+        "--media-workers",
+        "1",
+        "-o",
+        "out.zip",
+        server.url,
+        kill_after_members=100,
+        check=False,
+    )
+    assert killed.returncode == 9
+    run_tool(str(tmp_path), "-z", "--resume", "-o", "out.zip", server.url)
+    ids, media = archive_contents(tmp_path / "out.zip")
+    assert len(ids) == len(set(ids)) == 200
+    assert len(media) == 200